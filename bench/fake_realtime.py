@@ -0,0 +1,89 @@
+# bench/fake_realtime.py
+# Servidor falso del API realtime de OpenAI para probar voice_realtime.py sin red ni costo.
+#
+# Uso:
+#   python bench/fake_realtime.py --port 8765 --latency-ms 150
+#   OPENAI_REALTIME_URL=ws://127.0.0.1:8765/v1/realtime python main.py
+#
+# Comportamiento:
+# - Cada --turn-frames frames de input_audio_buffer.append simula un turno del llamante
+#   (speech_started -> speech_stopped -> transcripción) y responde tras --latency-ms
+#   con --reply-frames deltas de audio μ-law (silencio) + transcript + response.done.
+# - response.create (p. ej. el saludo) responde igual; response.cancel corta la respuesta en curso.
+
+import argparse
+import base64
+import json
+import threading
+import time
+import uuid
+
+from flask import Flask
+from flask_sock import Sock
+
+app = Flask(__name__)
+sock = Sock(app)
+ARGS = None
+
+# 20 ms de silencio μ-law (8 kHz => 160 bytes)
+_SILENCE_FRAME = base64.b64encode(b"\xff" * 160).decode("ascii")
+
+
+def _send(ws, lock, payload):
+    with lock:
+        ws.send(json.dumps(payload))
+
+
+def _respond(ws, lock, cancel_evt, texto):
+    time.sleep(ARGS.latency_ms / 1000.0)
+    item_id = f"item_{uuid.uuid4().hex[:8]}"
+    for _ in range(ARGS.reply_frames):
+        if cancel_evt.is_set():
+            break
+        _send(ws, lock, {"type": "response.audio.delta", "item_id": item_id, "delta": _SILENCE_FRAME})
+        time.sleep(ARGS.frame_ms / 1000.0)
+    if not cancel_evt.is_set():
+        _send(ws, lock, {"type": "response.audio_transcript.done", "item_id": item_id, "transcript": texto})
+    _send(ws, lock, {"type": "response.done", "response": {"status": "cancelled" if cancel_evt.is_set() else "completed"}})
+
+
+@sock.route("/v1/realtime")
+def realtime(ws):
+    lock = threading.Lock()
+    frames = 0
+    turno = 0
+    cancel_evt = threading.Event()
+    while True:
+        raw = ws.receive()
+        if raw is None:
+            break
+        msg = json.loads(raw)
+        mtype = msg.get("type")
+        if mtype == "session.update":
+            _send(ws, lock, {"type": "session.updated", "session": msg.get("session", {})})
+        elif mtype == "response.create":
+            cancel_evt = threading.Event()
+            threading.Thread(target=_respond, args=(ws, lock, cancel_evt, "Hola, ¿en qué te ayudo?"), daemon=True).start()
+        elif mtype == "response.cancel":
+            cancel_evt.set()
+        elif mtype == "input_audio_buffer.append":
+            frames += 1
+            if frames % ARGS.turn_frames == 1:
+                _send(ws, lock, {"type": "input_audio_buffer.speech_started"})
+            elif frames % ARGS.turn_frames == 0:
+                turno += 1
+                _send(ws, lock, {"type": "input_audio_buffer.speech_stopped"})
+                _send(ws, lock, {"type": "conversation.item.input_audio_transcription.completed", "transcript": f"turno {turno} del llamante"})
+                cancel_evt = threading.Event()
+                threading.Thread(target=_respond, args=(ws, lock, cancel_evt, f"respuesta {turno}"), daemon=True).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor realtime falso (OpenAI) para pruebas locales")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=int, default=150, help="espera antes del primer delta de audio")
+    parser.add_argument("--turn-frames", type=int, default=50, help="frames del llamante por turno (50 = 1 s)")
+    parser.add_argument("--reply-frames", type=int, default=50, help="frames de audio por respuesta")
+    parser.add_argument("--frame-ms", type=int, default=20, help="ritmo de envío de frames")
+    ARGS = parser.parse_args()
+    app.run(host="127.0.0.1", port=ARGS.port, threaded=True)
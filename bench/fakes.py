@@ -0,0 +1,421 @@
+# bench/fakes.py
+# Servidores falsos (sin red ni costo) de Firebase RTDB, OpenAI y Twilio REST para los benchmarks.
+#
+# Uso suelto (un puerto para los tres):
+#   python bench/fakes.py --port 9400 --rtdb-latency-ms 8 --openai-base-ms 400 --openai-ms-per-token 15
+#   FIREBASE_DATABASE_EMULATOR_HOST=127.0.0.1:9400 OPENAI_BASE_URL=http://127.0.0.1:9400/v1 ...
+# o en proceso: start_fakes(FakeConfig(...)) -> (server, base_url)  (lo usa bench/webhook_bench.py)
+#
+# Rutas:
+# - /v1/chat/completions, /v1/audio/speech       -> OpenAI (latencia = base + ms/token de salida)
+# - /2010-04-01/Accounts/<sid>/Messages.json     -> Twilio REST (create + listado vacío)
+# - /__stats, /__reset                           -> contadores por servicio/método (GET) y reinicio (POST)
+# - cualquier otra ruta *.json                   -> RTDB (protocolo REST del emulador: GET con shallow/orderBy/
+#                                                   startAt/endAt/equalTo/limitTo*, ETag + if-match, PUT, PATCH
+#                                                   multi-path, POST push, DELETE)
+# Todo es determinista salvo el jitter (semilla fija --seed).
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+@dataclass
+class FakeConfig:
+    rtdb_latency_ms: float = 5.0
+    openai_base_ms: float = 300.0
+    openai_ms_per_token: float = 10.0
+    openai_completion_tokens: int = 60
+    tts_ms: float = 250.0
+    twilio_ms: float = 120.0
+    jitter: float = 0.1        # ±10 % sobre cada latencia
+    seed: int = 42
+
+
+# =======================
+# RTDB en memoria
+# =======================
+def _rank(v):
+    """Orden de RTDB: null < false < true < números < strings < objetos."""
+    if v is None:
+        return (0, 0)
+    if isinstance(v, bool):
+        return (1 if not v else 2, 0)
+    if isinstance(v, (int, float)):
+        return (3, v)
+    if isinstance(v, str):
+        return (4, v)
+    return (5, 0)
+
+
+def _children(node) -> dict:
+    return node if isinstance(node, dict) else {}
+
+
+def _to_tree(v):
+    """Como RTDB: arrays => objetos con claves "0".."n"; null y objetos vacíos no existen."""
+    if isinstance(v, list):
+        v = {str(i): x for i, x in enumerate(v)}
+    if isinstance(v, dict):
+        out = {str(k): _to_tree(x) for k, x in v.items()}
+        out = {k: x for k, x in out.items() if x is not None}
+        return out or None
+    return v
+
+
+def _from_tree(v):
+    """Al leer, claves enteras densas (más de la mitad ocupadas) vuelven como array, igual que RTDB."""
+    if not isinstance(v, dict):
+        return v
+    out = {k: _from_tree(x) for k, x in v.items()}
+    if out and all(k.isdigit() for k in out):
+        top = max(int(k) for k in out)
+        if len(out) * 2 > top + 1:
+            return [out.get(str(i)) for i in range(top + 1)]
+    return out
+
+
+class FakeRTDB:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.root = None
+
+    def node(self, parts):
+        """Nodo crudo (objetos); llamar con self.lock tomado."""
+        node = self.root
+        for p in parts:
+            node = _children(node).get(p)
+            if node is None:
+                return None
+        return node
+
+    def get(self, parts):
+        with self.lock:
+            return _from_tree(self.node(parts))
+
+    def set_locked(self, parts, value):
+        value = _to_tree(value)
+        if not parts:
+            self.root = value
+            return
+        if not isinstance(self.root, dict):
+            self.root = {}
+        camino = [self.root]
+        for p in parts[:-1]:
+            hijo = camino[-1].get(p)
+            if not isinstance(hijo, dict):
+                hijo = camino[-1][p] = {}
+            camino.append(hijo)
+        if value is None:
+            camino[-1].pop(parts[-1], None)
+        else:
+            camino[-1][parts[-1]] = value
+        # padres vacíos desaparecen
+        for i in range(len(camino) - 1, 0, -1):
+            if camino[i]:
+                break
+            camino[i - 1].pop(parts[i - 1], None)
+
+    def set(self, parts, value):
+        with self.lock:
+            self.set_locked(parts, value)
+
+    def update(self, parts, cambios: dict):
+        with self.lock:
+            for sub, value in (cambios or {}).items():
+                self.set_locked(parts + [p for p in str(sub).split("/") if p], value)
+
+    def push(self, parts, value) -> str:
+        key = f"-{int(time.time() * 1000):013d}{uuid.uuid4().hex[:7]}"
+        self.set(parts + [key], value)
+        return key
+
+    def reset(self):
+        with self.lock:
+            self.root = None
+
+
+def _etag(value) -> str:
+    return hashlib.md5(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _query(node, params: dict):
+    """Filtros de consulta del REST de RTDB (el SDK reordena en cliente; aquí se filtra y limita)."""
+    order = json.loads(params["orderBy"]) if "orderBy" in params else None
+    hijos = _children(node)
+    if order is None:
+        return node
+
+    def _val(k, v):
+        if order == "$key":
+            return k
+        if order == "$value":
+            return v
+        cur = v
+        for p in order.split("/"):
+            cur = cur.get(p) if isinstance(cur, dict) else None
+        return cur
+
+    hijos = {k: _from_tree(v) for k, v in hijos.items()}
+    items = sorted(hijos.items(), key=lambda kv: (_rank(_val(*kv)), kv[0]))
+    if "equalTo" in params:
+        eq = json.loads(params["equalTo"])
+        items = [kv for kv in items if _val(*kv) == eq]
+    if "startAt" in params:
+        lo = _rank(json.loads(params["startAt"]))
+        items = [kv for kv in items if _rank(_val(*kv)) >= lo]
+    if "endAt" in params:
+        hi = _rank(json.loads(params["endAt"]))
+        items = [kv for kv in items if _rank(_val(*kv)) <= hi]
+    if "limitToFirst" in params:
+        items = items[:int(params["limitToFirst"])]
+    if "limitToLast" in params:
+        n = int(params["limitToLast"])
+        items = items[-n:] if n else []
+    return {k: v for k, v in items}
+
+
+# =======================
+# Servidor
+# =======================
+class _Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}   # "rtdb.GET" -> n
+        self.openai_tokens = {"prompt": 0, "completion": 0}
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.openai_tokens = {"prompt": 0, "completion": 0}
+
+    def hit(self, key: str):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            rtdb = {k.split(".", 1)[1]: v for k, v in self.counts.items() if k.startswith("rtdb.")}
+            return {
+                "counts": dict(self.counts),
+                "rtdb_total": sum(rtdb.values()),
+                "rtdb": rtdb,
+                "openai_tokens": dict(self.openai_tokens),
+            }
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256   # ráfagas: el backlog por defecto (5) descarta conexiones y mete reintentos de 1 s
+
+    def __init__(self, addr, cfg: FakeConfig):
+        super().__init__(addr, _Handler)
+        self.cfg = cfg
+        self.rtdb = FakeRTDB()
+        self.stats = _Stats()
+        self._rnd = random.Random(cfg.seed)
+        self._rnd_lock = threading.Lock()
+
+    def sleep_ms(self, ms: float):
+        if ms <= 0:
+            return
+        with self._rnd_lock:
+            f = 1 + self._rnd.uniform(-self.cfg.jitter, self.cfg.jitter) if self.cfg.jitter else 1
+        time.sleep(ms * f / 1000.0)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True   # keep-alive: cabeceras y cuerpo van en escrituras separadas
+    server: FakeServer
+
+    def log_message(self, *args):
+        pass
+
+    # ---- utilidades ----
+    def _body(self) -> bytes:
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _send(self, status: int, payload=None, raw: bytes = None, ctype="application/json", headers=None):
+        data = raw if raw is not None else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, method: str):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        body = self._body() if method in ("POST", "PUT", "PATCH") else b""
+        try:
+            if path.startswith("/__"):
+                return self._control(method, path, params)
+            if path.startswith("/v1/"):
+                return self._openai(method, path, body)
+            if path.startswith("/2010-04-01/"):
+                return self._twilio(method, path, body)
+            return self._rtdb(method, path, params, body)
+        except Exception as e:
+            return self._send(500, {"error": str(e)})
+
+    do_GET = lambda self: self._dispatch("GET")
+    do_PUT = lambda self: self._dispatch("PUT")
+    do_POST = lambda self: self._dispatch("POST")
+    do_PATCH = lambda self: self._dispatch("PATCH")
+    do_DELETE = lambda self: self._dispatch("DELETE")
+
+    # ---- control ----
+    def _control(self, method, path, params):
+        srv = self.server
+        if path == "/__stats":
+            return self._send(200, srv.stats.snapshot())
+        if path == "/__reset" and method == "POST":
+            srv.stats.reset()
+            if params.get("data") in ("1", "true"):
+                srv.rtdb.reset()
+            return self._send(200, {"ok": True})
+        return self._send(404, {"error": "not found"})
+
+    # ---- RTDB ----
+    def _rtdb(self, method, path, params, body):
+        srv = self.server
+        if not path.endswith(".json"):
+            return self._send(404, {"error": "not found"})
+        parts = [p for p in path[:-len(".json")].split("/") if p]
+        kind = method
+        if method == "GET" and params.get("shallow") == "true":
+            kind = "GET.shallow"
+        elif method == "GET" and "orderBy" in params:
+            kind = "GET.query"
+        elif method == "PUT" and self.headers.get("if-match"):
+            kind = "PUT.if_match"
+        srv.stats.hit(f"rtdb.{kind}")
+        srv.sleep_ms(srv.cfg.rtdb_latency_ms)
+        silent = params.get("print") == "silent"
+
+        if method == "GET":
+            with srv.rtdb.lock:
+                node = srv.rtdb.node(parts)
+                if params.get("shallow") == "true" and isinstance(node, dict):
+                    node = {k: (True if isinstance(v, dict) else v) for k, v in node.items()}
+                elif "orderBy" in params:
+                    node = _query(node, params)
+                else:
+                    node = _from_tree(node)
+            headers = {"ETag": _etag(node)} if self.headers.get("X-Firebase-ETag") else None
+            return self._send(200, node, headers=headers)
+
+        value = json.loads(body.decode("utf-8")) if body else None
+        if method == "PUT":
+            expected = self.headers.get("if-match")
+            if expected:
+                with srv.rtdb.lock:
+                    cur = _from_tree(srv.rtdb.node(parts))
+                    if _etag(cur) != expected:
+                        return self._send(412, cur, headers={"ETag": _etag(cur)})
+                    srv.rtdb.set_locked(parts, value)
+                    nuevo = _from_tree(srv.rtdb.node(parts))
+                return self._send(200, nuevo, headers={"ETag": _etag(nuevo)})
+            srv.rtdb.set(parts, value)
+            return self._send(204, raw=b"") if silent else self._send(200, value)
+        if method == "PATCH":
+            srv.rtdb.update(parts, value or {})
+            return self._send(204, raw=b"") if silent else self._send(200, value)
+        if method == "POST":
+            return self._send(200, {"name": srv.rtdb.push(parts, value)})
+        if method == "DELETE":
+            srv.rtdb.set(parts, None)
+            return self._send(200, None)
+        return self._send(405, {"error": "method not allowed"})
+
+    # ---- OpenAI ----
+    def _openai(self, method, path, body):
+        srv, cfg = self.server, self.server.cfg
+        req = json.loads(body.decode("utf-8")) if body else {}
+        if path == "/v1/chat/completions":
+            srv.stats.hit("openai.chat")
+            prompt_tokens = sum(len(str(m.get("content") or "")) for m in req.get("messages") or []) // 4 + 1
+            out_tokens = int(req.get("max_tokens") or cfg.openai_completion_tokens)
+            srv.sleep_ms(cfg.openai_base_ms + cfg.openai_ms_per_token * out_tokens)
+            with srv.stats.lock:
+                srv.stats.openai_tokens["prompt"] += prompt_tokens
+                srv.stats.openai_tokens["completion"] += out_tokens
+            texto = " ".join(["palabra"] * max(1, out_tokens - 6)) + f" (resp {uuid.uuid4().hex[:6]}). ¿Algo más?"
+            return self._send(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": req.get("model") or "gpt-4o",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": texto}}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": out_tokens,
+                          "total_tokens": prompt_tokens + out_tokens},
+            })
+        if path == "/v1/audio/speech":
+            srv.stats.hit("openai.tts")
+            srv.sleep_ms(cfg.tts_ms)
+            return self._send(200, raw=b"\xff\xfb\x90\x00" + b"\x00" * 2044, ctype="audio/mpeg")
+        return self._send(404, {"error": {"message": f"ruta falsa no soportada: {path}"}})
+
+    # ---- Twilio ----
+    def _twilio(self, method, path, body):
+        srv = self.server
+        srv.stats.hit(f"twilio.{method}")
+        srv.sleep_ms(srv.cfg.twilio_ms)
+        if path.endswith("/Messages.json") and method == "POST":
+            form = {k: v[-1] for k, v in parse_qs(body.decode("utf-8")).items()}
+            sid = "SM" + uuid.uuid4().hex
+            return self._send(201, {
+                "sid": sid, "status": "queued", "direction": "outbound-api",
+                "from": form.get("From"), "to": form.get("To"), "body": form.get("Body"),
+                "price": None, "price_unit": "USD", "num_segments": "1",
+                "date_created": time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()),
+                "uri": path.replace(".json", f"/{sid}.json"),
+            })
+        if path.endswith("/Messages.json"):
+            return self._send(200, {"messages": [], "next_page_uri": None, "page": 0, "page_size": 50,
+                                    "first_page_uri": path, "uri": path})
+        return self._send(404, {"code": 20404, "message": "not found"})
+
+
+def start_fakes(cfg: FakeConfig = None, host: str = "127.0.0.1", port: int = 0):
+    """Arranca el servidor en un hilo (con eventlet parcheado, un greenlet). Devuelve (server, base_url)."""
+    server = FakeServer((host, port), cfg or FakeConfig())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="RTDB/OpenAI/Twilio falsos para benchmarks")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9400)
+    ap.add_argument("--rtdb-latency-ms", type=float, default=5.0)
+    ap.add_argument("--openai-base-ms", type=float, default=300.0)
+    ap.add_argument("--openai-ms-per-token", type=float, default=10.0)
+    ap.add_argument("--openai-completion-tokens", type=int, default=60)
+    ap.add_argument("--tts-ms", type=float, default=250.0)
+    ap.add_argument("--twilio-ms", type=float, default=120.0)
+    ap.add_argument("--jitter", type=float, default=0.1)
+    ap.add_argument("--seed", type=int, default=42)
+    a = ap.parse_args()
+    cfg = FakeConfig(a.rtdb_latency_ms, a.openai_base_ms, a.openai_ms_per_token, a.openai_completion_tokens,
+                     a.tts_ms, a.twilio_ms, a.jitter, a.seed)
+    server = FakeServer((a.host, a.port), cfg)
+    print(f"[fakes] Escuchando en http://{a.host}:{a.port} (RTDB, /v1 OpenAI, /2010-04-01 Twilio)")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
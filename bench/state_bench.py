@@ -0,0 +1,97 @@
+# bench/state_bench.py
+# Comparativa de throughput del estado de conversación (state_backend.py) por backend y nº de workers.
+#
+# Uso:
+#   python bench/state_bench.py --messages 4000 --workers 1,2,4 --cpu-us 2000 --greenlets 20
+#   STATE_REDIS_URL=redis://127.0.0.1:6379/0 python bench/state_bench.py --backends memory,sqlite,redis
+#
+# Cada "mensaje" reproduce las operaciones de estado de un webhook de WhatsApp
+# (exists/get/append/set ~ 9 ops) más --cpu-us de CPU sintética (parseo, TwiML, etc.).
+# Cada worker es un proceso con eventlet parcheado (como gunicorn -k eventlet) que atiende
+# --greenlets mensajes a la vez sobre un único backend, igual que los greenlets de un worker real.
+# "memory" solo se mide con 1 worker: no es compartible entre procesos (con N workers
+# cada conversación perdería el contexto al caer en otro proceso).
+
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def _burn(us: int):
+    fin = time.perf_counter() + us / 1e6
+    x = 0
+    while time.perf_counter() < fin:
+        x += 1
+    return x
+
+
+def _one_message(state, clave: str, i: int, cpu_us: int):
+    """Mismas operaciones que whatsapp_bot() sobre el backend de estado."""
+    if not state.exists("hist", clave):
+        state.list_set("hist", clave, [{"role": "system", "content": "Eres un asistente."}])
+        state.set("followup", clave, {"5min": False, "60min": False})
+        state.set("greeted", clave, False)
+    agenda = state.get("agenda", clave) or {}
+    state.get("greeted", clave)
+    state.list_append("hist", clave, {"role": "user", "content": f"mensaje {i}"})
+    state.set("last_msg", clave, time.time())
+    mensajes = state.list_get("hist", clave)
+    _burn(cpu_us)
+    state.list_append("hist", clave, {"role": "assistant", "content": f"respuesta {i} ({len(mensajes)})"})
+    agenda["last_bot_hash"] = str(i)
+    state.set("agenda", clave, agenda)
+
+
+def _worker(kind: str, opciones: dict, wid: int, n: int, conversations: int, cpu_us: int, greenlets: int, out):
+    # Parcheado en el hijo antes de importar state_backend: threading.local/Lock pasan a ser de greenlet
+    import eventlet
+    eventlet.monkey_patch()
+    import state_backend
+    state = state_backend.make_backend(kind, **opciones)
+    pool = eventlet.GreenPool(max(1, greenlets))
+    t0 = time.perf_counter()
+    for i in range(n):
+        clave = f"whatsapp:+1555000{(wid * 7919 + i) % conversations:04d}|whatsapp:+1555999{wid}"
+        pool.spawn_n(_one_message, state, clave, i, cpu_us)
+    pool.waitall()
+    out.put(time.perf_counter() - t0)
+
+
+def run(kind: str, opciones: dict, workers: int, messages: int, conversations: int, cpu_us: int, greenlets: int) -> float:
+    per = messages // workers
+    q = mp.SimpleQueue()   # sin hilo alimentador: mp.Queue se cuelga con eventlet parcheado
+    procs = [mp.Process(target=_worker, args=(kind, opciones, w, per, conversations, cpu_us, greenlets, q)) for w in range(workers)]
+    t0 = time.perf_counter()
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    wall = time.perf_counter() - t0
+    return per * workers / wall
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput del backend de estado de conversación")
+    parser.add_argument("--backends", default="memory,sqlite")
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--messages", type=int, default=4000)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--cpu-us", type=int, default=2000, help="CPU sintética por mensaje (µs)")
+    parser.add_argument("--greenlets", type=int, default=20, help="Mensajes concurrentes por worker (eventlet)")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="state_bench_")
+    print(f"CPUs: {os.cpu_count()}  mensajes: {args.messages}  conversaciones: {args.conversations}  cpu/msg: {args.cpu_us} µs  greenlets/worker: {args.greenlets}")
+    print(f"{'backend':<8} {'workers':>7} {'msg/s':>10}")
+    for kind in [k.strip() for k in args.backends.split(",") if k.strip()]:
+        for w in [int(x) for x in args.workers.split(",")]:
+            if kind == "memory" and w > 1:
+                continue
+            opciones = {"path": os.path.join(tmp, f"{kind}_{w}.sqlite3")} if kind == "sqlite" else {}
+            rate = run(kind, opciones, w, args.messages, args.conversations, args.cpu_us, args.greenlets)
+            print(f"{kind:<8} {w:>7} {rate:>10.0f}")
@@ -0,0 +1,309 @@
+# bench/webhook_bench.py
+# Benchmark de punta a punta de whatsapp_bot() (/webhook) y voice_gather() (/voice-gather) sin red:
+# main.app arranca contra bench/fakes.py (RTDB, OpenAI y Twilio falsos, en proceso) y se le envía
+# tráfico de varias conversaciones concurrentes (greenlets de eventlet, como en producción).
+#
+# Uso:
+#   python bench/webhook_bench.py
+#   python bench/webhook_bench.py --scenarios steady,burst,long,agenda,voice --conversations 40 --concurrency 32 \
+#       --rtdb-latency-ms 8 --openai-base-ms 400 --openai-ms-per-token 12 --history 300
+#   python bench/webhook_bench.py --json /tmp/bench.json --max-p95-ms 3000 --max-rtdb-per-msg 12   (exit 1 si regresa)
+#
+# Escenarios:
+# - steady: cada conversación manda --messages mensajes con --think-ms de pausa (tráfico normal)
+# - burst:  --burst conversaciones nuevas escriben a la vez, sin pausa (pico de campaña / reintentos de Twilio)
+# - long:   conversaciones con --history entradas previas en RTDB (hidratación + RMW de historial grande)
+# - agenda: hola -> palabra clave de agenda -> "sí" (enlace) -> "ya agendé" (sin OpenAI en los pasos de agenda)
+# - voice:  /voice + saludo + --messages turnos de /voice-gather por llamada (chat + TTS por turno)
+# Reporte por escenario: peticiones/s, p50/p95/p99/max (ms), errores y round-trips a RTDB por mensaje.
+# Los falsos en proceso comparten CPU con la app; para aislarlos: python bench/fakes.py --port 9400 y
+#   python bench/webhook_bench.py --fakes-url http://127.0.0.1:9400   (las latencias se configuran en fakes.py)
+
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeConfig, start_fakes
+
+SCENARIOS = ("steady", "burst", "long", "agenda", "voice")
+_CLIENT_NUM = "whatsapp:+1555{:07d}"
+
+
+def _percentile(vals, p):
+    if not vals:
+        return 0.0
+    vals = sorted(vals)
+    k = max(0, min(len(vals) - 1, int(round(p / 100.0 * (len(vals) - 1)))))
+    return vals[k]
+
+
+def _fake_stats(base: str) -> dict:
+    with urllib.request.urlopen(f"{base}/__stats") as r:
+        return json.loads(r.read())
+
+
+def _fake_reset(base: str):
+    urllib.request.urlopen(urllib.request.Request(f"{base}/__reset", data=b"", method="POST")).close()
+
+
+def _quiesce(base: str, max_wait: float = 5.0):
+    """Espera a que los hilos de fondo (ledger, índices) terminen: contadores estables 300 ms."""
+    prev, fin = None, time.time() + max_wait
+    while time.time() < fin:
+        cur = _fake_stats(base)["counts"]
+        if cur == prev:
+            return
+        prev = cur
+        eventlet.sleep(0.3)
+
+
+# =======================
+# Arranque de la app contra los falsos
+# =======================
+def boot_app(base: str):
+    host = base.split("://", 1)[1]
+    os.environ["FIREBASE_DATABASE_EMULATOR_HOST"] = host
+    os.environ["FIREBASE_DB_URL"] = "https://bench-default-rtdb.firebaseio.com"
+    os.environ["OPENAI_BASE_URL"] = f"{base}/v1"
+    os.environ["OPENAI_API_KEY"] = "bench"
+    os.environ["TWILIO_ACCOUNT_SID"] = "AC" + "0" * 32
+    os.environ["TWILIO_AUTH_TOKEN"] = "bench"
+    os.environ.setdefault("CAMPAIGNS_WORKER", "0")
+    os.environ.setdefault("SEARCH_INDEX_ON_BOOT", "0")
+    os.environ.setdefault("VOICE_REALTIME", "0")
+    os.environ.setdefault("DEV_HTTP", "true")
+
+    # Firebase: con el emulador no hace falta certificado (main.py no reinicializa si ya hay app)
+    import firebase_admin
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(options={"databaseURL": os.environ["FIREBASE_DB_URL"], "projectId": "bench"})
+
+    import main
+
+    # Twilio REST: mismo SDK, pero el host api.twilio.com se reescribe al falso
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client as TwilioClient
+
+    class _FakeTwilioHttp(TwilioHttpClient):
+        def request(self, method, url, *args, **kwargs):
+            url = url.replace("https://api.twilio.com", base, 1)
+            return super().request(method, url, *args, **kwargs)
+
+    main.twilio_client = TwilioClient(os.environ["TWILIO_ACCOUNT_SID"], os.environ["TWILIO_AUTH_TOKEN"],
+                                      http_client=_FakeTwilioHttp())
+    _check_boot(main)
+    return main
+
+# Blueprints que main.py debe registrar: si falta uno el bench falla en vez de medir una app a medias
+_BOOT_HEALTH = ("/billing/health", "/api/mobile/health")
+
+def _check_boot(main):
+    c = main.app.test_client()
+    for path in _BOOT_HEALTH:
+        r = c.get(path)
+        if r.status_code != 200:
+            raise SystemExit(f"[bench] ❌ {path} respondió {r.status_code}: main.py no arrancó completo")
+
+
+# =======================
+# Tráfico
+# =======================
+def _bots(main, need_agenda=False) -> list:
+    out = []
+    for number, cfg in main.bots_config.items():
+        if not isinstance(cfg, dict) or not cfg.get("name"):
+            continue
+        if need_agenda and not ((cfg.get("agenda") or {}).get("keywords")):
+            continue
+        out.append((number, cfg))
+    return out
+
+
+def _wa(bot_number: str, sender: str, body: str, n: int) -> tuple:
+    return ("/webhook", {"From": sender, "To": bot_number, "Body": body,
+                         "MessageSid": f"SMbench{sender.split('+')[-1]}{n:05d}", "NumMedia": "0"})
+
+
+def _plan(main, base: str, scenario: str, args, offset: int) -> list:
+    """Lista de conversaciones; cada una es una lista de (ruta, form, pausa_ms) que se envía en orden."""
+    bots = _bots(main)
+    convs = []
+    if scenario in ("steady", "long"):
+        for i in range(args.conversations):
+            number, cfg = bots[i % len(bots)]
+            sender = _CLIENT_NUM.format(offset + i)
+            if scenario == "long":
+                _seed_history(base, cfg["name"], sender, args.history)
+            convs.append([(*_wa(number, sender, f"Quisiera información sobre sus servicios, pregunta {n}", n),
+                           args.think_ms) for n in range(args.messages)])
+    elif scenario == "burst":
+        for i in range(args.burst):
+            number, _ = bots[i % len(bots)]
+            sender = _CLIENT_NUM.format(offset + i)
+            convs.append([(*_wa(number, sender, "Necesito una cotización, ¿me ayudas?", 0), 0)])
+    elif scenario == "agenda":
+        con_agenda = _bots(main, need_agenda=True) or bots
+        for i in range(args.conversations):
+            number, cfg = con_agenda[i % len(con_agenda)]
+            sender = _CLIENT_NUM.format(offset + i)
+            kw = ((cfg.get("agenda") or {}).get("keywords") or ["cita"])[0]
+            pasos = ["hola", f"quiero una {kw}", "sí", "ya agendé"]
+            convs.append([(*_wa(number, sender, t, n), args.think_ms) for n, t in enumerate(pasos)])
+    elif scenario == "voice":
+        for i in range(args.conversations):
+            number, _ = bots[i % len(bots)]
+            to = number.replace("whatsapp:", "")
+            call = {"CallSid": f"CAbench{offset + i:010d}", "From": f"+1555{offset + i:07d}", "To": to}
+            pasos = [("/voice", dict(call), 0), ("/voice-gather", dict(call), 0)]
+            for n in range(args.messages):
+                pasos.append(("/voice-gather", {**call, "SpeechResult": f"Tengo una pregunta número {n}"}, args.think_ms))
+            convs.append(pasos)
+    return convs
+
+
+def _seed_history(base: str, bot_name: str, sender: str, n: int):
+    """Escribe el lead en el falso antes de medir (los contadores se reinician después)."""
+    hist = []
+    for k in range(n):
+        hist.append({"tipo": "user" if k % 2 == 0 else "bot", "texto": f"mensaje previo {k} " + "x" * 80,
+                     "hora": "2025-01-01 10:00:00", "ts": 1735725600000 + k * 1000})
+    lead = {
+        "historial": hist, "messages": n, "bot": bot_name, "numero": sender, "status": "nuevo", "notes": "",
+        "last_message": hist[-1]["texto"] if hist else "", "last_seen": "2025-01-01 10:00:00",
+    }
+    path = urllib.parse.quote(f"leads/{bot_name}/{sender}")
+    req = urllib.request.Request(f"{base}/{path}.json", data=json.dumps(lead).encode("utf-8"), method="PUT")
+    urllib.request.urlopen(req).close()
+
+
+def run_scenario(main, base: str, scenario: str, args, offset: int) -> dict:
+    convs = _plan(main, base, scenario, args, offset)
+    _quiesce(base)
+    _fake_reset(base)
+    lat, errores = [], 0
+    n_msgs = sum(1 for c in convs for ruta, _, _ in c if ruta in ("/webhook", "/voice-gather"))
+
+    def _conv(pasos):
+        nonlocal errores
+        cli = main.app.test_client()
+        for ruta, form, pausa_ms in pasos:
+            if pausa_ms:
+                eventlet.sleep(pausa_ms / 1000.0)
+            t0 = time.perf_counter()
+            resp = cli.post(ruta, data=form)
+            resp.get_data()
+            lat.append((time.perf_counter() - t0) * 1000)
+            if resp.status_code != 200:
+                errores += 1
+
+    t0 = time.perf_counter()
+    pool = eventlet.GreenPool(args.concurrency)
+    for pasos in convs:
+        pool.spawn_n(_conv, pasos)
+    pool.waitall()
+    took = time.perf_counter() - t0
+    _quiesce(base)
+    st = _fake_stats(base)
+    return {
+        "scenario": scenario,
+        "conversations": len(convs),
+        "requests": len(lat),
+        "messages": n_msgs,
+        "errors": errores,
+        "took_s": round(took, 3),
+        "rps": round(len(lat) / took, 2) if took else 0.0,
+        "p50_ms": round(_percentile(lat, 50), 1),
+        "p95_ms": round(_percentile(lat, 95), 1),
+        "p99_ms": round(_percentile(lat, 99), 1),
+        "max_ms": round(max(lat) if lat else 0.0, 1),
+        "rtdb_per_msg": round(st["rtdb_total"] / n_msgs, 2) if n_msgs else 0.0,
+        "rtdb": st["rtdb"],
+        "openai_calls": st["counts"].get("openai.chat", 0),
+        "tts_calls": st["counts"].get("openai.tts", 0),
+    }
+
+
+def _print_table(rows):
+    cols = ("scenario", "requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms", "max_ms", "rtdb_per_msg", "openai_calls")
+    print("  ".join(f"{c:>12}" for c in cols))
+    for r in rows:
+        print("  ".join(f"{str(r[c]):>12}" for c in cols))
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description="Benchmark de /webhook y /voice-gather contra servicios falsos")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--conversations", type=int, default=30)
+    ap.add_argument("--messages", type=int, default=4, help="mensajes (o turnos de voz) por conversación")
+    ap.add_argument("--burst", type=int, default=100)
+    ap.add_argument("--history", type=int, default=200, help="entradas previas por lead en 'long'")
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--think-ms", type=float, default=0.0)
+    ap.add_argument("--rtdb-latency-ms", type=float, default=5.0)
+    ap.add_argument("--openai-base-ms", type=float, default=300.0)
+    ap.add_argument("--openai-ms-per-token", type=float, default=10.0)
+    ap.add_argument("--openai-completion-tokens", type=int, default=60)
+    ap.add_argument("--tts-ms", type=float, default=250.0)
+    ap.add_argument("--twilio-ms", type=float, default=120.0)
+    ap.add_argument("--jitter", type=float, default=0.1)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--fakes-url", default="", help="usar bench/fakes.py ya arrancado aparte en vez de en proceso")
+    ap.add_argument("--json", default="", help="guardar resultados en este archivo")
+    ap.add_argument("--max-p95-ms", type=float, default=0.0, help="umbral de regresión (0 = sin umbral)")
+    ap.add_argument("--max-rtdb-per-msg", type=float, default=0.0)
+    ap.add_argument("--min-rps", type=float, default=0.0)
+    args = ap.parse_args()
+
+    cfg = FakeConfig(args.rtdb_latency_ms, args.openai_base_ms, args.openai_ms_per_token,
+                     args.openai_completion_tokens, args.tts_ms, args.twilio_ms, args.jitter, args.seed)
+    if args.fakes_url:
+        base = args.fakes_url.rstrip("/")
+        print(f"[bench] Falsos externos en {base}")
+    else:
+        _, base = start_fakes(cfg)
+        print(f"[bench] Falsos en {base} (RTDB {cfg.rtdb_latency_ms} ms, OpenAI {cfg.openai_base_ms} ms + "
+              f"{cfg.openai_ms_per_token} ms/token x {cfg.openai_completion_tokens}, TTS {cfg.tts_ms} ms)")
+    main = boot_app(base)
+
+    rows = []
+    for i, sc in enumerate(s.strip() for s in args.scenarios.split(",") if s.strip()):
+        if sc not in SCENARIOS:
+            print(f"[bench] ⚠️ Escenario desconocido '{sc}' (opciones: {', '.join(SCENARIOS)})")
+            continue
+        print(f"[bench] ▶️ {sc} ...")
+        rows.append(run_scenario(main, base, sc, args, offset=(i + 1) * 100000))
+
+    print()
+    _print_table(rows)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": rows}, f, indent=2)
+        print(f"[bench] Resultados en {args.json}")
+
+    fallas = []
+    for r in rows:
+        if r["errors"]:
+            fallas.append(f"{r['scenario']}: {r['errors']} respuestas no-200")
+        if args.max_p95_ms and r["p95_ms"] > args.max_p95_ms:
+            fallas.append(f"{r['scenario']}: p95 {r['p95_ms']} ms > {args.max_p95_ms}")
+        if args.max_rtdb_per_msg and r["rtdb_per_msg"] > args.max_rtdb_per_msg:
+            fallas.append(f"{r['scenario']}: {r['rtdb_per_msg']} RTDB/msg > {args.max_rtdb_per_msg}")
+        if args.min_rps and r["rps"] < args.min_rps:
+            fallas.append(f"{r['scenario']}: {r['rps']} req/s < {args.min_rps}")
+    for f in fallas:
+        print(f"[bench] ❌ {f}")
+    sys.exit(1 if fallas else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,14 +1,20 @@
 # billing_api.py
 # Maestro de Facturación (panel factura clientes) + Gráficos en vivo
-# - Endpoints: clients, toggle, consumption (legacy), service-item, usage, invoice, usage_ts, track/openai
+# - Endpoints: clients, toggle, consumption (legacy), service-item, usage, invoice, usage_ts, track/openai,
+#   twilio/status (ledger), rollup/run (rollups mensuales + snapshots de factura)
 # - Página /billing/panel: tabla + modal de detalle + sección de gráficos en vivo
 
 from flask import Blueprint, request, jsonify
 from datetime import datetime, timedelta
-import os, json, glob
+from concurrent.futures import ThreadPoolExecutor
+import os, json, glob, time, threading
 
 from firebase_admin import db
 from twilio.rest import Client as TwilioClient
+from twilio.request_validator import RequestValidator
+
+from http_cache import bump, make_etag, conditional_json
+from compression import Precompressed
 
 billing_bp = Blueprint("billing_bp", __name__)
 
@@ -34,6 +40,92 @@ def _as_float(x, default=0.0):
     except Exception:
         return float(default)
 
+BILLING_MAX_PARALLEL = int(os.getenv("BILLING_MAX_PARALLEL", "8") or 8)
+
+def _parallel_map(fn, items, max_workers=None):
+    """Aplica fn a cada item con paralelismo acotado; conserva el orden de entrada."""
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(x) for x in items]
+    workers = max(1, min(int(max_workers or BILLING_MAX_PARALLEL), len(items)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(fn, items))
+
+# =======================
+# Caché con TTL + coalescencia de peticiones
+# =======================
+# Rangos que incluyen hoy cambian con cada mensaje: TTL corto. Rangos cerrados: TTL largo.
+CACHE_TTL_OPEN = int(os.getenv("BILLING_CACHE_TTL_OPEN", "20") or 20)
+CACHE_TTL_CLOSED = int(os.getenv("BILLING_CACHE_TTL_CLOSED", "21600") or 21600)
+_cache = {}        # key -> (expira_ts, valor)   (key[1] es siempre el bot, para invalidar por bot)
+_inflight = {}     # key -> {"event": Event, "value": ..., "error": Exception|None}
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+def _cached(key: tuple, ttl, compute, cacheable=None):
+    """
+    Devuelve el valor cacheado de key o lo calcula UNA sola vez aunque lleguen
+    peticiones idénticas concurrentes (las demás esperan el mismo resultado).
+    ttl puede ser una función del valor calculado (p. ej. TTL corto para resultados parciales).
+    """
+    now = time.time()
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit and hit[0] > now:
+            _cache_stats["hits"] += 1
+            return hit[1]
+        slot = _inflight.get(key)
+        owner = slot is None
+        if owner:
+            slot = {"event": threading.Event(), "value": None, "error": None}
+            _inflight[key] = slot
+            _cache_stats["misses"] += 1
+        else:
+            _cache_stats["coalesced"] += 1
+
+    if not owner:
+        slot["event"].wait()
+        if slot["error"] is not None:
+            raise slot["error"]
+        return slot["value"]
+
+    try:
+        value = compute()
+        slot["value"] = value
+        if cacheable is None or cacheable(value):
+            with _cache_lock:
+                _cache[key] = (time.time() + (ttl(value) if callable(ttl) else ttl), value)
+                for k in [k for k, v in _cache.items() if v[0] <= now]:
+                    _cache.pop(k, None)
+        return value
+    except Exception as e:
+        slot["error"] = e
+        raise
+    finally:
+        with _cache_lock:
+            _inflight.pop(key, None)
+        slot["event"].set()
+
+def _ttl_for_range(end: str) -> int:
+    return CACHE_TTL_OPEN if _range_is_open(end) else CACHE_TTL_CLOSED
+
+def _range_is_open(end: str) -> bool:
+    return _utcdate(end) >= datetime.utcnow().date()
+
+def invalidate_billing_cache(bot: str = ""):
+    """Invalida el caché de un bot (o todo si bot vacío): uso, series, tarifas y recorridos de Twilio."""
+    bump(f"usage:{bot}" if bot else "usage:*", "billing:clients")
+    with _cache_lock:
+        if not bot:
+            _cache.clear()
+            return
+        for k in [k for k in _cache if len(k) > 1 and k[1] == bot]:
+            _cache.pop(k, None)
+
+def billing_cache_stats() -> dict:
+    with _cache_lock:
+        return {"entries": len(_cache), "inflight": len(_inflight), **_cache_stats}
+
 # =======================
 # Bots loader
 # =======================
@@ -78,17 +170,37 @@ def _service_item_ref(bot_name: str):
 def _openai_day_ref(bot_name: str, ymd: str):
     return db.reference(f"billing/openai/{bot_name}/{ymd}/aggregate")
 
+def _openai_bot_ref(bot_name: str):
+    return db.reference(f"billing/openai/{bot_name}")
+
+def _twilio_msg_ref(sid: str):
+    return db.reference(f"billing/twilio_msgs/{sid}")
+
+def _twilio_ledger_ref(bot_name: str):
+    return db.reference(f"billing/twilio_ledger/{bot_name}")
+
+def _twilio_ledger_since_ref(bot_name: str):
+    return db.reference(f"billing/twilio_ledger_since/{bot_name}")
+
+def _rollup_ref(bot_name: str, period_ym: str):
+    return db.reference(f"billing/rollups/{bot_name}/{period_ym}")
+
+def _invoice_snapshot_ref(bot_name: str, period_ym: str):
+    return db.reference(f"billing/invoices/{bot_name}/{period_ym}")
+
 # =======================
 # ON/OFF
 # =======================
+def _status_from_val(val) -> str:
+    if isinstance(val, bool):
+        return "on" if val else "off"
+    if isinstance(val, str):
+        return "on" if val.lower() == "on" else "off"
+    return "off"
+
 def _get_status(bot_name: str) -> str:
     try:
-        val = _status_ref(bot_name).get()
-        if isinstance(val, bool):
-            return "on" if val else "off"
-        if isinstance(val, str):
-            return "on" if val.lower() == "on" else "off"
-        return "off"
+        return _status_from_val(_status_ref(bot_name).get())
     except Exception as e:
         print(f"[billing_api] ⚠️ Error leyendo status: {e}")
         return "off"
@@ -124,13 +236,34 @@ def record_openai_usage(bot: str, model: str, input_tokens: int, output_tokens:
     model_counts[m] = info
     cur["model_counts"] = model_counts
     ref.set(cur)
+    bump(f"usage:{bot}")
 
 def _get_openai_rates(bot: str):
-    bot_rates = _rates_ref(bot).get() or {}
-    return (
-        _as_float(bot_rates.get("openai_input_per_1k", os.getenv("OAI_INPUT_PER_1K", "0.00"))),
-        _as_float(bot_rates.get("openai_output_per_1k", os.getenv("OAI_OUTPUT_PER_1K", "0.00")))
-    )
+    def _load():
+        bot_rates = _rates_ref(bot).get() or {}
+        return (
+            _as_float(bot_rates.get("openai_input_per_1k", os.getenv("OAI_INPUT_PER_1K", "0.00"))),
+            _as_float(bot_rates.get("openai_output_per_1k", os.getenv("OAI_OUTPUT_PER_1K", "0.00")))
+        )
+    # Mismo caché (y misma invalidación por bot) que las respuestas de uso
+    return _cached(("rates", bot), CACHE_TTL_CLOSED, _load)
+
+def _openai_days(bot: str, d1: str, d2: str) -> dict:
+    """
+    Agregados diarios {ymd: aggregate} del rango en UNA consulta ordenada por clave
+    (las claves son YYYY-MM-DD, así que el orden lexicográfico es cronológico).
+    Si la consulta falla, cae a lecturas por día en paralelo acotado.
+    """
+    try:
+        nodes = _openai_bot_ref(bot).order_by_key().start_at(d1).end_at(d2).get() or {}
+        if isinstance(nodes, dict):
+            return {ymd: ((n or {}).get("aggregate") or {}) for ymd, n in nodes.items() if isinstance(n, dict)}
+    except Exception as e:
+        print(f"[billing_api] ⚠️ Consulta por rango falló, leyendo por día: {e}")
+
+    days = [d.strftime("%Y-%m-%d") for d in _daterange(_utcdate(d1), _utcdate(d2))]
+    nodes = _parallel_map(lambda ymd: _openai_day_ref(bot, ymd).get() or {}, days)
+    return dict(zip(days, nodes))
 
 def _sum_openai(bot: str, d1: str, d2: str):
     start, end = _utcdate(d1), _utcdate(d2)
@@ -138,10 +271,11 @@ def _sum_openai(bot: str, d1: str, d2: str):
     model_counts = {}
     per_day = []
     rate_in, rate_out = _get_openai_rates(bot)
+    days = _openai_days(bot, start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
 
     for d in _daterange(start, end):
         ymd = d.strftime("%Y-%m-%d")
-        node = _openai_day_ref(bot, ymd).get() or {}
+        node = days.get(ymd) or {}
         di  = int(node.get("total_input_tokens", 0))
         do  = int(node.get("total_output_tokens", 0))
         dr  = int(node.get("total_requests", 0))
@@ -186,81 +320,286 @@ def _twilio_client():
 def _get_bot_twilio_number(cfg: dict) -> str:
     return (cfg.get("twilio_number") or cfg.get("whatsapp_number") or "").strip()
 
-def _twilio_sum_prices(bot_cfg: dict, start: str, end: str, from_number_override: str = ""):
-    client = _twilio_client()
-    res = {"messages": 0, "price_usd": 0.0, "note": "Basado en Message.price; algunos mensajes pueden tardar en reflejar precio definitivo."}
-    if not client:
-        res["note"] = "Sin credenciales de Twilio en entorno."
-        return res
+TWILIO_CACHE_TTL_OPEN = int(os.getenv("TWILIO_CACHE_TTL_OPEN", "60") or 60)        # rangos que incluyen hoy
+TWILIO_CACHE_TTL_CLOSED = int(os.getenv("TWILIO_CACHE_TTL_CLOSED", "21600") or 21600) # rangos cerrados (6 h)
+_TWILIO_NOTE = "Basado en Message.price; algunos mensajes pueden tardar en reflejar precio definitivo."
+_TWILIO_ERROR_NOTE = "Error consultando Twilio (revisa SID/TOKEN y rango)."
 
+def _twilio_scan(bot_cfg: dict, start: str, end: str, from_number_override: str = ""):
+    """
+    Un solo recorrido paginado del rango: filtra por remitente en el API de Twilio (from_)
+    y agrupa por día en memoria. Resultado cacheado por (número, rango); los errores no se cachean.
+    """
     from_number = (from_number_override or "").strip()
     if not from_number:
-        from_number = _get_bot_twilio_number(bot_cfg)
-
-    d1 = datetime.strptime(start, "%Y-%m-%d")
-    d2 = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1)
+        from_number = _get_bot_twilio_number(bot_cfg or {})
+    ttl = TWILIO_CACHE_TTL_OPEN if _range_is_open(end) else TWILIO_CACHE_TTL_CLOSED
+    bot = (bot_cfg or {}).get("name", "")
+    return _cached(("twilio_scan", bot, from_number, start, end), ttl,
+                   lambda: _twilio_scan_uncached(from_number, start, end),
+                   cacheable=lambda r: r.get("note") == _TWILIO_NOTE)
+
+def _twilio_scan_uncached(from_number: str, start: str, end: str):
+    client = _twilio_client()
+    if not client:
+        return {"per_day": [], "messages": 0, "price_usd": 0.0, "note": "Sin credenciales de Twilio en entorno."}
 
-    total_msgs = 0
-    total_price = 0.0
+    s, e = _utcdate(start), _utcdate(end)
+    buckets = {d.strftime("%Y-%m-%d"): {"messages": 0, "price_usd": 0.0} for d in _daterange(s, e)}
+    note = _TWILIO_NOTE
     try:
-        msgs = client.messages.list(date_sent_after=d1, date_sent_before=d2)
-        for m in msgs:
-            if from_number and (str(m.from_) or "").strip() != from_number:
+        d1 = datetime(s.year, s.month, s.day)
+        d2 = datetime(e.year, e.month, e.day) + timedelta(days=1)
+        filtros = {"date_sent_after": d1, "date_sent_before": d2, "page_size": 1000}
+        if from_number:
+            filtros["from_"] = from_number
+        for m in client.messages.stream(**filtros):
+            sent = getattr(m, "date_sent", None) or getattr(m, "date_created", None)
+            ymd = sent.strftime("%Y-%m-%d") if sent else ""
+            b = buckets.get(ymd)
+            if b is None:
                 continue
-            total_msgs += 1
+            b["messages"] += 1
             if m.price and m.price_unit == "USD":
-                total_price += _as_float(m.price, 0.0)
-    except Exception as e:
-        print(f"[billing_api] ⚠️ Error Twilio list: {e}")
-        res["note"] = "Error consultando Twilio (revisa SID/TOKEN y rango)."
-
-    res["messages"] = total_msgs
-    res["price_usd"] = round(total_price, 4)
-    return res
+                b["price_usd"] += _as_float(m.price, 0.0)
+    except Exception as ex:
+        print(f"[billing_api] ⚠️ Error Twilio scan: {ex}")
+        note = _TWILIO_ERROR_NOTE
 
-def _twilio_series(bot_cfg: dict, start: str, end: str, from_number_override: str = ""):
-    """Serie diaria: mensajes y costo."""
-    client = _twilio_client()
-    per_day = []
-    total_msgs = 0
-    total_price = 0.0
-    note = "Basado en Message.price; algunos mensajes pueden tardar en reflejar precio definitivo."
+    per_day = [{"date": ymd, "messages": b["messages"], "price_usd": round(b["price_usd"], 6)} for ymd, b in buckets.items()]
+    return {
+        "per_day": per_day,
+        "messages": sum(b["messages"] for b in buckets.values()),
+        "price_usd": round(sum(b["price_usd"] for b in buckets.values()), 4),
+        "note": note,
+    }
 
-    if not client:
-        return {"per_day": [], "messages": 0, "price_usd": 0.0, "note": "Sin credenciales de Twilio en entorno."}
+# =======================
+# Ledger local de Twilio (alimentado por status callbacks)
+# =======================
+# billing/twilio_msgs/{sid}             -> {bot, direction, status, price_usd, date, ts}
+# billing/twilio_ledger/{bot}/{ymd}     -> {messages, inbound, outbound, price_usd}
+# billing/twilio_ledger_since/{bot}     -> primer día registrado (desde ahí el ledger es la fuente)
+BILLING_TWILIO_SOURCE = (os.getenv("BILLING_TWILIO_SOURCE", "auto") or "auto").strip().lower()  # auto | ledger | api
+TWILIO_PRICE_FETCH_DELAY_SEC = int(os.getenv("TWILIO_PRICE_FETCH_DELAY_SEC", "90") or 90)
+_TWILIO_FINAL_STATUSES = ("delivered", "read", "undelivered", "failed", "received", "sent")
+
+def _digits(num: str) -> str:
+    return "".join(ch for ch in str(num or "") if ch.isdigit())
+
+def _bot_name_by_number(*numbers) -> tuple:
+    """(bot_name, número que coincidió) buscando From/To entre las claves de bots/*.json."""
+    bots_config = load_bots_folder()
+    for num in numbers:
+        d = _digits(num)
+        if not d:
+            continue
+        for key, cfg in bots_config.items():
+            if not isinstance(cfg, dict):
+                continue
+            candidatos = (key, cfg.get("twilio_number") or "", cfg.get("whatsapp_number") or "")
+            if any(_digits(c) == d for c in candidatos if c):
+                return cfg.get("name") or "", num
+    return "", ""
+
+def _ledger_apply(bot: str, ymd: str, d_msgs: int, d_in: int, d_out: int, d_price: float):
+    """Suma deltas al nodo diario del ledger de forma atómica (transaction)."""
+    if not (d_msgs or d_in or d_out or d_price):
+        return
 
-    from_number = (from_number_override or "").strip()
-    if not from_number:
-        from_number = _get_bot_twilio_number(bot_cfg)
+    def _tx(cur):
+        cur = cur if isinstance(cur, dict) else {}
+        cur["messages"] = int(cur.get("messages", 0)) + d_msgs
+        cur["inbound"] = int(cur.get("inbound", 0)) + d_in
+        cur["outbound"] = int(cur.get("outbound", 0)) + d_out
+        cur["price_usd"] = round(_as_float(cur.get("price_usd", 0.0)) + d_price, 6)
+        return cur
+
+    _twilio_ledger_ref(bot).child(ymd).transaction(_tx)
+
+    # El primer día registrado suele estar incompleto: el ledger es fuente desde el día siguiente
+    def _tx_since(cur):
+        return cur if cur else (_utcdate(ymd) + timedelta(days=1)).strftime("%Y-%m-%d")
+
+    _twilio_ledger_since_ref(bot).transaction(_tx_since)
+
+def record_twilio_message(sid: str, from_number: str, to_number: str, status: str,
+                          price=None, price_unit: str = "USD", direction: str = "", sent_at: datetime = None):
+    """
+    Registra/actualiza un mensaje en el ledger. Idempotente por sid: un mensaje cuenta una
+    sola vez y el precio entra como delta cuando Twilio lo informa (o cambia).
+    """
+    sid = (sid or "").strip()
+    if not sid:
+        return None
+    status = (status or "").strip().lower()
+
+    when = sent_at or datetime.utcnow()
+    new_price = _as_float(price, 0.0) if (price not in (None, "") and (price_unit or "USD").upper() == "USD") else None
+    por_numero = []  # (bot, matched) de bots/*.json: solo se busca si el sid aún no tiene bot
+    out = {}
+
+    def _tx(prev):
+        # Puede ejecutarse varias veces (reintentos por ETag): out refleja la última, que es la que se escribe
+        out.clear()
+        prev = prev if isinstance(prev, dict) else {}
+        bot = prev.get("bot") or ""
+        dirn = direction or prev.get("direction") or ""
+        if not bot:
+            # Outbound: el bot es el remitente; inbound: el destinatario
+            if not por_numero:
+                por_numero.append(_bot_name_by_number(from_number, to_number))
+            bot, matched = por_numero[0]
+            if not dirn and matched:
+                dirn = "outbound" if _digits(matched) == _digits(from_number) else "inbound"
+        if not bot:
+            return prev or None
+        dirn = dirn or "outbound"
+        old_price = _as_float(prev.get("price_usd"), 0.0) if prev.get("price_usd") is not None else None
+        rec = {
+            "bot": bot,
+            "direction": dirn,
+            "status": status or prev.get("status", ""),
+            "date": prev.get("date") or when.strftime("%Y-%m-%d"),
+            "ts": prev.get("ts") or int(when.timestamp()),
+            "price_usd": new_price if new_price is not None else old_price,
+        }
+        out.update(
+            rec=rec,
+            is_new=not prev,
+            d_price=(new_price - (old_price or 0.0)) if new_price is not None else 0.0,
+        )
+        return rec
+
+    # Dedupe + delta de precio en una sola transacción: callbacks concurrentes del mismo sid
+    # (sent/delivered/read llegan casi a la vez) no pueden contar el mensaje ni el precio dos veces
+    _twilio_msg_ref(sid).transaction(_tx)
+    if not out:
+        return None
+    rec, is_new = out["rec"], out["is_new"]
+    bot, ymd, direction = rec["bot"], rec["date"], rec["direction"]
+
+    bump(f"usage:{bot}")
+    _ledger_apply(
+        bot, ymd,
+        d_msgs=1 if is_new else 0,
+        d_in=1 if (is_new and direction == "inbound") else 0,
+        d_out=1 if (is_new and direction == "outbound") else 0,
+        d_price=out["d_price"],
+    )
 
-    s, e = _utcdate(start), _utcdate(end)
+    if new_price is None and rec["price_usd"] is None and status in _TWILIO_FINAL_STATUSES:
+        _schedule_price_fetch(sid)
+    return rec
+
+# Precios pendientes: sid -> [ts a partir del cual consultar, intentos]. Los consulta en lote el job de
+# rollups (run_price_fetches) en vez de un hilo dormido por mensaje.
+TWILIO_PRICE_BATCH = int(os.getenv("TWILIO_PRICE_BATCH", "50") or 50)
+TWILIO_PRICE_MAX_ATTEMPTS = int(os.getenv("TWILIO_PRICE_MAX_ATTEMPTS", "3") or 3)
+TWILIO_PRICE_PENDING_MAX = int(os.getenv("TWILIO_PRICE_PENDING_MAX", "5000") or 5000)
+_price_pending = {}
+_price_lock = threading.Lock()
+_price_stats = {"queued": 0, "fetched": 0, "priced": 0, "dropped": 0, "errors": 0}
+
+def _schedule_price_fetch(sid: str, attempts: int = 0):
+    """Twilio suele publicar Message.price unos segundos después del estado final: se encola el sid."""
+    with _price_lock:
+        if sid in _price_pending:
+            return
+        if len(_price_pending) >= TWILIO_PRICE_PENDING_MAX:
+            _price_stats["dropped"] += 1
+            return
+        _price_pending[sid] = [time.time() + TWILIO_PRICE_FETCH_DELAY_SEC, attempts]
+        _price_stats["queued"] += 1
+
+def _fetch_price(client, sid: str) -> bool:
+    """True si Twilio ya informó el precio (y quedó registrado en el ledger)."""
     try:
-        for day in _daterange(s, e):
-            d1 = datetime(day.year, day.month, day.day)
-            d2 = d1 + timedelta(days=1)
-            msgs = client.messages.list(date_sent_after=d1, date_sent_before=d2)
-            cnt = 0
-            cost = 0.0
-            for m in msgs:
-                if from_number and (str(m.from_) or "").strip() != from_number:
-                    continue
-                cnt += 1
-                if m.price and m.price_unit == "USD":
-                    cost += _as_float(m.price, 0.0)
-            per_day.append({"date": day.strftime("%Y-%m-%d"), "messages": cnt, "price_usd": round(cost, 6)})
-            total_msgs += cnt
-            total_price += cost
+        m = client.messages(sid).fetch()
+        if m.price in (None, ""):
+            return False
+        record_twilio_message(sid, str(m.from_ or ""), str(m.to or ""), str(m.status or ""),
+                              price=m.price, price_unit=m.price_unit or "USD")
+        return True
     except Exception as e:
-        print(f"[billing_api] ⚠️ Error Twilio series: {e}")
-        note = "Error consultando Twilio (revisa SID/TOKEN y rango)."
+        with _price_lock:
+            _price_stats["errors"] += 1
+        print(f"[billing_api] ⚠️ No se pudo obtener el precio de {sid}: {e}")
+        return False
+
+def run_price_fetches(now: float = None) -> int:
+    """Consulta hasta TWILIO_PRICE_BATCH precios vencidos (paralelismo acotado); reencola los que aún no tienen precio."""
+    now = now or time.time()
+    with _price_lock:
+        vencidos = [(sid, v[1]) for sid, v in _price_pending.items() if v[0] <= now][:TWILIO_PRICE_BATCH]
+        for sid, _ in vencidos:
+            _price_pending.pop(sid, None)
+    if not vencidos:
+        return 0
+    client = _twilio_client()
+    if not client:
+        return 0
+    resultados = _parallel_map(lambda sid: _fetch_price(client, sid), [sid for sid, _ in vencidos])
+    for (sid, intentos), ok in zip(vencidos, resultados):
+        if not ok and intentos + 1 < TWILIO_PRICE_MAX_ATTEMPTS:
+            _schedule_price_fetch(sid, intentos + 1)
+    with _price_lock:
+        _price_stats["fetched"] += len(vencidos)
+        _price_stats["priced"] += sum(1 for ok in resultados if ok)
+    return len(vencidos)
+
+def price_fetch_stats() -> dict:
+    with _price_lock:
+        return {**_price_stats, "pending": len(_price_pending)}
+
+def _twilio_from_ledger(bot: str, start: str, end: str):
+    """Totales y serie diaria desde el ledger (una consulta por rango de claves)."""
+    nodes = _twilio_ledger_ref(bot).order_by_key().start_at(start).end_at(end).get() or {}
+    per_day = []
+    for d in _daterange(_utcdate(start), _utcdate(end)):
+        ymd = d.strftime("%Y-%m-%d")
+        n = nodes.get(ymd) or {}
+        per_day.append({"date": ymd, "messages": int(n.get("messages", 0)), "price_usd": round(_as_float(n.get("price_usd", 0.0)), 6)})
+    return {
+        "per_day": per_day,
+        "messages": sum(x["messages"] for x in per_day),
+        "price_usd": round(sum(x["price_usd"] for x in per_day), 4),
+        "note": "Ledger local (status callbacks de Twilio).",
+        "source": "ledger",
+    }
 
-    return {"per_day": per_day, "messages": total_msgs, "price_usd": round(total_price, 4), "note": note}
+def _ledger_covers(bot: str, start: str) -> bool:
+    try:
+        since = _twilio_ledger_since_ref(bot).get()
+    except Exception:
+        return False
+    return bool(since) and str(since) <= start
+
+def _twilio_usage(bot: str, bot_cfg: dict, start: str, end: str, from_number_override: str = ""):
+    """Elige la fuente: ledger precomputado si cubre el rango; si no, recorrido del API de Twilio."""
+    use_ledger = False
+    if not (from_number_override or "").strip():
+        if BILLING_TWILIO_SOURCE == "ledger":
+            use_ledger = True
+        elif BILLING_TWILIO_SOURCE == "auto":
+            use_ledger = _ledger_covers(bot, start)
+    if use_ledger:
+        try:
+            return _twilio_from_ledger(bot, start, end)
+        except Exception as e:
+            print(f"[billing_api] ⚠️ Error leyendo ledger de Twilio: {e}")
+    res = dict(_twilio_scan(bot_cfg, start, end, from_number_override))
+    res["source"] = "api"
+    return res
 
 # =======================
 # Ítem fijo de servicio
 # =======================
 def _get_service_item(bot: str):
-    n = _service_item_ref(bot).get() or {}
+    return _service_item_from_node(_service_item_ref(bot).get())
+
+def _service_item_from_node(n):
+    n = n if isinstance(n, dict) else {}
     return {
         "enabled": bool(n.get("enabled", True)),
         "amount":  _as_float(n.get("amount", os.getenv("SERVICE_ITEM_AMOUNT", "200.0"))),
@@ -272,6 +611,212 @@ def _set_service_item(bot: str, enabled: bool, amount: float, label: str):
     _service_item_ref(bot).set(payload)
     return payload
 
+# =======================
+# Rollups mensuales + snapshots de factura
+# =======================
+# billing/rollups/{bot}/{YYYY-MM}   -> agregados de días CERRADOS del mes (crece de forma incremental)
+# billing/invoices/{bot}/{YYYY-MM}  -> factura congelada al cerrar el período (no se recalcula)
+BILLING_JOB_TOKEN = (os.getenv("BILLING_JOB_TOKEN") or "").strip()
+ROLLUP_INTERVAL_SEC = int(os.getenv("ROLLUP_INTERVAL_SEC", "3600") or 3600)
+
+def _resolve_bot(bot: str):
+    """(bot_name, bot_cfg) a partir del nombre recibido en la URL."""
+    for cfg in load_bots_folder().values():
+        if isinstance(cfg, dict) and cfg.get("name", "").lower() == (bot or "").lower():
+            return cfg.get("name"), cfg
+    return bot, {}
+
+def _month_bounds(period_ym: str):
+    first = datetime.strptime(period_ym + "-01", "%Y-%m-%d").date()
+    nxt = (first.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return first, nxt - timedelta(days=1)
+
+def _period_of_range(start: str, end: str):
+    """YYYY-MM si [start, end] es un mes completo (o el mes en curso hasta hoy); si no, None."""
+    try:
+        s, e = _utcdate(start), _utcdate(end)
+    except Exception:
+        return None
+    ym = s.strftime("%Y-%m")
+    first, last = _month_bounds(ym)
+    today = datetime.utcnow().date()
+    if s != first or e.strftime("%Y-%m") != ym:
+        return None
+    if e == last or (first <= today <= last and e >= today):
+        return ym
+    return None
+
+def _merge_openai(parts, rate_in: float, rate_out: float) -> dict:
+    out = {"requests": 0, "input_tokens": 0, "output_tokens": 0, "model_breakdown": {}, "per_day": []}
+    for p in parts:
+        if not p:
+            continue
+        out["requests"] += int(p.get("requests", 0))
+        out["input_tokens"] += int(p.get("input_tokens", 0))
+        out["output_tokens"] += int(p.get("output_tokens", 0))
+        for m, info in (p.get("model_breakdown") or {}).items():
+            acc = out["model_breakdown"].get(m, {"requests": 0, "input_tokens": 0, "output_tokens": 0})
+            for k in acc:
+                acc[k] += int((info or {}).get(k, 0))
+            out["model_breakdown"][m] = acc
+        out["per_day"].extend(p.get("per_day") or [])
+    out["per_day"].sort(key=lambda x: x.get("date", ""))
+    out["rate_input_per_1k"] = rate_in
+    out["rate_output_per_1k"] = rate_out
+    out["cost_estimate_usd"] = round((out["input_tokens"] / 1000.0) * rate_in + (out["output_tokens"] / 1000.0) * rate_out, 4)
+    return out
+
+def _merge_twilio(parts) -> dict:
+    out = {"messages": 0, "price_usd": 0.0, "per_day": [], "note": _TWILIO_NOTE, "source": "api"}
+    for p in parts:
+        if not p:
+            continue
+        out["messages"] += int(p.get("messages", 0))
+        out["price_usd"] += _as_float(p.get("price_usd", 0.0))
+        out["per_day"].extend(p.get("per_day") or [])
+        out["note"] = p.get("note", out["note"])
+        out["source"] = p.get("source", out["source"])
+    out["per_day"].sort(key=lambda x: x.get("date", ""))
+    out["price_usd"] = round(out["price_usd"], 4)
+    return out
+
+def _usage_payload(bot_name: str, start: str, end: str, oa: dict, tw_all: dict) -> dict:
+    tw = {k: v for k, v in tw_all.items() if k != "per_day"}
+    svc = _get_service_item(bot_name)
+    subtotal = oa.get("cost_estimate_usd", 0.0) + tw.get("price_usd", 0.0)
+    total = subtotal + (svc["amount"] if svc["enabled"] else 0.0)
+    return {
+        "bot": bot_name,
+        "range": {"start": start, "end": end},
+        "twilio": tw,
+        "openai": oa,
+        "service_item": svc,
+        "subtotal_usd": round(subtotal, 4),
+        "total_usd": round(total, 4)
+    }
+
+def _rollup_update(bot_name: str, bot_cfg: dict, period_ym: str) -> dict:
+    """Suma al rollup del mes los días cerrados que aún no incluye (ayer como máximo)."""
+    first, last = _month_bounds(period_ym)
+    closed_until = min(last, datetime.utcnow().date() - timedelta(days=1))
+    ref = _rollup_ref(bot_name, period_ym)
+    roll = ref.get() or {}
+    through = _utcdate(roll["through"]) if roll.get("through") else first - timedelta(days=1)
+    if through >= closed_until:
+        return roll
+
+    a = (through + timedelta(days=1)).strftime("%Y-%m-%d")
+    b = closed_until.strftime("%Y-%m-%d")
+    rate_in, rate_out = _get_openai_rates(bot_name)
+    try:
+        oa_new = _sum_openai(bot_name, a, b)
+    except Exception as e:
+        print(f"[billing_api] ⚠️ Rollup {bot_name} {period_ym}: OpenAI {a}..{b} falló, se reintenta en la próxima pasada: {e}")
+        return roll
+    tw_new = _twilio_usage(bot_name, bot_cfg, a, b)
+    if not _twilio_result_ok(tw_new):
+        # Sin credenciales o error del API: no avanzar 'through' o esos días quedarían en cero para siempre
+        print(f"[billing_api] ⚠️ Rollup {bot_name} {period_ym}: Twilio {a}..{b} sin datos fiables ({tw_new.get('note', '')}), se reintenta")
+        return roll
+    roll = {
+        "through": b,
+        "openai": _merge_openai([roll.get("openai"), oa_new], rate_in, rate_out),
+        "twilio": _merge_twilio([roll.get("twilio"), tw_new]),
+        "updated": datetime.utcnow().isoformat() + "Z",
+    }
+    ref.set(roll)
+    return roll
+
+def _twilio_result_ok(res: dict) -> bool:
+    """Ledger o recorrido completo del API; las notas de error/sin credenciales no cuentan como datos."""
+    return (res or {}).get("source") == "ledger" or (res or {}).get("note") == _TWILIO_NOTE
+
+def _period_usage(bot_name: str, bot_cfg: dict, period_ym: str) -> dict:
+    """
+    Uso de un período completo: snapshot congelado si el mes ya cerró (O(1));
+    si está abierto, rollup de días cerrados + solo HOY en vivo.
+    """
+    first, last = _month_bounds(period_ym)
+    today = datetime.utcnow().date()
+    start, end = first.strftime("%Y-%m-%d"), last.strftime("%Y-%m-%d")
+
+    if last < today:
+        snap = _invoice_snapshot_ref(bot_name, period_ym).get()
+        if isinstance(snap, dict) and snap:
+            return snap
+        roll = _rollup_update(bot_name, bot_cfg, period_ym)
+        rate_in, rate_out = _get_openai_rates(bot_name)
+        payload = _usage_payload(bot_name, start, end,
+                                 _merge_openai([roll.get("openai")], rate_in, rate_out),
+                                 _merge_twilio([roll.get("twilio")]))
+        if roll.get("through") != end:
+            # Rollup incompleto (una fuente falló): se sirve sin congelar, marcado y con TTL corto
+            payload["rollup"] = {"period": period_ym, "through": roll.get("through", "")}
+            payload["partial"] = True
+            return payload
+        payload["snapshot"] = {"period": period_ym, "frozen_at": datetime.utcnow().isoformat() + "Z"}
+        _invoice_snapshot_ref(bot_name, period_ym).set(payload)
+        return payload
+
+    roll = _rollup_update(bot_name, bot_cfg, period_ym)
+    ymd = today.strftime("%Y-%m-%d")
+    rate_in, rate_out = _get_openai_rates(bot_name)
+    oa = _merge_openai([roll.get("openai"), _sum_openai(bot_name, ymd, ymd)], rate_in, rate_out)
+    tw = _merge_twilio([roll.get("twilio"), _twilio_usage(bot_name, bot_cfg, ymd, ymd)])
+    payload = _usage_payload(bot_name, start, ymd, oa, tw)
+    payload["rollup"] = {"period": period_ym, "through": roll.get("through", "")}
+    return payload
+
+def run_rollups(now=None) -> dict:
+    """Job: avanza el rollup del mes en curso y congela la factura del mes anterior para cada bot."""
+    now = now or datetime.utcnow()
+    cur = _period_ym(now)
+    prev = _period_ym(now.replace(day=1) - timedelta(days=1))
+    done = {}
+    for cfg in load_bots_folder().values():
+        if not isinstance(cfg, dict) or not cfg.get("name"):
+            continue
+        name = cfg["name"]
+        try:
+            _period_usage(name, cfg, prev)
+            _rollup_update(name, cfg, cur)
+            done[name] = "ok"
+        except Exception as e:
+            print(f"[billing_api] ⚠️ Error en rollup de {name}: {e}")
+            done[name] = "error"
+    return done
+
+TWILIO_PRICE_POLL_SEC = int(os.getenv("TWILIO_PRICE_POLL_SEC", "30") or 30)
+
+def _rollup_loop():
+    # Tick corto para los precios pendientes de Twilio; los rollups siguen corriendo cada ROLLUP_INTERVAL_SEC
+    tick = max(1, min(TWILIO_PRICE_POLL_SEC, ROLLUP_INTERVAL_SEC))
+    proximo_rollup = time.time() + ROLLUP_INTERVAL_SEC
+    while True:
+        time.sleep(tick)
+        try:
+            while run_price_fetches() >= TWILIO_PRICE_BATCH:
+                pass
+        except Exception as e:
+            print(f"[billing_api] ⚠️ Error consultando precios de Twilio: {e}")
+        if time.time() < proximo_rollup:
+            continue
+        proximo_rollup = time.time() + ROLLUP_INTERVAL_SEC
+        try:
+            run_rollups()
+        except Exception as e:
+            print(f"[billing_api] ⚠️ Error en job de rollups: {e}")
+
+_rollup_started = False
+
+def start_rollup_worker():
+    """Arranca el job periódico de rollups (idempotente: se puede ejecutar en varios workers)."""
+    global _rollup_started
+    if _rollup_started:
+        return
+    _rollup_started = True
+    threading.Thread(target=_rollup_loop, daemon=True).start()
+
 # =======================
 # Endpoints públicos JSON
 # =======================
@@ -279,42 +824,65 @@ def _set_service_item(bot: str, enabled: bool, amount: float, label: str):
 def health():
     return jsonify({"ok": True, "service": "billing_api", "time": datetime.utcnow().isoformat() + "Z"})
 
+def _consumption_cents(val) -> int:
+    return int((val or {}).get("cents", 0) if isinstance(val, dict) else (val or 0))
+
+def _bulk_get(path: str) -> dict:
+    try:
+        val = db.reference(path).get()
+        return val if isinstance(val, dict) else {}
+    except Exception as e:
+        print(f"[billing_api] ⚠️ Error leyendo {path}: {e}")
+        return {}
+
 @billing_bp.route("/clients", methods=["GET"])
 def list_clients():
-    bots_config = load_bots_folder()
     period = request.args.get("period") or _period_ym()
+    etag = make_etag("billing_clients", keys=["billing:clients"], parts=[period])
+    return conditional_json("billing_clients", etag, lambda: _clients_payload(period))
 
-    items = []
+def _clients_payload(period: str) -> dict:
+    bots_config = load_bots_folder()
+
+    bots = []
     for cfg in bots_config.values():
-        if not isinstance(cfg, dict):
-            continue
-        bot_name = cfg.get("name") or ""
-        if not bot_name:
-            continue
+        if isinstance(cfg, dict) and cfg.get("name"):
+            bots.append(cfg)
+    names = [cfg["name"] for cfg in bots]
 
+    # status y service_item: un solo GET por nodo; consumo del período: un GET por bot en paralelo
+    # (billing/consumption completo traería todos los períodos históricos)
+    def _consumption(name):
+        try:
+            return _consumption_ref(name, period).get()
+        except Exception as e:
+            print(f"[billing_api] ⚠️ Error leyendo consumo de {name}: {e}")
+            return None
+
+    tareas = [lambda: _bulk_get("billing/status"), lambda: _bulk_get("billing/service_item")]
+    tareas += [(lambda n=n: _consumption(n)) for n in names]
+    resultados = _parallel_map(lambda f: f(), tareas)
+    statuses, service_items, consumos = resultados[0], resultados[1], dict(zip(names, resultados[2:]))
+
+    items = []
+    for cfg in bots:
+        bot_name = cfg["name"]
         business_name = cfg.get("business_name", bot_name)
         email = cfg.get("email") or (cfg.get("contact", {}) or {}).get("email") or ""
         phone = cfg.get("phone") or (cfg.get("contact", {}) or {}).get("phone") or ""
 
-        val = _consumption_ref(bot_name, period).get()
-        consumo_cents = int((val or {}).get("cents", 0) if isinstance(val, dict) else (val or 0))
-
-        status = _get_status(bot_name)
-        # ⬇️ Añadido: incluir service_item en /clients
-        svc = _get_service_item(bot_name)
-
         items.append({
             "id": bot_name,
             "name": business_name,
             "email": email,
             "phone": phone,
-            "consumo_cents": consumo_cents,
+            "consumo_cents": _consumption_cents(consumos.get(bot_name)),
             "consumo_period": period,
-            "bot_status": status,
-            "service_item": svc,  # ⬅️ nuevo campo
+            "bot_status": _status_from_val(statuses.get(bot_name)),
+            "service_item": _service_item_from_node(service_items.get(bot_name)),
         })
 
-    return jsonify({"success": True, "data": items})
+    return {"success": True, "data": items}
 
 @billing_bp.route("/toggle", methods=["POST"])
 def toggle_bot():
@@ -331,6 +899,7 @@ def toggle_bot():
     if not ok:
         return jsonify({"success": False, "message": "No se pudo guardar en Firebase"}), 500
 
+    bump("billing:clients")
     return jsonify({"success": True})
 
 @billing_bp.route("/consumption/<bot_name>", methods=["GET"])
@@ -339,8 +908,7 @@ def get_consumption(bot_name):
     bots_config = load_bots_folder()
     bot_norm = _normalize_bot_name(bots_config, bot_name) or bot_name
 
-    val = _consumption_ref(bot_norm, period).get()
-    cents = int((val or {}).get("cents", 0) if isinstance(val, dict) else (val or 0))
+    cents = _consumption_cents(_consumption_ref(bot_norm, period).get())
     return jsonify({"success": True, "bot": bot_norm, "period": period, "consumo_cents": cents})
 
 @billing_bp.route("/service-item/<bot>", methods=["GET", "POST"])
@@ -356,6 +924,7 @@ def service_item(bot):
     amount  = _as_float(data.get("amount", 0.0))
     label   = str(data.get("label", "") or "")
     saved = _set_service_item(bot_norm, enabled, amount, label)
+    invalidate_billing_cache(bot_norm)
     return jsonify({"success": True, "service_item": saved})
 
 @billing_bp.route("/usage/<bot>", methods=["GET"])
@@ -367,35 +936,27 @@ def usage(bot):
     if not start or not end:
         return jsonify({"success": False, "message": "start y end son requeridos (YYYY-MM-DD)"}), 400
 
-    bots_config = load_bots_folder()
-    bot_cfg = None
-    bot_name = None
-    for cfg in bots_config.values():
-        if cfg.get("name", "").lower() == bot.lower():
-            bot_cfg = cfg
-            bot_name = cfg.get("name")
-            break
-    if not bot_name:
-        bot_name = bot
-        bot_cfg = {}
-
-    oa = _sum_openai(bot_name, start, end)
-    tw = _twilio_sum_prices(bot_cfg, start, end, from_number_override=from_number)
-    svc = _get_service_item(bot_name)
-
-    subtotal = oa.get("cost_estimate_usd", 0.0) + tw.get("price_usd", 0.0)
-    total = subtotal + (svc["amount"] if svc["enabled"] else 0.0)
-
-    payload = {
-        "bot": bot_name,
-        "range": {"start": start, "end": end},
-        "twilio": tw,
-        "openai": oa,
-        "service_item": svc,
-        "subtotal_usd": round(subtotal, 4),
-        "total_usd": round(total, 4)
-    }
-    return jsonify(payload)
+    bot_name, bot_cfg = _resolve_bot(bot)
+
+    def _compute():
+        # Mes completo (o mes en curso hasta hoy): snapshot / rollup en lugar de recalcular todo
+        period = _period_of_range(start, end) if not from_number else None
+        if period:
+            try:
+                return _period_usage(bot_name, bot_cfg, period)
+            except Exception as e:
+                print(f"[billing_api] ⚠️ Rollup no disponible, calculando en vivo: {e}")
+        oa = _sum_openai(bot_name, start, end)
+        tw_all = _twilio_usage(bot_name, bot_cfg, start, end, from_number_override=from_number)
+        payload = _usage_payload(bot_name, start, end, oa, tw_all)
+        if not _twilio_result_ok(tw_all):
+            payload["partial"] = True
+        return payload
+
+    # Resultados parciales (una fuente falló): TTL de rango abierto aunque el mes esté cerrado
+    ttl = _ttl_for_range(end)
+    return jsonify(_cached(("usage", bot_name, start, end, from_number),
+                           lambda v: CACHE_TTL_OPEN if v.get("partial") else ttl, _compute))
 
 @billing_bp.route("/usage_ts/<bot>", methods=["GET"])
 def usage_ts(bot):
@@ -406,22 +967,20 @@ def usage_ts(bot):
     if not start or not end:
         return jsonify({"success": False, "message": "start y end son requeridos (YYYY-MM-DD)"}), 400
 
-    bots_config = load_bots_folder()
-    bot_cfg = None
-    bot_name = None
-    for cfg in bots_config.values():
-        if cfg.get("name", "").lower() == bot.lower():
-            bot_cfg = cfg
-            bot_name = cfg.get("name")
-            break
-    if not bot_name:
-        bot_name = bot
-        bot_cfg = {}
+    bot_name, bot_cfg = _resolve_bot(bot)
+    # Rango abierto: el ETag caduca con el TTL corto del caché (escrituras de otros procesos)
+    window = CACHE_TTL_OPEN if _range_is_open(end) else None
+    etag = make_etag("billing_usage_ts", keys=["usage:*", f"usage:{bot_name}"],
+                     parts=[bot_name, start, end, from_number], window_sec=window)
+    return conditional_json("billing_usage_ts", etag,
+                            lambda: _cached(("usage_ts", bot_name, start, end, from_number), _ttl_for_range(end),
+                                            lambda: _usage_ts_payload(bot_name, bot_cfg, start, end, from_number)))
 
+def _usage_ts_payload(bot_name: str, bot_cfg: dict, start: str, end: str, from_number: str) -> dict:
     oa_all = _sum_openai(bot_name, start, end)
-    tw_all = _twilio_series(bot_cfg, start, end, from_number_override=from_number)
+    tw_all = _twilio_usage(bot_name, bot_cfg, start, end, from_number_override=from_number)
 
-    return jsonify({
+    return {
         "success": True,
         "bot": bot_name,
         "range": {"start": start, "end": end},
@@ -437,15 +996,32 @@ def usage_ts(bot):
             "per_day": oa_all["per_day"]
         },
         "twilio": {
-            "totals": {"messages": tw_all["messages"], "price_usd": tw_all["price_usd"], "note": tw_all["note"]},
+            "totals": {"messages": tw_all["messages"], "price_usd": tw_all["price_usd"], "note": tw_all["note"], "source": tw_all.get("source", "api")},
             "per_day": tw_all["per_day"]
         }
-    })
+    }
 
 @billing_bp.route("/invoice/<bot>", methods=["GET"])
 def invoice(bot):
     return usage(bot)
 
+@billing_bp.route("/cache/invalidate", methods=["POST"])
+def cache_invalidate():
+    """Invalida el caché de uso/tarifas (p. ej. tras cambiar billing/rates en la consola)."""
+    data = request.get_json(silent=True) or {}
+    bot = (data.get("bot") or "").strip()
+    if bot:
+        bot = _normalize_bot_name(load_bots_folder(), bot) or bot
+    invalidate_billing_cache(bot)
+    return jsonify({"success": True, "bot": bot or "*", "cache": billing_cache_stats()})
+
+@billing_bp.route("/rollup/run", methods=["POST"])
+def rollup_run():
+    """Dispara el job de rollups (cron externo). Si BILLING_JOB_TOKEN está definido, exige Bearer."""
+    if BILLING_JOB_TOKEN and (request.headers.get("Authorization") or "").strip() != f"Bearer {BILLING_JOB_TOKEN}":
+        return jsonify({"success": False, "message": "Unauthorized"}), 401
+    return jsonify({"success": True, "bots": run_rollups()})
+
 @billing_bp.route("/track/openai", methods=["POST"])
 def track_openai():
     data = request.get_json(silent=True) or {}
@@ -458,13 +1034,69 @@ def track_openai():
     record_openai_usage(bot, model, itok, otok)
     return jsonify({"success": True})
 
+_status_hooks = []   # fn(sid, status, query) adicionales (p. ej. estado de entrega en el chat)
+
+def add_twilio_status_hook(fn):
+    _status_hooks.append(fn)
+
+TWILIO_VALIDATE_SIGNATURE = (os.getenv("TWILIO_VALIDATE_SIGNATURE", "1") or "1").strip().lower() in ("1", "true", "on", "yes")
+
+def _twilio_signature_ok(req) -> bool:
+    """
+    Valida X-Twilio-Signature con TWILIO_AUTH_TOKEN. Twilio firma la URL pública (https), que detrás
+    del proxy Flask ve como http: misma normalización que _twilio_status_callback_url() en main.py.
+    """
+    token = (os.getenv("TWILIO_AUTH_TOKEN") or "").strip()
+    firma = req.headers.get("X-Twilio-Signature", "")
+    if not token or not firma:
+        return False
+    # Query cruda: req.url la re-normaliza (%3A -> ':') y la firma se calcula sobre la URL tal cual
+    qs = req.query_string.decode("utf-8")
+    url = req.base_url.replace("http://", "https://", 1) + (f"?{qs}" if qs else "")
+    configurada = (os.getenv("TWILIO_STATUS_CALLBACK_URL") or "").strip()
+    validator = RequestValidator(token)
+    params = req.form.to_dict()
+    if validator.validate(url, params, firma):
+        return True
+    if not configurada:
+        return False
+    # Host configurado distinto del que ve Flask: misma query (main.py añade bot/numero/mid)
+    if qs:
+        configurada += ("&" if "?" in configurada else "?") + qs
+    return configurada != url and validator.validate(configurada, params, firma)
+
+@billing_bp.route("/twilio/status", methods=["POST"])
+def twilio_status_callback():
+    """Status callback de mensajes (inbound y outbound). Configurar en el número / Messaging Service."""
+    if TWILIO_VALIDATE_SIGNATURE and not _twilio_signature_ok(request):
+        print("[billing_api] ⚠️ Status callback rechazado: firma de Twilio inválida o ausente")
+        return ("Firma inválida", 403)
+    v = request.values
+    sid = v.get("MessageSid") or v.get("SmsSid") or ""
+    status = v.get("MessageStatus") or v.get("SmsStatus") or ""
+    try:
+        record_twilio_message(
+            sid,
+            v.get("From", ""),
+            v.get("To", ""),
+            status,
+            price=v.get("Price"),
+            price_unit=v.get("PriceUnit") or "USD",
+        )
+    except Exception as e:
+        print(f"[billing_api] ⚠️ Error registrando status de Twilio: {e}")
+    for fn in _status_hooks:
+        try:
+            fn(sid, status, request.args)
+        except Exception as e:
+            print(f"[billing_api] ⚠️ Error en hook de status de Twilio: {e}")
+    return ("", 204)
+
 # =======================
 # Página HTML del panel + gráficos
 # =======================
-@billing_bp.route("/panel", methods=["GET"])
-def billing_panel():
-    # HTML auto-contenido
-    return ("""
+# HTML auto-contenido y constante: se comprime una sola vez al importar (br/gzip, ver compression.py)
+_PANEL_HTML = """
 <!doctype html>
 <html lang="es">
 <head>
@@ -766,4 +1398,9 @@ window.addEventListener('load', ()=>{ if(selBot.value) loadCharts(); });
 
 </script>
 </body></html>
-    """), 200, {"Content-Type": "text/html; charset=utf-8"}
\ No newline at end of file
+    """
+_PANEL_PAGE = Precompressed(_PANEL_HTML)
+
+@billing_bp.route("/panel", methods=["GET"])
+def billing_panel():
+    return _PANEL_PAGE.response()
\ No newline at end of file
@@ -1,8 +1,12 @@
-# bots/api_mobile_fastapi.py
-# Router de API móvil para el panel dentro de la app.
+# bots/api_mobile.py
+# API móvil (Blueprint Flask mobile_bp, montado en /api/mobile) para el panel dentro de la app.
 # - Login leyendo credenciales desde bots/*.json ("auth": {...})
 # - Listado/actualización/borrado de leads en Firebase
 # - Filtro por alcance (allowed bots) usando Authorization: Bearer <token>
+# - Tokens firmados (HMAC-SHA256) con alcance y expiración: sin estado compartido entre workers;
+#   revocación por jti en RTDB (mobile_revoked/<jti> = exp), cacheada en memoria
+#   (reglas: "mobile_revoked": {".indexOn": ".value"})
+# - Errores como JSON {"detail": "..."} (el formato que ya espera la app)
 # - ⬆️ Ahora también expone el "company" (business_name) de cada bot, tomado de bots/*.json
 
 from __future__ import annotations
@@ -10,52 +14,53 @@ from __future__ import annotations
 import os
 import json
 import glob
+import time
+import hmac
+import base64
+import hashlib
 import secrets
+import threading
 from typing import Any, Dict, List
 
-from fastapi import APIRouter, Request, HTTPException, status
-from fastapi.responses import JSONResponse
+from flask import Blueprint, request, jsonify, make_response, abort
 from firebase_admin import db
-from pydantic import BaseModel, Field
 
-# Importamos las funciones auxiliares de main.py
-# (Se asume que estas funciones no tienen dependencias de Flask)
+# Funciones auxiliares de main.py (main registra este Blueprint al final, con todo ya definido)
 from main import (
-    _load_users,
-    _get_bot_cfg_by_name,
-    _normalize_bot_name,
+    _lead_ref,
+    _lead_write,
     fb_list_leads_by_bot,
     fb_list_leads_all,
-    fb_get_lead,
-    fb_set_conversation_on,
-    fb_delete_lead
+    fb_delete_lead,
 )
+from http_cache import bump_lead, make_etag, conditional_json
+from leads_index import query_leads
 
 # --------------------------------------------------------------------
-# Router
+# Blueprint
 # --------------------------------------------------------------------
-mobile_router = APIRouter()
+mobile_bp = Blueprint("mobile_bp", __name__)
 
 # --------------------------------------------------------------------
 # Cache / Sesiones in-memory
 # --------------------------------------------------------------------
 _ACCOUNTS_CACHE: Dict[str, Dict[str, Any]] | None = None
 _BOT_COMPANY_CACHE: Dict[str, str] | None = None
-_SESSION_TOKENS: Dict[str, Dict[str, Any]] = {}
 
-class LoginRequest(BaseModel):
-    username: str
-    password: str
+# --------------------------------------------------------------------
+# Tokens firmados
+# --------------------------------------------------------------------
+MOBILE_TOKEN_TTL_SEC = int(os.environ.get("MOBILE_TOKEN_TTL_SEC", str(30 * 24 * 3600)) or 30 * 24 * 3600)
+MOBILE_REVOKED_REFRESH_SEC = int(os.environ.get("MOBILE_REVOKED_REFRESH_SEC", "60") or 60)
 
-class UpdateLeadRequest(BaseModel):
-    bot: str
-    numero: str
-    estado: str | None = Field(None)
-    nota: str | None = Field(None)
+# Secreto propio y obligatorio: sin él no se emiten ni se aceptan tokens (login => 503)
+_TOKEN_SECRET = (os.environ.get("MOBILE_TOKEN_SECRET") or "").strip().encode("utf-8")
+if not _TOKEN_SECRET:
+    print("[api_mobile] ⚠️ MOBILE_TOKEN_SECRET no configurado: login móvil deshabilitado.")
 
-class DeleteLeadRequest(BaseModel):
-    bot: str
-    numero: str
+_revoked_lock = threading.Lock()
+_REVOKED: Dict[str, int] = {}      # jti -> exp (epoch s)
+_revoked_loaded_at = 0.0
 
 # --------------------------------------------------------------------
 # Carga de bots desde ./bots/*.json
@@ -133,19 +138,95 @@ def _get_accounts() -> Dict[str, Dict[str, Any]]:
         print(f"[api_mobile] Cuentas cargadas desde /bots: {list(_ACCOUNTS_CACHE.keys())}")
     return _ACCOUNTS_CACHE
 
-def _issue_token(allowed):
-    tok = secrets.token_urlsafe(32)
-    _SESSION_TOKENS[tok] = {"allowed": allowed}
-    return tok
+def _b64e(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _b64d(txt: str) -> bytes:
+    return base64.urlsafe_b64decode(txt + "=" * (-len(txt) % 4))
+
+def _sign(payload_b64: str) -> str:
+    return _b64e(hmac.new(_TOKEN_SECRET, payload_b64.encode("ascii"), hashlib.sha256).digest())
+
+def _issue_token(allowed, username: str = "") -> str:
+    """Token autocontenido: base64url(payload).base64url(HMAC). payload = sub, bots, iat, exp, jti."""
+    now = int(time.time())
+    payload = {
+        "sub": username,
+        "bots": allowed if allowed == "*" else list(allowed),
+        "iat": now,
+        "exp": now + MOBILE_TOKEN_TTL_SEC,
+        "jti": secrets.token_urlsafe(12),
+    }
+    body = _b64e(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+    return f"{body}.{_sign(body)}"
+
+def _verify_token(tok: str) -> Dict[str, Any] | None:
+    """Payload si la firma es válida, no expiró y no está revocado; None en otro caso."""
+    if not _TOKEN_SECRET:
+        return None
+    try:
+        body, sig = tok.split(".", 1)
+        if not hmac.compare_digest(sig, _sign(body)):
+            return None
+        payload = json.loads(_b64d(body))
+    except Exception:
+        return None
+    if not isinstance(payload, dict) or int(payload.get("exp", 0)) < time.time():
+        return None
+    if _is_revoked(payload.get("jti", "")):
+        return None
+    return payload
+
+def _refresh_revoked(force: bool = False):
+    """Recarga la lista de revocados (solo los no vencidos) como mucho cada MOBILE_REVOKED_REFRESH_SEC."""
+    global _revoked_loaded_at
+    now = time.time()
+    with _revoked_lock:
+        if not force and now - _revoked_loaded_at < MOBILE_REVOKED_REFRESH_SEC:
+            return
+        _revoked_loaded_at = now
+    try:
+        data = db.reference("mobile_revoked").order_by_value().start_at(int(now)).get() or {}
+    except Exception as e:
+        print(f"[api_mobile] ⚠️ No se pudo leer mobile_revoked: {e}")
+        return
+    with _revoked_lock:
+        _REVOKED.clear()
+        _REVOKED.update({k: int(v) for k, v in data.items() if isinstance(v, (int, float))})
 
-def _allowed_from_request(request: Request) -> Any:
+def _is_revoked(jti: str) -> bool:
+    if not jti:
+        return True
+    _refresh_revoked()
+    with _revoked_lock:
+        return jti in _REVOKED
+
+def _revoke(payload: Dict[str, Any]):
+    jti = payload.get("jti", "")
+    exp = int(payload.get("exp", 0))
+    if not jti:
+        return
+    with _revoked_lock:
+        _REVOKED[jti] = exp
+    try:
+        db.reference(f"mobile_revoked/{jti}").set(exp)
+    except Exception as e:
+        print(f"[api_mobile] ⚠️ No se pudo guardar revocación {jti}: {e}")
+
+def _fail(code: int, detail: str):
+    """Corta la petición con {"detail": ...} y el código dado."""
+    abort(make_response(jsonify({"detail": detail}), code))
+
+def _token_from_request() -> Dict[str, Any]:
     auth = request.headers.get("Authorization") or ""
-    if auth.startswith("Bearer "):
-        tok = auth[7:].strip()
-        entry = _SESSION_TOKENS.get(tok)
-        if entry:
-            return entry.get("allowed", "*")
-    return "*"
+    payload = _verify_token(auth[7:].strip()) if auth.startswith("Bearer ") else None
+    if payload is None:
+        _fail(401, "invalid_token")
+    return payload
+
+def _allowed_from_request() -> Any:
+    """Alcance del token ("*" o lista de bots). Token ausente/ inválido/ vencido/ revocado => 401."""
+    return _token_from_request().get("bots") or []
 
 def _is_allowed(bot_name: str, allowed) -> bool:
     if allowed == "*":
@@ -154,78 +235,147 @@ def _is_allowed(bot_name: str, allowed) -> bool:
         return bot_name in allowed
     return True
 
+# --------------------------------------------------------------------
+# Leads
+# --------------------------------------------------------------------
+def _list_leads_by_bot(bot_name: str) -> List[Dict[str, Any]]:
+    return list(fb_list_leads_by_bot(bot_name).values())
+
+def _list_leads_all() -> List[Dict[str, Any]]:
+    return list(fb_list_leads_all().values())
+
+def _update_lead(bot_name: str, numero: str, estado: str | None = None, nota: str | None = None) -> bool:
+    try:
+        current = _lead_ref(bot_name, numero).get() or {}
+        if estado:
+            current["status"] = estado
+        if nota is not None:
+            current["notes"] = nota
+        current.setdefault("bot", bot_name)
+        current.setdefault("numero", numero)
+        _lead_write(bot_name, numero, current)
+        bump_lead(bot_name, numero)
+        return True
+    except Exception as e:
+        print(f"[api_mobile] ⚠️ No se pudo actualizar {bot_name}/{numero}: {e}")
+        return False
+
+def _delete_lead(bot_name: str, numero: str) -> bool:
+    return fb_delete_lead(bot_name, numero)
+
+def _json_body() -> Dict[str, Any]:
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
 # --------------------------------------------------------------------
 # Endpoints
 # --------------------------------------------------------------------
-@mobile_router.get("/health")
-async def mobile_health():
-    return JSONResponse(content={"ok": True, "service": "mobile"})
-
-@mobile_router.post("/login")
-async def mobile_login(login_data: LoginRequest):
-    username = login_data.username.strip()
-    password = login_data.password.strip()
+@mobile_bp.route("/health", methods=["GET"])
+def mobile_health():
+    return jsonify({"ok": True, "service": "mobile"})
+
+@mobile_bp.route("/login", methods=["POST"])
+def mobile_login():
+    if not _TOKEN_SECRET:
+        _fail(503, "token_secret_missing")
+    data = _json_body()
+    username = str(data.get("username") or "").strip()
+    password = str(data.get("password") or "").strip()
     accounts = _get_accounts()
     acc = accounts.get(username)
     if not acc or password != acc.get("password"):
-        raise HTTPException(status_code=401, detail="bad_credentials")
+        _fail(401, "bad_credentials")
     allowed = acc.get("bots", "*")
-    token = _issue_token(allowed)
+    token = _issue_token(allowed, username)
     bots_payload = allowed if allowed == "*" else list(allowed)
-    return JSONResponse(content={"ok": True, "token": token, "bots": bots_payload})
+    return jsonify({"ok": True, "token": token, "bots": bots_payload, "expires_in": MOBILE_TOKEN_TTL_SEC})
 
-@mobile_router.get("/leads")
-async def mobile_leads(request: Request):
-    allowed = _allowed_from_request(request)
-    bot_q = request.query_params.get("bot", "").strip()
+@mobile_bp.route("/logout", methods=["POST"])
+def mobile_logout():
+    _revoke(_token_from_request())
+    return jsonify({"ok": True})
 
-    try:
-        if bot_q:
-            if not _is_allowed(bot_q, allowed):
-                return JSONResponse(content={"leads": []})
-            leads = _list_leads_by_bot(bot_q)
-        else:
+@mobile_bp.route("/leads", methods=["GET"])
+def mobile_leads():
+    allowed = _allowed_from_request()
+    qp = request.args
+    bot_q = qp.get("bot", "").strip()
+
+    # Paginado (si la app manda limit/cursor): una página ordenada desde leads_index
+    paginado = bool(qp.get("limit") or qp.get("cursor"))
+
+    # ETag por versión de la lista (y alcance del token): sin cambios => 304 sin leer Firebase
+    scope = allowed if allowed == "*" else ",".join(sorted(allowed or []))
+    page_parts = [qp.get(k, "") for k in ("limit", "cursor", "sort", "order", "status", "from", "to")] if paginado else []
+    etag = make_etag("mobile_leads", keys=[f"leads:{bot_q}" if bot_q else "leads:*"], parts=[scope, bot_q] + page_parts)
+
+    def _build():
+        try:
+            if bot_q and not _is_allowed(bot_q, allowed):
+                return {"leads": []}
+            if paginado:
+                try:
+                    limit = int(qp.get("limit") or 50)
+                except ValueError:
+                    limit = 50
+                return query_leads(
+                    bot=bot_q,
+                    status=qp.get("status", "").strip(),
+                    date_from=qp.get("from", "").strip(),
+                    date_to=qp.get("to", "").strip(),
+                    sort=qp.get("sort", "last_seen").strip(),
+                    order=qp.get("order", "desc").strip(),
+                    limit=limit,
+                    cursor=qp.get("cursor", "").strip(),
+                    allowed=None if allowed == "*" else (allowed if isinstance(allowed, list) else []),
+                )
+            if bot_q:
+                return {"leads": _list_leads_by_bot(bot_q)}
             leads = _list_leads_all()
             if allowed != "*":
                 allowed_set = set(allowed) if isinstance(allowed, list) else set()
                 leads = [l for l in leads if l.get("bot") in allowed_set]
-        return JSONResponse(content={"leads": leads})
-    except Exception as e:
-        print(f"❌ Error leyendo leads: {e}")
-        raise HTTPException(status_code=500, detail="Error al leer los leads")
+            return {"leads": leads}
+        except Exception as e:
+            print(f"❌ Error leyendo leads: {e}")
+            return {"detail": "Error al leer los leads"}, 500   # sin ETag: conditional_json solo lo pone en 200
+
+    return conditional_json("mobile_leads", etag, _build)
 
-@mobile_router.get("/bots_meta")
-async def mobile_bots_meta():
+@mobile_bp.route("/bots_meta", methods=["GET"])
+def mobile_bots_meta():
     comp = _get_bot_company_map()
     arr = [{"name": k, "company": v} for k, v in sorted(comp.items())]
-    return JSONResponse(content={"bots": arr})
+    return jsonify({"bots": arr})
 
-@mobile_router.post("/lead")
-async def mobile_update_lead(lead_data: UpdateLeadRequest, request: Request):
-    bot_name = lead_data.bot.strip()
-    numero = lead_data.numero.strip()
+@mobile_bp.route("/lead", methods=["POST"])
+def mobile_update_lead():
+    data = _json_body()
+    bot_name = str(data.get("bot") or "").strip()
+    numero = str(data.get("numero") or "").strip()
 
     if not bot_name or not numero:
-        raise HTTPException(status_code=400, detail="params")
+        _fail(400, "params")
 
-    allowed = _allowed_from_request(request)
+    allowed = _allowed_from_request()
     if not _is_allowed(bot_name, allowed):
-        raise HTTPException(status_code=403, detail="forbidden")
+        _fail(403, "forbidden")
 
-    ok = _update_lead(bot_name, numero, estado=lead_data.estado, nota=lead_data.nota)
-    return JSONResponse(content={"ok": bool(ok)})
+    ok = _update_lead(bot_name, numero, estado=data.get("estado"), nota=data.get("nota"))
+    return jsonify({"ok": bool(ok)})
 
-@mobile_router.post("/delete")
-async def mobile_delete_lead(delete_data: DeleteLeadRequest, request: Request):
-    bot_name = delete_data.bot.strip()
-    numero = delete_data.numero.strip()
+@mobile_bp.route("/delete", methods=["POST"])
+def mobile_delete_lead():
+    data = _json_body()
+    bot_name = str(data.get("bot") or "").strip()
+    numero = str(data.get("numero") or "").strip()
 
     if not bot_name or not numero:
-        raise HTTPException(status_code=400, detail="params")
+        _fail(400, "params")
 
-    allowed = _allowed_from_request(request)
+    allowed = _allowed_from_request()
     if not _is_allowed(bot_name, allowed):
-        raise HTTPException(status_code=403, detail="forbidden")
+        _fail(403, "forbidden")
 
     ok = _delete_lead(bot_name, numero)
-    return JSONResponse(content={"ok": bool(ok)})
\ No newline at end of file
+    return jsonify({"ok": bool(ok)})
@@ -0,0 +1,368 @@
+# campaigns.py
+# Campañas salientes de WhatsApp (difusión a un segmento de leads) con cola persistente
+# - campaigns/<cid>: plantilla, segmento (bot, estado, fechas), ritmo, estado y totales
+# - campaign_queue/<cid>/<rid>: un destinatario {numero, estado, intentos, next_at, sid, error}
+# - active_campaigns/<cid> = estado: índice pequeño de campañas con trabajo (building/queued/running);
+#   el worker consulta solo este nodo, no el árbol completo de campañas
+# - El alta solo registra la campaña ("building"); el worker resuelve el segmento y llena la cola en segundo plano
+# - Cambios de estado por transaction sobre campaigns/<cid>/state: un pause/cancel nunca se pisa
+# - Un worker por proceso toma campañas con un lease en RTDB (transaction): un solo emisor por campaña
+#   aunque haya varios workers/nodos; si el emisor muere, otro la retoma al vencer el lease
+# - Ritmo: CAMPAIGN_RATE_MPS por número emisor (máx. CAMPAIGN_MAX_RATE_MPS) => dentro del throughput de Twilio
+# - Reintentos con backoff exponencial; tras CAMPAIGN_MAX_RETRIES queda "fallido" con el error
+# - Estados de la cola, totales e historial se escriben por lotes (no una lectura+escritura por envío)
+# - Reglas de RTDB recomendadas: "campaign_queue": {"$cid": {".indexOn": ["next_at"]}},
+#   "campaigns": {".indexOn": ["state"]}
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+import threading
+import time
+import uuid
+
+from firebase_admin import db
+
+from leads_index import iter_leads
+
+CAMPAIGN_RATE_MPS = float(os.environ.get("CAMPAIGN_RATE_MPS", "5") or 5)
+CAMPAIGN_MAX_RATE_MPS = float(os.environ.get("CAMPAIGN_MAX_RATE_MPS", "20") or 20)
+CAMPAIGN_MAX_RETRIES = int(os.environ.get("CAMPAIGN_MAX_RETRIES", "3") or 3)
+CAMPAIGN_RETRY_BASE_SEC = int(os.environ.get("CAMPAIGN_RETRY_BASE_SEC", "30") or 30)
+CAMPAIGN_BATCH = int(os.environ.get("CAMPAIGN_BATCH", "50") or 50)
+CAMPAIGN_POLL_SEC = int(os.environ.get("CAMPAIGN_POLL_SEC", "5") or 5)
+CAMPAIGN_LEASE_SEC = int(os.environ.get("CAMPAIGN_LEASE_SEC", "60") or 60)
+CAMPAIGN_MAX_RECIPIENTS = int(os.environ.get("CAMPAIGN_MAX_RECIPIENTS", "20000") or 20000)
+CAMPAIGN_HISTORY_PARALLEL = int(os.environ.get("CAMPAIGN_HISTORY_PARALLEL", "8") or 8)
+
+_ACTIVE = ("building", "queued", "running")   # estados con entrada en active_campaigns
+_WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+# =======================
+# Estado (runtime)
+# =======================
+_lock = threading.Lock()
+_hooks = {"send": None, "append_history": None, "bot_number": None}
+_next_slot = {}   # número emisor -> instante del próximo envío permitido
+_started = False
+_stats = {"sent": 0, "failed": 0, "retried": 0, "batches": 0}
+
+
+def init_campaigns(send, append_history, bot_number):
+    """
+    Hooks de main.py:
+      send(from_, to, body, status_callback) -> sid
+      append_history(bot, numero, entradas)   (fb_append_historial_batch)
+      bot_number(bot) -> "whatsapp:+1..."
+    """
+    _hooks.update({"send": send, "append_history": append_history, "bot_number": bot_number})
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+def _hora() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def _campaign_ref(cid: str = ""):
+    return db.reference(f"campaigns/{cid}" if cid else "campaigns")
+
+def _queue_ref(cid: str):
+    return db.reference(f"campaign_queue/{cid}")
+
+def _active_ref(cid: str = ""):
+    return db.reference(f"active_campaigns/{cid}" if cid else "active_campaigns")
+
+def _transition(cid: str, desde, hacia: str, extra: dict = None) -> bool:
+    """
+    Pasa campaigns/<cid>/state a 'hacia' solo si sigue en uno de 'desde' (transaction).
+    Si cambia, escribe 'extra' y mantiene active_campaigns en la misma escritura multi-path.
+    """
+    desde = (desde,) if isinstance(desde, str) else tuple(desde)
+    hecho = {}
+
+    def _tx(cur):
+        hecho.clear()   # la transaction puede reintentar
+        if cur in desde:
+            hecho["ok"] = True
+            return hacia
+        return cur
+    try:
+        _campaign_ref(cid).child("state").transaction(_tx)
+    except Exception as e:
+        print(f"[campaigns] ⚠️ No se pudo cambiar {cid} a {hacia}: {e}")
+        return False
+    if not hecho.get("ok"):
+        return False
+    cambios = {f"campaigns/{cid}/{k}": v for k, v in (extra or {}).items()}
+    cambios[f"active_campaigns/{cid}"] = hacia if hacia in _ACTIVE else None
+    db.reference().update(cambios)
+    return True
+
+class _Vars(dict):
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+def render_template(template: str, lead: dict) -> str:
+    """
+    {numero}, {bot}, {estado}; variables desconocidas quedan tal cual.
+    Los leads no tienen nombre: {nombre} no se rellena (y 'notes' es interna, nunca va al cliente).
+    """
+    numero = lead.get("numero", "")
+    return (template or "").format_map(_Vars(
+        numero=numero.replace("whatsapp:", ""),
+        bot=lead.get("bot", ""),
+        estado=lead.get("status", ""),
+    ))
+
+# =======================
+# Alta y control
+# =======================
+def create_campaign(bot: str, template: str, status: str = "", date_from: str = "", date_to: str = "",
+                    rate: float = None, status_callback: str = "", created_by: str = "") -> dict:
+    """Registra la campaña en estado "building"; el worker resuelve el segmento y llena la cola (no bloquea la petición)."""
+    cid = datetime.now().strftime("%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:6]
+    rate = min(float(rate or CAMPAIGN_RATE_MPS), CAMPAIGN_MAX_RATE_MPS)
+    campaign = {
+        "id": cid,
+        "bot": bot,
+        "template": template,
+        "segment": {"status": status, "date_from": date_from, "date_to": date_to},
+        "rate": rate,
+        "state": "building",
+        "status_callback": status_callback,
+        "created": _hora(),
+        "created_by": created_by,
+        "totals": {"total": 0, "sent": 0, "failed": 0, "pending": 0},
+    }
+    db.reference().update({f"campaigns/{cid}": campaign, f"active_campaigns/{cid}": "building"})
+    print(f"[campaigns] 📣 Campaña {cid} ({bot}) registrada a {rate} msg/s; preparando destinatarios")
+    return campaign
+
+def _build_queue(cid: str, campaign: dict):
+    """Resuelve el segmento desde leads_index y encola un destinatario por lead (escrituras por lotes)."""
+    seg = campaign.get("segment") or {}
+    template = campaign.get("template", "")
+    cola, total = {}, 0
+    for lead in iter_leads(bot=campaign.get("bot", ""), status=seg.get("status", ""),
+                           date_from=seg.get("date_from", ""), date_to=seg.get("date_to", "")):
+        if total >= CAMPAIGN_MAX_RECIPIENTS:
+            break
+        cola[f"{total:06d}"] = {
+            "numero": lead["numero"],
+            "texto": render_template(template, lead),
+            "estado": "pendiente",
+            "intentos": 0,
+            "next_at": 1,   # > 0: visible para la consulta por next_at
+        }
+        total += 1
+        if len(cola) >= 500:
+            _queue_ref(cid).update(cola)
+            cola = {}
+            _claim(cid)   # segmentos grandes: renovar el lease mientras se llena la cola
+    if cola:
+        _queue_ref(cid).update(cola)
+    _campaign_ref(cid).child("totals").set({"total": total, "sent": 0, "failed": 0, "pending": total})
+    if total:
+        _transition(cid, "building", "queued", {"lease": None})
+    else:
+        _transition(cid, "building", "done", {"finished": _hora(), "lease": None})
+    print(f"[campaigns] 📣 Campaña {cid}: {total} destinatarios en cola")
+
+def set_state(cid: str, state: str) -> bool:
+    """pause / resume / cancel. Devuelve False si la campaña no existe, ya terminó o el cambio no aplica."""
+    if state == "pause":
+        return _transition(cid, ("queued", "running"), "paused")
+    if state == "resume":
+        return _transition(cid, "paused", "queued", {"lease": None})
+    if state == "cancel":
+        return _transition(cid, ("building", "queued", "running", "paused"), "cancelled", {"lease": None})
+    return False
+
+def get_campaign(cid: str) -> dict:
+    data = _campaign_ref(cid).get()
+    if isinstance(data, dict):
+        data.pop("lease", None)
+    return data
+
+def list_campaigns(bots=None) -> list:
+    data = _campaign_ref().get() or {}
+    out = []
+    for cid, c in data.items():
+        if not isinstance(c, dict) or (bots is not None and c.get("bot") not in bots):
+            continue
+        c = dict(c)
+        c.pop("lease", None)
+        c.pop("template", None)
+        out.append(c)
+    out.sort(key=lambda c: c.get("created", ""), reverse=True)
+    return out
+
+def list_recipients(cid: str, estado: str = "", limit: int = 100) -> list:
+    data = _queue_ref(cid).get() or {}
+    rows = data.items() if isinstance(data, dict) else enumerate(data)
+    out = [{"id": str(k), **{f: v.get(f) for f in ("numero", "estado", "intentos", "sid", "error", "hora")}}
+           for k, v in rows if isinstance(v, dict) and (not estado or v.get("estado") == estado)]
+    return out[:max(1, int(limit or 100))]
+
+# =======================
+# Envío (worker)
+# =======================
+def _pace(sender: str, rate: float):
+    """Espacia los envíos de un mismo número emisor a 'rate' msg/s (reserva de turno bajo lock)."""
+    with _lock:
+        now = time.monotonic()
+        slot = max(now, _next_slot.get(sender, 0.0))
+        _next_slot[sender] = slot + 1.0 / max(rate, 0.01)
+    if slot > now:
+        time.sleep(slot - now)
+
+def _claim(cid: str) -> bool:
+    """Lease de la campaña para este proceso (transaction: un solo emisor entre workers)."""
+    def _tx(cur):
+        cur = cur or {}
+        if cur.get("owner") not in (None, _WORKER_ID) and int(cur.get("until", 0)) > _now_ms():
+            return cur
+        return {"owner": _WORKER_ID, "until": _now_ms() + CAMPAIGN_LEASE_SEC * 1000}
+    try:
+        lease = _campaign_ref(cid).child("lease").transaction(_tx)
+        return (lease or {}).get("owner") == _WORKER_ID
+    except Exception as e:
+        print(f"[campaigns] ⚠️ No se pudo tomar el lease de {cid}: {e}")
+        return False
+
+def _due(cid: str, n: int) -> dict:
+    now = _now_ms()
+    try:
+        data = _queue_ref(cid).order_by_child("next_at").start_at(1).end_at(now).limit_to_first(n).get() or {}
+    except Exception as e:
+        print(f"[campaigns] ⚠️ Consulta por next_at falló (¿falta .indexOn?), leyendo cola completa: {e}")
+        data = _queue_ref(cid).get() or {}
+        data = {k: v for k, v in data.items() if isinstance(v, dict) and 0 < int(v.get("next_at") or 0) <= now}
+        data = dict(sorted(data.items())[:n])
+    return {k: v for k, v in data.items() if isinstance(v, dict)}
+
+def _flush_history(bot: str, entradas_por_lead: dict):
+    """Historial de los enviados del lote: un append por lead, en paralelo acotado y fuera del bucle de envío."""
+    append = _hooks["append_history"]
+    if not append or not entradas_por_lead:
+        return
+
+    def _one(item):
+        numero, entradas = item
+        try:
+            append(bot, numero, entradas)
+        except Exception as e:
+            print(f"[campaigns] ⚠️ No se pudo guardar historial {bot}/{numero}: {e}")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(CAMPAIGN_HISTORY_PARALLEL, len(entradas_por_lead)))) as pool:
+        list(pool.map(_one, entradas_por_lead.items()))
+
+def _run_batch(cid: str, campaign: dict) -> bool:
+    """Envía un lote. Devuelve True si quedan destinatarios pendientes."""
+    bot = campaign.get("bot", "")
+    sender = _hooks["bot_number"](bot) if _hooks["bot_number"] else ""
+    if not sender or not _hooks["send"]:
+        print(f"[campaigns] ❌ Campaña {cid}: sin número emisor para '{bot}' o Twilio no configurado; en pausa")
+        _transition(cid, ("queued", "running"), "paused", {"error": "Sin número emisor / Twilio"})
+        return False
+
+    rate = float(campaign.get("rate") or CAMPAIGN_RATE_MPS)
+    totals = dict(campaign.get("totals") or {})
+    # El lote debe caber holgado en el lease (a ritmos bajos, lotes más pequeños)
+    lote = _due(cid, max(1, min(CAMPAIGN_BATCH, int(rate * CAMPAIGN_LEASE_SEC / 2))))
+    cambios, historial = {}, {}
+    for rid, rec in sorted(lote.items()):
+        _pace(sender, rate)
+        base = f"campaign_queue/{cid}/{rid}"
+        try:
+            sid = _hooks["send"](sender, rec["numero"], rec.get("texto", ""), campaign.get("status_callback") or None)
+            hora = _hora()
+            cambios.update({f"{base}/estado": "enviado", f"{base}/sid": sid or "", f"{base}/hora": hora,
+                            f"{base}/next_at": None, f"{base}/error": None})
+            historial.setdefault(rec["numero"], []).append({"tipo": "admin", "texto": rec.get("texto", ""), "hora": hora, "campaign": cid})
+            totals["sent"] = int(totals.get("sent", 0)) + 1
+            totals["pending"] = max(0, int(totals.get("pending", 0)) - 1)
+            _stats["sent"] += 1
+        except Exception as e:
+            intentos = int(rec.get("intentos", 0)) + 1
+            if intentos < CAMPAIGN_MAX_RETRIES:
+                espera = CAMPAIGN_RETRY_BASE_SEC * (2 ** (intentos - 1))
+                cambios.update({f"{base}/intentos": intentos, f"{base}/error": str(e)[:300],
+                                f"{base}/next_at": _now_ms() + espera * 1000})
+                _stats["retried"] += 1
+            else:
+                cambios.update({f"{base}/estado": "fallido", f"{base}/intentos": intentos,
+                                f"{base}/error": str(e)[:300], f"{base}/next_at": None, f"{base}/hora": _hora()})
+                totals["failed"] = int(totals.get("failed", 0)) + 1
+                totals["pending"] = max(0, int(totals.get("pending", 0)) - 1)
+                _stats["failed"] += 1
+
+    pendientes = int(totals.get("pending", 0)) > 0
+    cambios[f"campaigns/{cid}/totals"] = totals
+    cambios[f"campaigns/{cid}/lease"] = {"owner": _WORKER_ID, "until": _now_ms() + CAMPAIGN_LEASE_SEC * 1000}
+    db.reference().update(cambios)   # estados + totales del lote en una escritura multi-path
+    _flush_history(bot, historial)
+    _stats["batches"] += 1
+    # Solo running -> done: un pause/cancel que llegó durante el lote se respeta
+    if not pendientes and _transition(cid, "running", "done", {"finished": _hora(), "lease": None}):
+        print(f"[campaigns] ✅ Campaña {cid} terminada: {totals.get('sent', 0)} enviados, {totals.get('failed', 0)} fallidos")
+    # Solo quedan reintentos con backoff: esperar al siguiente ciclo
+    return pendientes and bool(lote)
+
+def _backfill_active():
+    """Una vez por proceso: indexa campañas activas que no estén en active_campaigns (p. ej. creadas antes del índice)."""
+    try:
+        cambios = {}
+        for state in _ACTIVE:
+            try:
+                data = _campaign_ref().order_by_child("state").equal_to(state).get() or {}
+            except Exception:
+                data = {cid: c for cid, c in (_campaign_ref().get() or {}).items()
+                        if isinstance(c, dict) and c.get("state") == state}
+            cambios.update({cid: state for cid in data})
+        ya = _active_ref().get(shallow=True) or {}
+        cambios = {cid: st for cid, st in cambios.items() if cid not in ya}
+        if cambios:
+            _active_ref().update(cambios)
+            print(f"[campaigns] 🔁 {len(cambios)} campañas activas añadidas a active_campaigns")
+    except Exception as e:
+        print(f"[campaigns] ⚠️ No se pudo completar active_campaigns: {e}")
+
+def _worker_loop():
+    _backfill_active()
+    while True:
+        try:
+            activas = _active_ref().get() or {}
+            for cid in sorted(activas):
+                c = _campaign_ref(cid).get()
+                if not isinstance(c, dict) or c.get("state") not in _ACTIVE:
+                    _active_ref(cid).delete()   # entrada huérfana: la campaña terminó o se borró
+                    continue
+                if not _claim(cid):
+                    continue
+                if c.get("state") == "building":
+                    _build_queue(cid, c)
+                    continue   # se envía en el siguiente ciclo (o lo toma otro worker)
+                if c.get("state") == "queued":
+                    _transition(cid, "queued", "running", {"started": _hora()})
+                while True:
+                    c = _campaign_ref(cid).get() or {}
+                    if c.get("state") not in _ACTIVE or (c.get("lease") or {}).get("owner") != _WORKER_ID:
+                        break
+                    if not _run_batch(cid, c):
+                        break
+        except Exception as e:
+            print(f"[campaigns] ⚠️ Error en el worker de campañas: {e}")
+        time.sleep(CAMPAIGN_POLL_SEC)
+
+def start_campaign_worker():
+    """Arranca el emisor en segundo plano (idempotente; con eventlet es un greenlet que no bloquea peticiones)."""
+    global _started
+    if _started:
+        return
+    _started = True
+    threading.Thread(target=_worker_loop, daemon=True).start()
+
+def campaign_stats() -> dict:
+    with _lock:
+        return {**_stats, "worker": _WORKER_ID, "senders_paced": len(_next_slot)}
@@ -0,0 +1,239 @@
+# chat_events.py
+# Canal push (Server-Sent Events) para las vistas de chat del panel y la app
+# - Sustituye el polling de 3 s a /api/chat: solo viaja lo NUEVO (mensajes y ON/OFF)
+# - Alimentado por el camino de escritura (fb_append_historial, ON/OFF) y, mientras haya
+#   chats abiertos, por un listener de RTDB por lead (escrituras de otros workers/app)
+# - Un suscriptor = una cola; con eventlet cada stream abierto es un greenlet barato
+
+from datetime import datetime
+import os
+import json
+import queue
+import threading
+
+from firebase_admin import db
+
+from http_cache import bump_lead
+
+CHAT_EVENTS_RTDB_LISTEN = (os.environ.get("CHAT_EVENTS_RTDB_LISTEN", "1") or "1").strip().lower() in ("1", "true", "on", "yes")
+SSE_HEARTBEAT_SEC = int(os.environ.get("SSE_HEARTBEAT_SEC", "15") or 15)
+SSE_QUEUE_MAX = int(os.environ.get("SSE_QUEUE_MAX", "200") or 200)
+
+# =======================
+# Estado (runtime)
+# =======================
+_lock = threading.Lock()
+# (bot, numero) -> {"subs": set(Queue), "count": int|None, "enabled": bool|None, "listener": ListenerRegistration|None}
+_channels = {}
+_stats = {"published": 0, "dropped": 0, "listener_events": 0}
+
+
+def _entry_ts(entrada: dict) -> int:
+    ts = (entrada or {}).get("ts")
+    if isinstance(ts, (int, float)) and ts > 0:
+        return int(ts)
+    try:
+        return int(datetime.strptime((entrada or {}).get("hora", ""), "%Y-%m-%d %H:%M:%S").timestamp() * 1000)
+    except Exception:
+        return 0
+
+def _as_list(historial):
+    if isinstance(historial, dict):
+        return [historial[k] for k in sorted(historial.keys(), key=lambda k: int(k) if str(k).isdigit() else k)]
+    return [h for h in (historial or []) if h is not None]
+
+def _message_event(entrada: dict) -> dict:
+    msg = {
+        "texto": entrada.get("texto", ""),
+        "hora": entrada.get("hora", ""),
+        "tipo": entrada.get("tipo", "user"),
+        "ts": _entry_ts(entrada),
+    }
+    for k in ("id", "estado"):
+        if entrada.get(k):
+            msg[k] = entrada[k]
+    return {"type": "message", "mensaje": msg}
+
+def _fanout(ch: dict, event: dict):
+    """Entrega a todos los suscriptores del canal (llamar con _lock tomado)."""
+    for q in list(ch["subs"]):
+        try:
+            q.put_nowait(event)
+        except queue.Full:
+            # Cliente lento: le pedimos resincronizar en lugar de crecer sin límite
+            _stats["dropped"] += 1
+            try:
+                while True:
+                    q.get_nowait()
+            except queue.Empty:
+                pass
+            q.put_nowait({"type": "reset"})
+    _stats["published"] += 1
+
+# =======================
+# Publicación (camino de escritura)
+# =======================
+def publish_message(bot: str, numero: str, entrada: dict, index: int = None):
+    """Nuevo mensaje en el historial; index = posición en la lista (deduplica con el listener)."""
+    with _lock:
+        ch = _channels.get((bot, numero))
+        if not ch:
+            return
+        if index is not None and ch["count"] is not None and index < ch["count"]:
+            return
+        if index is not None:
+            ch["count"] = index + 1
+        _fanout(ch, _message_event(entrada))
+
+def publish_state(bot: str, numero: str, enabled: bool):
+    with _lock:
+        ch = _channels.get((bot, numero))
+        if not ch or ch["enabled"] == bool(enabled):
+            return
+        ch["enabled"] = bool(enabled)
+        _fanout(ch, {"type": "state", "bot_enabled": bool(enabled)})
+
+def publish_update(bot: str, numero: str, index: int, cambios: dict):
+    """Cambio sobre un mensaje ya publicado (p. ej. estado de entrega)."""
+    with _lock:
+        ch = _channels.get((bot, numero))
+        if not ch:
+            return
+        _fanout(ch, {"type": "update", "index": index, "cambios": cambios})
+
+def publish_reset(bot: str, numero: str):
+    """Historial vaciado/borrado: el cliente debe recargar."""
+    with _lock:
+        ch = _channels.get((bot, numero))
+        if not ch:
+            return
+        ch["count"] = 0
+        _fanout(ch, {"type": "reset"})
+
+# =======================
+# Listener RTDB (escrituras de otros procesos)
+# =======================
+def _on_rtdb_event(bot: str, numero: str, event):
+    path = event.path or "/"
+    data = event.data
+    with _lock:
+        ch = _channels.get((bot, numero))
+        if not ch:
+            return
+        first = ch["count"] is None
+        _stats["listener_events"] += 1
+    if not first:
+        # Cambio hecho quizá por otro proceso: invalida los ETag de este lead
+        bump_lead(bot, numero)
+    with _lock:
+        ch = _channels.get((bot, numero))
+        if not ch:
+            return
+
+        if path in ("/", "/historial"):
+            if path == "/":
+                lead = data if isinstance(data, dict) else {}
+                historial = _as_list(lead.get("historial"))
+                if "bot_enabled" in lead and isinstance(lead["bot_enabled"], bool):
+                    if ch["enabled"] is not None and ch["enabled"] != lead["bot_enabled"]:
+                        _fanout(ch, {"type": "state", "bot_enabled": lead["bot_enabled"]})
+                    ch["enabled"] = lead["bot_enabled"]
+            else:
+                historial = _as_list(data)
+            if ch["count"] is None:
+                ch["count"] = len(historial)       # snapshot inicial: no se reenvía
+            elif len(historial) < ch["count"]:
+                ch["count"] = len(historial)
+                _fanout(ch, {"type": "reset"})
+            else:
+                for entrada in historial[ch["count"]:]:
+                    if isinstance(entrada, dict):
+                        _fanout(ch, _message_event(entrada))
+                ch["count"] = len(historial)
+        elif path.startswith("/historial/"):
+            idx = path.split("/")[2]
+            if idx.isdigit() and isinstance(data, dict) and path.count("/") == 2:
+                i = int(idx)
+                if ch["count"] is None or i >= ch["count"]:
+                    ch["count"] = i + 1
+                    _fanout(ch, _message_event(data))
+        elif path == "/bot_enabled" and isinstance(data, bool):
+            if ch["enabled"] != data:
+                ch["enabled"] = data
+                _fanout(ch, {"type": "state", "bot_enabled": data})
+
+def _start_listener(bot: str, numero: str):
+    try:
+        reg = db.reference(f"leads/{bot}/{numero}").listen(lambda ev: _on_rtdb_event(bot, numero, ev))
+    except Exception as e:
+        print(f"[chat_events] ⚠️ No se pudo escuchar leads/{bot}/{numero}: {e}")
+        return
+    with _lock:
+        ch = _channels.get((bot, numero))
+        if ch is not None and ch["listener"] is None and ch["subs"]:
+            ch["listener"] = reg
+            return
+    reg.close()  # el último suscriptor se fue mientras abríamos
+
+# =======================
+# Suscripción
+# =======================
+def subscribe(bot: str, numero: str, enabled: bool = None) -> queue.Queue:
+    q = queue.Queue(maxsize=SSE_QUEUE_MAX)
+    start_listener = False
+    with _lock:
+        ch = _channels.get((bot, numero))
+        if ch is None:
+            ch = {"subs": set(), "count": None, "enabled": enabled, "listener": None}
+            _channels[(bot, numero)] = ch
+            start_listener = CHAT_EVENTS_RTDB_LISTEN
+        ch["subs"].add(q)
+    if start_listener:
+        threading.Thread(target=_start_listener, args=(bot, numero), daemon=True).start()
+    return q
+
+def unsubscribe(bot: str, numero: str, q: queue.Queue):
+    reg = None
+    with _lock:
+        ch = _channels.get((bot, numero))
+        if not ch:
+            return
+        ch["subs"].discard(q)
+        if not ch["subs"]:
+            reg = ch["listener"]
+            _channels.pop((bot, numero), None)
+    if reg is not None:
+        try:
+            reg.close()
+        except Exception:
+            pass
+
+def sse_stream(bot: str, numero: str, enabled: bool = None):
+    """Generador text/event-stream para una conversación (usar con stream_with_context)."""
+    q = subscribe(bot, numero, enabled)
+    try:
+        yield f"retry: 3000\n\n"
+        if enabled is not None:
+            yield f"event: state\ndata: {json.dumps({'type': 'state', 'bot_enabled': bool(enabled)})}\n\n"
+        while True:
+            try:
+                ev = q.get(timeout=SSE_HEARTBEAT_SEC)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            data = json.dumps(ev, ensure_ascii=False)
+            ts = (ev.get("mensaje") or {}).get("ts")
+            id_line = f"id: {ts}\n" if ts else ""
+            yield f"{id_line}event: {ev['type']}\ndata: {data}\n\n"
+    finally:
+        unsubscribe(bot, numero, q)
+
+def chat_events_stats() -> dict:
+    with _lock:
+        return {
+            "channels": len(_channels),
+            "subscribers": sum(len(c["subs"]) for c in _channels.values()),
+            "listeners": sum(1 for c in _channels.values() if c["listener"] is not None),
+            "queued": sum(q.qsize() for c in _channels.values() for q in c["subs"]),
+            **_stats,
+        }
@@ -0,0 +1,185 @@
+# compression.py
+# Compresión negociada (br/gzip) y huellas de contenido para estáticos
+# - after_request: comprime respuestas de texto grandes (HTML, JSON, CSS, JS) según Accept-Encoding
+# - No toca streams (/exportar, SSE), 304/204, ni respuestas ya codificadas
+# - brotli es opcional: sin el paquete se negocia solo gzip
+# - url_for("static", ...) añade ?v=<hash del contenido>; con ?v= correcto => caché de un año (immutable)
+# - Precompressed: cuerpos constantes (p. ej. /billing/panel) comprimidos una sola vez al arrancar
+
+from flask import request, make_response
+import gzip
+import hashlib
+import os
+import threading
+
+try:
+    import brotli   # opcional (pip install Brotli)
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024") or 1024)
+COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", "6") or 6)
+COMPRESS_BR_QUALITY = int(os.environ.get("COMPRESS_BR_QUALITY", "5") or 5)
+STATIC_MAX_AGE_SEC = int(os.environ.get("STATIC_MAX_AGE_SEC", str(365 * 24 * 3600)) or 365 * 24 * 3600)
+
+_COMPRESSIBLE = (
+    "text/html", "text/plain", "text/css", "text/csv", "text/javascript",
+    "application/json", "application/javascript", "application/x-ndjson", "image/svg+xml",
+)
+
+_lock = threading.Lock()
+_hashes = {}   # ruta absoluta -> (mtime, hash)
+_stats = {"compressed": 0, "bytes_in": 0, "bytes_out": 0, "br": 0, "gzip": 0}
+
+# =======================
+# Negociación
+# =======================
+def negotiate(accept_encoding: str) -> str:
+    """'br', 'gzip' o '' según Accept-Encoding (respeta q=0)."""
+    prefs = {}
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        prefs[name.strip()] = q
+
+    def _q(enc):
+        return prefs.get(enc, prefs.get("*", 0.0))
+
+    opciones = [("br", _q("br"))] if brotli is not None else []
+    opciones.append(("gzip", _q("gzip")))
+    enc, q = max(opciones, key=lambda x: x[1])
+    return enc if q > 0 else ""
+
+def encode(data: bytes, enc: str, best: bool = False) -> bytes:
+    if enc == "br":
+        return brotli.compress(data, quality=11 if best else COMPRESS_BR_QUALITY)
+    if enc == "gzip":
+        return gzip.compress(data, compresslevel=9 if best else COMPRESS_GZIP_LEVEL)
+    return data
+
+def _add_vary(resp):
+    vary = [v.strip() for v in (resp.headers.get("Vary") or "").split(",") if v.strip()]
+    if "accept-encoding" not in [v.lower() for v in vary]:
+        vary.append("Accept-Encoding")
+        resp.headers["Vary"] = ", ".join(vary)
+
+# =======================
+# Hook de respuesta
+# =======================
+def compress_response(resp):
+    if (
+        resp.status_code < 200 or resp.status_code in (204, 206, 304)
+        or resp.direct_passthrough or resp.is_streamed
+        or "Content-Encoding" in resp.headers
+        or (resp.mimetype or "") not in _COMPRESSIBLE
+        or request.method == "HEAD"
+    ):
+        return resp
+    _add_vary(resp)
+    enc = negotiate(request.headers.get("Accept-Encoding", ""))
+    if not enc:
+        return resp
+    data = resp.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return resp
+    out = encode(data, enc)
+    if len(out) >= len(data):
+        return resp
+    resp.set_data(out)
+    resp.headers["Content-Encoding"] = enc
+    etag = resp.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        resp.headers["ETag"] = "W/" + etag   # otra representación: el ETag fuerte ya no aplica
+    with _lock:
+        _stats["compressed"] += 1
+        _stats[enc] += 1
+        _stats["bytes_in"] += len(data)
+        _stats["bytes_out"] += len(out)
+    return resp
+
+# =======================
+# Estáticos con huella
+# =======================
+def static_hash(static_folder: str, filename: str) -> str:
+    """Hash corto del contenido (cacheado por mtime); '' si el archivo no existe."""
+    path = os.path.abspath(os.path.join(static_folder, filename))
+    if not path.startswith(os.path.abspath(static_folder) + os.sep):
+        return ""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return ""
+    with _lock:
+        cached = _hashes.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    digest = h.hexdigest()[:12]
+    with _lock:
+        _hashes[path] = (mtime, digest)
+    return digest
+
+def init_app(app):
+    """Registra la huella en url_for('static') y los hooks de caché + compresión."""
+
+    @app.url_defaults
+    def _static_fingerprint(endpoint, values):
+        if endpoint == "static" and "filename" in values and "v" not in values:
+            v = static_hash(app.static_folder, values["filename"])
+            if v:
+                values["v"] = v
+
+    @app.after_request
+    def _static_cache_and_compress(resp):
+        if request.endpoint == "static" and resp.status_code in (200, 304):
+            v = request.args.get("v", "")
+            if v and v == static_hash(app.static_folder, (request.view_args or {}).get("filename", "")):
+                resp.headers["Cache-Control"] = f"public, max-age={STATIC_MAX_AGE_SEC}, immutable"
+            else:
+                resp.headers["Cache-Control"] = "public, max-age=300"
+        return compress_response(resp)
+
+# =======================
+# Cuerpos constantes precomprimidos
+# =======================
+class Precompressed:
+    """Cuerpo constante con sus variantes br/gzip calculadas una vez (máxima compresión)."""
+
+    def __init__(self, body, content_type: str = "text/html; charset=utf-8", max_age: int = 300):
+        self.raw = body.encode("utf-8") if isinstance(body, str) else body
+        self.content_type = content_type
+        self.max_age = max_age
+        self.etag = 'W/"' + hashlib.md5(self.raw).hexdigest()[:16] + '"'
+        self.variants = {"": self.raw, "gzip": encode(self.raw, "gzip", best=True)}
+        if brotli is not None:
+            self.variants["br"] = encode(self.raw, "br", best=True)
+
+    def response(self):
+        if self.etag in [c.strip() for c in (request.headers.get("If-None-Match") or "").split(",")]:
+            resp = make_response("", 304)
+        else:
+            enc = negotiate(request.headers.get("Accept-Encoding", ""))
+            resp = make_response(self.variants.get(enc, self.raw), 200)
+            resp.headers["Content-Type"] = self.content_type
+            if enc in self.variants and enc:
+                resp.headers["Content-Encoding"] = enc
+        resp.headers["ETag"] = self.etag
+        resp.headers["Cache-Control"] = f"public, max-age={self.max_age}"
+        _add_vary(resp)
+        return resp
+
+def compression_stats() -> dict:
+    with _lock:
+        ratio = round(1 - _stats["bytes_out"] / _stats["bytes_in"], 4) if _stats["bytes_in"] else 0.0
+        return {**_stats, "saved_ratio": ratio, "brotli": brotli is not None, "min_bytes": COMPRESS_MIN_BYTES}
@@ -0,0 +1,358 @@
+# dispatcher.py
+# Despachador frontal con afinidad de conversación para despliegues con varios workers
+# - Hash consistente (anillo con nodos virtuales) de la clave de conversación:
+#     POST /webhook            -> "To|From"  (misma clave_sesion que main.py)
+#     /voice*, /voice-audio/*  -> CallSid    (audios y estado de la llamada viven en un proceso)
+#     /voice-stream/<CallSid>  -> CallSid    (WebSocket realtime en el worker de la llamada)
+#     resto                    -> worker con menos conexiones activas (SSE, panel, billing)
+# - Proxy a nivel TCP (eventlet): pasa WebSockets (/voice-stream) y streams sin tocarlos
+# - Health checks: los workers que caen salen del anillo y sus claves se reparten; al volver, regresan
+# - /_dispatch/stats (Bearer): carga por worker; /_dispatch/nodes (POST, Bearer): alta/baja manual
+#
+# Uso:
+#   python dispatcher.py                      # lanza DISPATCH_WORKERS workers gunicorn locales
+#   DISPATCH_BACKENDS=10.0.0.2:5000,10.0.0.3:5000 python dispatcher.py   # workers externos
+#   (los workers externos deben arrancar con WEB_CONCURRENCY = número total de workers)
+
+import eventlet
+eventlet.monkey_patch()
+
+import bisect
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, unquote
+
+PORT = int(os.environ.get("DISPATCH_PORT") or os.environ.get("PORT") or 5000)
+DISPATCH_WORKERS = int(os.environ.get("DISPATCH_WORKERS") or os.environ.get("WEB_CONCURRENCY") or os.cpu_count() or 1)
+DISPATCH_BASE_PORT = int(os.environ.get("DISPATCH_BASE_PORT", "5101") or 5101)
+DISPATCH_BACKENDS = (os.environ.get("DISPATCH_BACKENDS") or "").strip()
+DISPATCH_VNODES = int(os.environ.get("DISPATCH_VNODES", "160") or 160)
+DISPATCH_HEALTH_SEC = float(os.environ.get("DISPATCH_HEALTH_SEC", "5") or 5)
+DISPATCH_MAX_BODY = int(os.environ.get("DISPATCH_MAX_BODY", str(1024 * 1024)) or 1024 * 1024)
+API_BEARER_TOKEN = (os.environ.get("API_BEARER_TOKEN") or "").strip()
+
+_MAX_HEAD = 64 * 1024
+
+
+def _h(s: str) -> int:
+    return int(hashlib.md5(s.encode("utf-8")).hexdigest()[:16], 16)
+
+# =======================
+# Anillo de hash consistente
+# =======================
+class HashRing:
+    def __init__(self, vnodes: int = DISPATCH_VNODES):
+        self.vnodes = vnodes
+        self._lock = threading.Lock()
+        self._points = []    # hashes ordenados
+        self._owners = []    # nodo de cada punto
+        self._nodes = set()
+
+    def _rebuild(self):
+        pares = sorted((_h(f"{n}#{i}"), n) for n in self._nodes for i in range(self.vnodes))
+        self._points = [p for p, _ in pares]
+        self._owners = [n for _, n in pares]
+
+    def add(self, node: str):
+        with self._lock:
+            if node not in self._nodes:
+                self._nodes.add(node)
+                self._rebuild()
+
+    def remove(self, node: str):
+        with self._lock:
+            if node in self._nodes:
+                self._nodes.discard(node)
+                self._rebuild()
+
+    def node_for(self, key: str):
+        with self._lock:
+            if not self._points:
+                return None
+            i = bisect.bisect(self._points, _h(key)) % len(self._points)
+            return self._owners[i]
+
+    def nodes(self) -> list:
+        with self._lock:
+            return sorted(self._nodes)
+
+# =======================
+# Estado (runtime)
+# =======================
+ring = HashRing()
+_lock = threading.Lock()
+_workers = {}   # "host:port" -> {"up": bool, "active": int, "requests": int, "affinity": int, "errors": int, "proc": Popen|None}
+_stats = {"requests": 0, "no_backend": 0, "rebalances": 0}
+
+
+def _add_worker(addr: str, proc=None):
+    with _lock:
+        _workers.setdefault(addr, {"up": False, "active": 0, "requests": 0, "affinity": 0, "errors": 0, "proc": proc})
+
+def _set_up(addr: str, up: bool):
+    with _lock:
+        w = _workers.get(addr)
+        if not w or w["up"] == up:
+            return
+        w["up"] = up
+        _stats["rebalances"] += 1
+    (ring.add if up else ring.remove)(addr)
+    print(f"[dispatcher] Worker {addr} {'⬆️ en el anillo' if up else '⬇️ fuera del anillo'} ({len(ring.nodes())} activos)")
+
+def _least_loaded():
+    with _lock:
+        vivos = [(w["active"], addr) for addr, w in _workers.items() if w["up"]]
+    return min(vivos)[1] if vivos else None
+
+def dispatch_stats() -> dict:
+    with _lock:
+        workers = {a: {k: v for k, v in w.items() if k != "proc"} for a, w in _workers.items()}
+        return {"workers": workers, "ring_nodes": ring.nodes(), "vnodes": ring.vnodes, **_stats}
+
+# =======================
+# Workers locales (gunicorn -w 1 por puerto) y health checks
+# =======================
+def _spawn_local(port: int):
+    cmd = [sys.executable, "-m", "gunicorn", "-k", "eventlet", "-w", "1", "-b", f"127.0.0.1:{port}", "main:app"]
+    # Cada worker es "-w 1", pero la app debe saber que hay varios procesos: http_cache y search_index
+    # se desactivan con WEB_CONCURRENCY > 1 si su estado no es compartido
+    return subprocess.Popen(cmd, env={**os.environ, "WEB_CONCURRENCY": str(DISPATCH_WORKERS)})
+
+def _probe(addr: str) -> bool:
+    host, port = addr.rsplit(":", 1)
+    try:
+        s = eventlet.connect((host, int(port)))
+        s.settimeout(3)
+        s.sendall(f"GET /billing/health HTTP/1.1\r\nHost: {addr}\r\nConnection: close\r\n\r\n".encode("ascii"))
+        head = s.recv(64)
+        s.close()
+        return head.startswith(b"HTTP/1.") and head[9:10] in (b"2", b"3")
+    except Exception:
+        return False
+
+def _check_worker(addr: str):
+    with _lock:
+        w = _workers.get(addr)
+        proc = w["proc"] if w else None
+    if w is None:
+        return   # dado de baja por /_dispatch/nodes durante la vuelta
+    if proc is not None and proc.poll() is not None:
+        # Worker local muerto: fuera del anillo y relanzado en el mismo puerto
+        _set_up(addr, False)
+        print(f"[dispatcher] ⚠️ Worker {addr} terminó (code {proc.returncode}); relanzando")
+        nuevo = _spawn_local(int(addr.rsplit(":", 1)[1]))
+        with _lock:
+            w = _workers.get(addr)
+            if w is not None:
+                w["proc"] = nuevo
+                return
+        nuevo.terminate()   # se dio de baja mientras se relanzaba
+        return
+    _set_up(addr, _probe(addr))
+
+def _health_loop():
+    while True:
+        for addr in list(_workers.keys()):
+            try:
+                _check_worker(addr)
+            except Exception as e:
+                print(f"[dispatcher] ⚠️ Health check de {addr} falló: {e}")
+        eventlet.sleep(DISPATCH_HEALTH_SEC)
+
+# =======================
+# Clave de afinidad
+# =======================
+def _routing_key(method: str, path: str, headers: dict, body: bytes) -> str:
+    ruta, _, query = path.partition("?")
+    form = {}
+    if body and "application/x-www-form-urlencoded" in headers.get("content-type", ""):
+        form = parse_qs(body.decode("utf-8", "replace"))
+    args = parse_qs(query)
+
+    def _f(name):
+        return (form.get(name) or args.get(name) or [""])[0]
+
+    if ruta.startswith("/voice-audio/"):
+        return "call:" + unquote(ruta[len("/voice-audio/"):]).split("_", 1)[0]
+    if ruta.startswith("/voice-stream/"):
+        sid = unquote(ruta[len("/voice-stream/"):]).strip("/")
+        return f"call:{sid}" if sid else ""
+    if ruta.startswith("/voice"):
+        sid = _f("CallSid")
+        return f"call:{sid}" if sid else ""
+    if ruta == "/webhook" and method == "POST":
+        to, frm = _f("To"), _f("From")
+        return f"{to}|{frm}" if (to or frm) else ""
+    return ""
+
+# =======================
+# Proxy
+# =======================
+def _read_head(sock):
+    buf = b""
+    while b"\r\n\r\n" not in buf:
+        chunk = sock.recv(8192)
+        if not chunk:
+            return None, b""
+        buf += chunk
+        if len(buf) > _MAX_HEAD:
+            return None, b""
+    head, _, rest = buf.partition(b"\r\n\r\n")
+    return head, rest
+
+def _parse_head(head: bytes):
+    lines = head.decode("latin-1").split("\r\n")
+    method, path, _ = (lines[0].split(" ", 2) + ["", ""])[:3]
+    headers = {}
+    for line in lines[1:]:
+        k, _, v = line.partition(":")
+        headers[k.strip().lower()] = v.strip()
+    return method, path, headers, lines
+
+def _rewrite_head(lines: list, headers: dict, client_ip: str) -> bytes:
+    """Una petición por conexión (afinidad por petición) y X-Forwarded-For."""
+    upgrade = "upgrade" in headers.get("connection", "").lower()
+    out = [lines[0]]
+    for line in lines[1:]:
+        k = line.partition(":")[0].strip().lower()
+        if k == "connection" and not upgrade:
+            continue
+        if k == "x-forwarded-for":
+            continue
+        out.append(line)
+    if not upgrade:
+        out.append("Connection: close")
+    xff = headers.get("x-forwarded-for")
+    out.append(f"X-Forwarded-For: {xff + ', ' if xff else ''}{client_ip}")
+    return ("\r\n".join(out) + "\r\n\r\n").encode("latin-1")
+
+def _pipe(src, dst):
+    try:
+        while True:
+            data = src.recv(65536)
+            if not data:
+                break
+            dst.sendall(data)
+    except Exception:
+        pass
+    finally:
+        try:
+            dst.shutdown(1)
+        except Exception:
+            pass
+
+def _respond(sock, status: str, payload: dict):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    sock.sendall(
+        f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii")
+        + body
+    )
+
+def _admin(sock, method: str, path: str, headers: dict, body: bytes):
+    if not API_BEARER_TOKEN or headers.get("authorization", "") != f"Bearer {API_BEARER_TOKEN}":
+        return _respond(sock, "401 Unauthorized", {"error": "No autenticado"})
+    if path.startswith("/_dispatch/stats"):
+        return _respond(sock, "200 OK", dispatch_stats())
+    if path.startswith("/_dispatch/nodes") and method == "POST":
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            data = {}
+        addr = (data.get("addr") or "").strip()
+        if not addr or data.get("action") not in ("add", "remove"):
+            return _respond(sock, "400 Bad Request", {"error": "addr y action=add|remove requeridos"})
+        if data["action"] == "add":
+            _add_worker(addr)
+            _set_up(addr, _probe(addr))
+        else:
+            _set_up(addr, False)
+            with _lock:
+                _workers.pop(addr, None)
+        return _respond(sock, "200 OK", {"ok": True, "ring_nodes": ring.nodes()})
+    return _respond(sock, "404 Not Found", {"error": "No encontrado"})
+
+def _handle(client, client_addr):
+    backend = None
+    addr = None
+    try:
+        head, rest = _read_head(client)
+        if head is None:
+            return
+        method, path, headers, lines = _parse_head(head)
+
+        # Cuerpo (solo formularios pequeños con Content-Length) para leer To/From/CallSid
+        body = rest
+        length = int(headers.get("content-length") or 0)
+        if length and length <= DISPATCH_MAX_BODY:
+            while len(body) < length:
+                chunk = client.recv(min(65536, length - len(body)))
+                if not chunk:
+                    break
+                body += chunk
+
+        if path.startswith("/_dispatch/"):
+            return _admin(client, method, path, headers, body)
+
+        key = _routing_key(method, path, headers, body if length <= DISPATCH_MAX_BODY else b"")
+        addr = ring.node_for(key) if key else _least_loaded()
+        with _lock:
+            _stats["requests"] += 1
+            if addr is None:
+                _stats["no_backend"] += 1
+            else:
+                w = _workers.get(addr)
+                if w:
+                    w["active"] += 1
+                    w["requests"] += 1
+                    w["affinity"] += 1 if key else 0
+        if addr is None:
+            return _respond(client, "503 Service Unavailable", {"error": "Sin workers disponibles"})
+
+        host, port = addr.rsplit(":", 1)
+        backend = eventlet.connect((host, int(port)))
+        backend.sendall(_rewrite_head(lines, headers, client_addr[0]) + body)
+        # Cliente -> worker (resto del cuerpo / frames WS) en un greenlet; worker -> cliente aquí
+        eventlet.spawn_n(_pipe, client, backend)
+        _pipe(backend, client)
+    except Exception as e:
+        print(f"[dispatcher] ⚠️ Error proxy hacia {addr}: {e}")
+        with _lock:
+            if addr in _workers:
+                _workers[addr]["errors"] += 1
+    finally:
+        if addr is not None:
+            with _lock:
+                if addr in _workers:
+                    _workers[addr]["active"] -= 1
+        for s in (backend, client):
+            if s is not None:
+                try:
+                    s.close()
+                except Exception:
+                    pass
+
+def main():
+    if DISPATCH_BACKENDS:
+        for addr in [a.strip() for a in DISPATCH_BACKENDS.split(",") if a.strip()]:
+            _add_worker(addr)
+    else:
+        for i in range(DISPATCH_WORKERS):
+            port = DISPATCH_BASE_PORT + i
+            _add_worker(f"127.0.0.1:{port}", _spawn_local(port))
+    eventlet.spawn_n(_health_loop)
+
+    server = eventlet.listen(("0.0.0.0", PORT))
+    print(f"[dispatcher] Escuchando en :{PORT} -> {list(_workers.keys())}")
+    pool = eventlet.GreenPool(10000)
+    while True:
+        client, client_addr = server.accept()
+        pool.spawn_n(_handle, client, client_addr)
+
+
+if __name__ == "__main__":
+    main()
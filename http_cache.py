@@ -0,0 +1,106 @@
+# http_cache.py
+# GET condicional (ETag / If-None-Match) para las APIs JSON que se consultan por polling
+# - Los ETag salen de contadores de versión (en el backend de estado: compartidos entre workers)
+#   que se incrementan en cada escritura (lead, lista de leads, uso de billing): si no cambió
+#   nada, 304 SIN leer Firebase
+# - El ETag incluye una ventana de tiempo (HTTP_ETAG_MAX_AGE_SEC) que acota lo que puede quedar
+#   obsoleto si otro proceso escribe sin que este se entere
+# - Requiere STATE_BACKEND compartido (sqlite/redis) con más de un worker: con "memory" cada proceso
+#   solo ve sus propios bumps y respondería 304 con datos viejos. Con memory y WEB_CONCURRENCY > 1
+#   el GET condicional se desactiva (siempre 200, sin ETag) y se avisa al arrancar
+# - Hit ratio por endpoint para medir el ahorro
+
+from flask import request, jsonify, make_response
+from state_backend import state
+import os
+import time
+import uuid
+import hashlib
+import threading
+
+HTTP_ETAG_MAX_AGE_SEC = int(os.environ.get("HTTP_ETAG_MAX_AGE_SEC", "60") or 60)
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1") or 1)
+HTTP_ETAG_ENABLED = state.name != "memory" or WEB_CONCURRENCY <= 1
+if not HTTP_ETAG_ENABLED:
+    print(f"[http_cache] ⚠️ STATE_BACKEND=memory con WEB_CONCURRENCY={WEB_CONCURRENCY}: versiones no compartidas, GET condicional desactivado.")
+
+_lock = threading.Lock()
+# Con backend en memoria, un reinicio pierde los contadores: el nonce invalida los ETag anteriores
+_boot = uuid.uuid4().hex[:8] if state.name == "memory" else "shared"
+_stats = {}                    # endpoint -> {"hits": int, "misses": int}
+
+# =======================
+# Versiones
+# =======================
+def lead_keys(bot: str, numero: str):
+    """Claves afectadas por un cambio en un lead: el lead, la lista de su bot y la lista global."""
+    return (f"lead:{bot}:{numero}", f"leads:{bot}", "leads:*")
+
+def bump(*keys):
+    for k in keys:
+        try:
+            state.incr("etag", k)
+        except Exception as e:
+            print(f"[http_cache] ⚠️ No se pudo incrementar versión {k}: {e}")
+
+def bump_lead(bot: str, numero: str):
+    bump(*lead_keys(bot, numero))
+
+def version_of(*keys) -> str:
+    try:
+        vals = state.get_many("etag", keys)
+    except Exception:
+        return uuid.uuid4().hex   # backend caído: ETag irrepetible => nunca 304 obsoleto
+    return ".".join(str(v or 0) for v in vals)
+
+def make_etag(endpoint: str, keys=(), parts=(), window_sec: int = None) -> str:
+    """ETag débil a partir de endpoint + parámetros + versiones + ventana de tiempo."""
+    window = HTTP_ETAG_MAX_AGE_SEC if window_sec is None else window_sec
+    bucket = int(time.time() // window) if window and window > 0 else 0
+    raw = "|".join([_boot, endpoint, version_of(*keys), str(bucket)] + [str(p) for p in parts])
+    return 'W/"' + hashlib.md5(raw.encode("utf-8")).hexdigest() + '"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match or not HTTP_ETAG_ENABLED:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or etag.replace('W/', '', 1) in candidates
+
+def record(endpoint: str, hit: bool):
+    with _lock:
+        st = _stats.setdefault(endpoint, {"hits": 0, "misses": 0})
+        st["hits" if hit else "misses"] += 1
+
+def http_cache_stats() -> dict:
+    with _lock:
+        out = {}
+        for ep, st in _stats.items():
+            total = st["hits"] + st["misses"]
+            out[ep] = {**st, "hit_ratio": round(st["hits"] / total, 4) if total else 0.0}
+        return {"endpoints": out, "backend": state.name, "enabled": HTTP_ETAG_ENABLED}
+
+# =======================
+# Helper Flask
+# =======================
+def conditional_json(endpoint: str, etag: str, build):
+    """
+    Si el cliente ya tiene 'etag' => 304 sin ejecutar build(). Si no, build() produce
+    (payload) o (payload, status) y se responde con el ETag.
+    """
+    if etag_matches(request.headers.get("If-None-Match", ""), etag):
+        record(endpoint, True)
+        resp = make_response("", 304)
+        resp.headers["ETag"] = etag
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
+
+    record(endpoint, False)
+    out = build()
+    status = 200
+    if isinstance(out, tuple):
+        out, status = out
+    resp = make_response(jsonify(out), status)
+    if status == 200 and HTTP_ETAG_ENABLED:
+        resp.headers["ETag"] = etag
+        resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
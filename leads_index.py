@@ -0,0 +1,342 @@
+# leads_index.py
+# Índice plano y ordenado de leads para listar sin descargar el árbol completo
+# - leads_index/<bot|numero> guarda solo el resumen del lead (sin historial) + claves de orden
+# - Claves compuestas (texto con ceros a la izquierda) => orden total y cursor estable:
+#     k_seen      = "<last_seen_ms>|<bot>|<numero>"
+#     k_bot_seen  = "<bot>|<last_seen_ms>|<numero>"
+#     k_msgs      = "<messages>|<last_seen_ms>|<bot>|<numero>"
+#     k_bot_msgs  = "<bot>|<messages>|<last_seen_ms>|<numero>"
+# - Reglas de RTDB necesarias:
+#     "leads_index": {".indexOn": ["k_seen", "k_bot_seen", "k_msgs", "k_bot_msgs"]}
+# - Sin índice en las reglas, query_leads cae a leer leads_index completo (sigue sin historial)
+# - leads_index_meta/version marca un índice completo; si falta o es de otra versión, ensure_index()
+#   lo reconstruye al arrancar (un solo worker, reclamado por transacción) y mientras tanto las
+#   consultas se resuelven desde leads/ (lento, pero sin perder leads)
+
+from datetime import datetime
+import os
+import threading
+import time
+import uuid
+
+from firebase_admin import db
+
+LEADS_PAGE_MAX = int(os.environ.get("LEADS_PAGE_MAX", "200") or 200)
+LEADS_SCAN_PAGES = int(os.environ.get("LEADS_SCAN_PAGES", "5") or 5)   # páginas extra a escanear con filtro de estado
+_LAST_MESSAGE_MAX = 200
+
+_SORTS = ("last_seen", "messages")
+
+INDEX_VERSION = 1   # subir si cambia index_entry(): fuerza una reconstrucción al arrancar
+LEADS_INDEX_BUILD_STALE_SEC = int(os.environ.get("LEADS_INDEX_BUILD_STALE_SEC", "1800") or 1800)
+_READY_RECHECK_SEC = 30
+_ready = {"ok": False, "checked": 0.0}
+
+
+def _seen_ms(hora: str) -> int:
+    try:
+        return int(datetime.strptime(hora or "", "%Y-%m-%d %H:%M:%S").timestamp() * 1000)
+    except Exception:
+        return 0
+
+def _day_ms(ymd: str, end: bool = False) -> int:
+    """'YYYY-MM-DD' -> epoch ms del inicio (o del final) del día; 0 si vacío/inválido."""
+    try:
+        d = datetime.strptime((ymd or "").strip(), "%Y-%m-%d")
+    except ValueError:
+        return 0
+    ms = int(d.timestamp() * 1000)
+    return ms + 86400000 - 1 if end else ms
+
+def index_key(bot: str, numero: str) -> str:
+    return f"{bot}|{numero}"
+
+def _index_ref(key: str = ""):
+    return db.reference(f"leads_index/{key}" if key else "leads_index")
+
+def _meta_ref():
+    return db.reference("leads_index_meta")
+
+def index_ready() -> bool:
+    """True cuando leads_index_meta marca un índice completo de la versión actual (se re-consulta cada 30 s)."""
+    if _ready["ok"]:
+        return True
+    now = time.time()
+    if now - _ready["checked"] < _READY_RECHECK_SEC:
+        return False
+    _ready["checked"] = now
+    try:
+        meta = _meta_ref().get() or {}
+    except Exception as e:
+        print(f"[leads_index] ⚠️ No se pudo leer leads_index_meta: {e}")
+        return False
+    _ready["ok"] = isinstance(meta, dict) and meta.get("version") == INDEX_VERSION
+    return _ready["ok"]
+
+def index_entry(bot: str, numero: str, lead: dict) -> dict:
+    """Resumen indexable de un lead (mismo formato que fb_list_leads_*) + claves de orden."""
+    lead = lead or {}
+    last_seen = lead.get("last_seen", "") or ""
+    messages = int(lead.get("messages", 0) or 0)
+    seen = f"{_seen_ms(last_seen):013d}"
+    msgs = f"{messages:09d}"
+    return {
+        "bot": bot,
+        "numero": numero,
+        "first_seen": lead.get("first_seen", ""),
+        "last_message": (lead.get("last_message", "") or "")[:_LAST_MESSAGE_MAX],
+        "last_seen": last_seen,
+        "messages": messages,
+        "status": lead.get("status", "nuevo"),
+        "notes": lead.get("notes", ""),
+        "k_seen": f"{seen}|{bot}|{numero}",
+        "k_bot_seen": f"{bot}|{seen}|{numero}",
+        "k_msgs": f"{msgs}|{seen}|{bot}|{numero}",
+        "k_bot_msgs": f"{bot}|{msgs}|{seen}|{numero}",
+    }
+
+def index_paths(bot: str, numero: str, lead: dict) -> dict:
+    """Rutas para una escritura multi-path junto con el propio lead (lead=None => borrar)."""
+    path = f"leads_index/{index_key(bot, numero)}"
+    return {path: index_entry(bot, numero, lead) if lead is not None else None}
+
+def index_upsert(bot: str, numero: str, lead: dict):
+    try:
+        _index_ref(index_key(bot, numero)).set(index_entry(bot, numero, lead))
+    except Exception as e:
+        print(f"[leads_index] ⚠️ No se pudo indexar {bot}/{numero}: {e}")
+
+def index_remove(bot: str, numero: str):
+    try:
+        _index_ref(index_key(bot, numero)).delete()
+    except Exception as e:
+        print(f"[leads_index] ⚠️ No se pudo quitar del índice {bot}/{numero}: {e}")
+
+# =======================
+# Consulta
+# =======================
+def _sort_field(sort: str, bot: str) -> str:
+    if sort == "messages":
+        return "k_bot_msgs" if bot else "k_msgs"
+    return "k_bot_seen" if bot else "k_seen"
+
+def _bounds(field: str, bot: str, date_from: str, date_to: str):
+    """Rango [lo, hi] sobre la clave de orden (prefijo de bot y, si se ordena por fecha, rango de días)."""
+    prefix = f"{bot}|" if bot else ""
+    lo, hi = prefix, prefix + "\uf8ff"
+    if field in ("k_seen", "k_bot_seen"):
+        d1, d2 = _day_ms(date_from), _day_ms(date_to, end=True)
+        if d1:
+            lo = f"{prefix}{d1:013d}"
+        if d2:
+            hi = f"{prefix}{d2:013d}|\uf8ff"
+    return lo, hi
+
+def _matches(entry: dict, bot: str, status: str, date_from: str, date_to: str) -> bool:
+    if bot and entry.get("bot") != bot:
+        return False
+    if status and (entry.get("status") or "nuevo") != status:
+        return False
+    seen = _seen_ms(entry.get("last_seen", ""))
+    d1, d2 = _day_ms(date_from), _day_ms(date_to, end=True)
+    if d1 and seen < d1:
+        return False
+    if d2 and seen > d2:
+        return False
+    return True
+
+def _fetch_chunk(field: str, lo: str, hi: str, cursor: str, n: int, desc: bool) -> list:
+    """Hasta n entradas estrictamente después del cursor en el sentido pedido."""
+    q = _index_ref().order_by_child(field)
+    if desc:
+        hi = cursor if cursor and cursor < hi else hi
+        data = q.start_at(lo).end_at(hi).limit_to_last(n + 1).get() or {}
+    else:
+        lo = cursor if cursor and cursor > lo else lo
+        data = q.start_at(lo).end_at(hi).limit_to_first(n + 1).get() or {}
+    rows = [v for v in (data.values() if isinstance(data, dict) else data) if isinstance(v, dict)]
+    rows.sort(key=lambda v: v.get(field, ""), reverse=desc)
+    rows = [v for v in rows if v.get(field, "") != cursor]
+    return rows[:n]
+
+def _entries_from_leads(bot: str = "") -> list:
+    """Entradas calculadas desde leads/ (descarga historiales): solo mientras el índice no está construido."""
+    root = db.reference(f"leads/{bot}" if bot else "leads").get() or {}
+    if not isinstance(root, dict):
+        return []
+    por_bot = {bot: root} if bot else root
+    rows = []
+    for b, numeros in por_bot.items():
+        if not isinstance(numeros, dict):
+            continue
+        for numero, lead in numeros.items():
+            if isinstance(lead, dict):
+                rows.append(index_entry(b, numero, lead))
+    return rows
+
+def _query_fallback(field: str, lo: str, hi: str, cursor: str, desc: bool, rows=None) -> list:
+    if rows is None:
+        data = _index_ref().get() or {}
+        rows = data.values() if isinstance(data, dict) else []
+    rows = [v for v in rows if isinstance(v, dict) and lo <= v.get(field, "") <= hi]
+    rows.sort(key=lambda v: v.get(field, ""), reverse=desc)
+    if cursor:
+        rows = [v for v in rows if (v.get(field, "") < cursor if desc else v.get(field, "") > cursor)]
+    return rows
+
+def _public(entry: dict) -> dict:
+    return {k: v for k, v in entry.items() if not k.startswith("k_")}
+
+def query_leads(bot: str = "", status: str = "", date_from: str = "", date_to: str = "",
+                sort: str = "last_seen", order: str = "desc", limit: int = 50, cursor: str = "",
+                allowed=None) -> dict:
+    """
+    Página de leads ordenada por 'last_seen' o 'messages'. Devuelve {"leads": [...], "next_cursor": str|None}.
+    'cursor' es la clave de orden del último lead de la página anterior (opaco para el cliente).
+    'allowed' (lista de bots) restringe el resultado cuando no se filtra por un bot concreto.
+    """
+    sort = sort if sort in _SORTS else "last_seen"
+    desc = (order or "desc").lower() != "asc"
+    limit = max(1, min(int(limit or 50), LEADS_PAGE_MAX))
+    field = _sort_field(sort, bot)
+    lo, hi = _bounds(field, bot, date_from, date_to)
+    allowed_set = set(allowed) if allowed is not None else None
+
+    def _keep(e):
+        return _matches(e, bot, status, date_from, date_to) and (allowed_set is None or e.get("bot") in allowed_set)
+
+    if not index_ready():
+        rows = [r for r in _query_fallback(field, lo, hi, cursor, desc, _entries_from_leads(bot)) if _keep(r)]
+        out = rows[:limit]
+        return {"leads": [_public(e) for e in out], "next_cursor": out[-1].get(field) if len(rows) > limit else None}
+
+    out = []
+    try:
+        # Filtros que no forman parte de la clave (estado, fechas con orden por mensajes, alcance):
+        # se escanean trozos sucesivos hasta llenar la página o agotar LEADS_SCAN_PAGES
+        # Se busca una fila de más: solo hay next_cursor si de verdad queda algo detrás de la página
+        n = limit + 1
+        scan_cursor = cursor
+        exhausted = False
+        for _ in range(1 + LEADS_SCAN_PAGES):
+            chunk = _fetch_chunk(field, lo, hi, scan_cursor, n, desc)
+            for e in chunk:
+                scan_cursor = e.get(field, "")
+                if _keep(e):
+                    out.append(e)
+                    if len(out) > limit:
+                        break
+            if len(out) > limit:
+                break
+            if len(chunk) < n:
+                exhausted = True
+                break
+        if len(out) > limit:
+            out = out[:limit]
+            next_cursor = out[-1].get(field)
+        else:
+            # Presupuesto de escaneo agotado sin llenar la página: seguir desde lo ya recorrido
+            next_cursor = None if exhausted else scan_cursor
+    except Exception as e:
+        print(f"[leads_index] ⚠️ Consulta ordenada falló (¿falta .indexOn?), leyendo índice completo: {e}")
+        rows = [r for r in _query_fallback(field, lo, hi, cursor, desc) if _keep(r)]
+        out = rows[:limit]
+        next_cursor = out[-1].get(field) if len(rows) > limit else None
+
+    return {"leads": [_public(e) for e in out], "next_cursor": next_cursor}
+
+def bot_summaries(bot: str) -> dict:
+    """{numero: entrada del índice} de un bot en una sola lectura (sin historiales)."""
+    if not index_ready():
+        return {e["numero"]: e for e in _entries_from_leads(bot)}
+    field = _sort_field("last_seen", bot)
+    try:
+        data = _index_ref().order_by_child(field).start_at(f"{bot}|").end_at(f"{bot}|\uf8ff").get() or {}
+    except Exception as e:
+        print(f"[leads_index] ⚠️ Consulta por bot falló (¿falta .indexOn?), leyendo índice completo: {e}")
+        data = {k: v for k, v in (_index_ref().get() or {}).items() if isinstance(v, dict) and v.get("bot") == bot}
+    rows = data.values() if isinstance(data, dict) else data
+    return {v["numero"]: v for v in rows if isinstance(v, dict) and v.get("numero")}
+
+def iter_leads(page_size: int = LEADS_PAGE_MAX, **filtros):
+    """Recorre todas las páginas de query_leads (memoria acotada a una página)."""
+    cursor = ""
+    while True:
+        page = query_leads(limit=page_size, cursor=cursor, **filtros)
+        for lead in page["leads"]:
+            yield lead
+        cursor = page["next_cursor"]
+        if not cursor:
+            return
+
+def leads_page_dict(page: dict) -> dict:
+    """Página en el formato {'bot|numero': lead} que usan las plantillas del panel."""
+    return {index_key(l["bot"], l["numero"]): l for l in page.get("leads", [])}
+
+# =======================
+# Reconstrucción
+# =======================
+def rebuild_index() -> int:
+    """Reconstruye leads_index desde leads/ (bot por bot). Devuelve cuántos leads se indexaron."""
+    bots = db.reference("leads").get(shallow=True) or {}
+    total = 0
+    vivos = set()
+    for bot in sorted(bots.keys()):
+        numeros = db.reference(f"leads/{bot}").get() or {}
+        if not isinstance(numeros, dict):
+            continue
+        cambios = {}
+        for numero, lead in numeros.items():
+            if isinstance(lead, dict):
+                cambios[index_key(bot, numero)] = index_entry(bot, numero, lead)
+                vivos.add(index_key(bot, numero))
+        if cambios:
+            _index_ref().update(cambios)   # una escritura multi-path por bot
+            total += len(cambios)
+    # Entradas huérfanas (leads borrados fuera de la app)
+    existentes = _index_ref().get(shallow=True) or {}
+    huerfanas = {k: None for k in existentes.keys() if k not in vivos}
+    if huerfanas:
+        _index_ref().update(huerfanas)
+    _meta_ref().set({"version": INDEX_VERSION, "built_at": datetime.utcnow().isoformat() + "Z", "leads": total})
+    _ready["ok"] = True
+    return total
+
+def ensure_index():
+    """
+    Arranque: si leads_index_meta no marca la versión actual, reclama la reconstrucción con una transacción
+    (un solo worker la hace; se puede volver a reclamar pasados LEADS_INDEX_BUILD_STALE_SEC) y la lanza en
+    segundo plano. Hasta que termine, query_leads/bot_summaries leen desde leads/.
+    """
+    token = uuid.uuid4().hex
+    now = time.time()
+
+    def _claim(cur):
+        cur = cur if isinstance(cur, dict) else {}
+        if cur.get("version") == INDEX_VERSION:
+            return cur
+        if float(cur.get("building_since", 0) or 0) > now - LEADS_INDEX_BUILD_STALE_SEC:
+            return cur
+        return {**cur, "building_since": now, "builder": token}
+
+    try:
+        meta = _meta_ref().transaction(_claim) or {}
+    except Exception as e:
+        print(f"[leads_index] ⚠️ No se pudo reclamar la reconstrucción del índice: {e}")
+        return
+    if meta.get("version") == INDEX_VERSION:
+        _ready["ok"] = True
+        return
+    if meta.get("builder") != token:
+        print("[leads_index] Otro worker está construyendo leads_index; se lee desde leads/ mientras tanto.")
+        return
+
+    def _run():
+        try:
+            t0 = time.time()
+            total = rebuild_index()
+            print(f"[leads_index] ✅ Índice construido: {total} leads en {time.time() - t0:.1f}s")
+        except Exception as e:
+            print(f"[leads_index] ❌ Error construyendo leads_index: {e}")
+
+    threading.Thread(target=_run, daemon=True).start()
@@ -6,15 +6,16 @@ import eventlet
 eventlet.monkey_patch()
 
 # Resto de importaciones
-from flask import Flask, request, session, redirect, url_for, send_file, jsonify, render_template, make_response, Response
+from flask import Flask, request, session, redirect, url_for, jsonify, render_template, make_response, Response, stream_with_context
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.twiml.voice_response import VoiceResponse, Gather, Connect
 from openai import OpenAI
 from dotenv import load_dotenv
 import os
+import sys
 import json
 import time
-from threading import Thread
+from threading import Thread, Lock, active_count
 from datetime import datetime, timedelta
 import csv
 from io import StringIO
@@ -22,9 +23,11 @@ import re
 import glob
 import random
 import hashlib
+import hmac
 import html
 import uuid
 import requests
+from urllib.parse import urlencode
 
 
 # 🔹 Twilio REST (para enviar mensajes manuales desde el panel)
@@ -36,17 +39,7 @@ from firebase_admin import credentials, db
 # 🔹 NEW: FCM (para notificaciones push)
 from firebase_admin import messaging as fcm
 
-# Se eliminan las dependencias de WebSocket porque no funcionaban
-# import base64
-# import struct
-# import ssl
-# from threading import Event
-# import urllib.parse
-# try:
-#     from flask_sock import Sock
-#     import websocket
-# except Exception as _e:
-#     pass
+# WebSocket (flask-sock + websocket-client) vive en voice_realtime.py
 
 # =======================
 #  Cargar variables de entorno (Render -> Secret File)
@@ -67,6 +60,13 @@ APP_DOWNLOAD_URL_FALLBACK = (os.environ.get("APP_DOWNLOAD_URL", "").strip())
 # 🔐 NEW (opcional): Bearer para proteger endpoints /push/* y (ahora) API móvil
 API_BEARER_TOKEN = (os.environ.get("API_BEARER_TOKEN") or "").strip()
 
+# Tamaño de página por defecto del listado de leads (panel y /api/leads)
+LEADS_PAGE_SIZE = int(os.environ.get("LEADS_PAGE_SIZE", "50") or 50)
+
+# Operaciones masivas sobre leads (/api/leads/bulk): máximo de items y leads por escritura multi-path
+LEADS_BULK_MAX = int(os.environ.get("LEADS_BULK_MAX", "1000") or 1000)
+LEADS_BULK_CHUNK = int(os.environ.get("LEADS_BULK_CHUNK", "200") or 200)
+
 def _valid_url(u: str) -> bool:
     return isinstance(u, str) and (u.startswith("http://") or u.startswith("https://"))
 
@@ -90,8 +90,9 @@ app.config.update({
 @app.after_request
 def add_cors_headers(resp):
     resp.headers["Access-Control-Allow-Origin"] = "*"
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, If-None-Match"
     resp.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+    resp.headers["Access-Control-Expose-Headers"] = "ETag"
     return resp
 
 def _bearer_ok(req) -> bool:
@@ -141,6 +142,20 @@ if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
 else:
     print("⚠️ TWILIO_ACCOUNT_SID / TWILIO_AUTH_TOKEN no configurados. El envío manual desde panel no funcionará hasta configurarlos.")
 
+# =======================
+#  📈 Métricas Prometheus (/metrics, Bearer): histogramas por etapa + colectores (ver metrics.py)
+# =======================
+from metrics import init_app as metrics_init_app, instrument_firebase, instrument_twilio, observe as metrics_observe, inc as metrics_inc, timer as metrics_timer, histogram as metrics_histogram, counter as metrics_counter, describe as metrics_describe, register_collector, set_request_label
+metrics_init_app(app, auth=_bearer_ok)
+instrument_firebase()
+instrument_twilio()
+
+metrics_histogram("intent_classification_seconds", "Desde el mensaje entrante hasta decidir la rama (agenda, cierre, saludo, llm...) por bot.",
+                  buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+metrics_histogram("openai_request_seconds", "Latencia de chat.completions por modelo, canal (whatsapp/voz) y bot.")
+metrics_histogram("tts_request_seconds", "Latencia de OpenAI TTS (petición + escritura del audio) por voz y tipo (saludo/turno).")
+metrics_counter("openai_tokens_total", "Tokens de OpenAI por modelo, bot y tipo (prompt/completion).")
+
 # =======================
 #  Cargar bots desde carpeta bots/
 # =======================
@@ -164,26 +179,87 @@ if not bots_config:
 # =======================
 #  💡 Registrar la API de facturación (Blueprint)
 # =======================
-from billing_api import billing_bp, record_openai_usage
+from billing_api import billing_bp, record_openai_usage, record_twilio_message, start_rollup_worker, add_twilio_status_hook, billing_cache_stats, price_fetch_stats
 app.register_blueprint(billing_bp, url_prefix="/billing")
+start_rollup_worker()
 
-# 💡 API móvil (JSON público para la app)
-from bots.api_mobile import mobile_bp
-app.register_blueprint(mobile_bp, url_prefix="/api/mobile")
+# 📇 Índice ordenado de leads (listado paginado sin descargar historiales)
+from leads_index import index_paths, query_leads, iter_leads, leads_page_dict, rebuild_index, bot_summaries, ensure_index as leads_index_ensure
+if (os.environ.get("LEADS_INDEX_ON_BOOT", "1") or "1").strip().lower() in ("1", "true", "on", "yes"):
+    leads_index_ensure()
+
+# 🔎 Búsqueda de texto completo en historiales (índice en memoria)
+from search_index import index_message, index_messages, remove_lead, search as search_historial, start_rebuild as search_start_rebuild, rebuild_all as search_rebuild_all, search_stats
+if (os.environ.get("SEARCH_INDEX_ON_BOOT", "1") or "1").strip().lower() in ("1", "true", "on", "yes"):
+    search_start_rebuild()
+
+# 🏷️ GET condicional (ETag por versión) para las APIs de polling
+from http_cache import bump_lead, make_etag, conditional_json, http_cache_stats
+
+# 🗜️ Compresión br/gzip negociada + estáticos con huella (caché de un año)
+from compression import init_app as compression_init_app, compression_stats
+compression_init_app(app)
+
+# 📣 Campañas salientes de WhatsApp (cola persistente, ritmo por número, reintentos)
+from campaigns import init_campaigns, start_campaign_worker, create_campaign, set_state as campaign_set_state, get_campaign, list_campaigns, list_recipients, campaign_stats
+
+# 🔔 Envío FCM por trozos de 500 en paralelo + registro de tokens con poda de muertos
+from push_engine import send_to_tokens, register_token, unregister_tokens, registered_tokens, is_dead_token_error, push_stats
+
+# 📡 Push de chat (SSE) para las vistas de conversación
+from chat_events import publish_message, publish_state, publish_update, publish_reset, sse_stream, chat_events_stats
+
+# ⚡ Voz realtime (Twilio Media Streams <-> modelo realtime)
+from voice_realtime import init_voice_realtime, realtime_enabled, realtime_stream_url, realtime_stats
+
+# 🔊 Almacén de audios de voz (TTL + presupuesto de disco + servido con caché)
+from voice_audio import audio_new_file, audio_register, audio_release_call, audio_response, audio_start_gc, audio_stats
+audio_start_gc()
+
+# 💡 API móvil (JSON público para la app): se registra al final del módulo (usa funciones de main)
 
 
 # =======================
-#  Memorias por sesión (runtime)
+#  Memorias por sesión (backend compartible entre workers/nodos: STATE_BACKEND)
 # =======================
-session_history = {}         # clave_sesion -> mensajes para OpenAI (texto)
-last_message_time = {}       # clave_sesion -> timestamp último mensaje
-follow_up_flags = {}         # clave_sesion -> {"5min": bool, "60min": bool}
-agenda_state = {}            # clave_sesion -> {"awaiting_confirm": bool, "status": str, "last_update": ts, "last_link_time": ts, "last_bot_hash": "", "closed": bool}
-greeted_state = {}           # clave_sesion -> bool (si ya se saludó)
+# Espacios de nombres en el backend (clave = clave_sesion "To|From"):
+#   hist     -> lista de mensajes para OpenAI (texto)
+#   last_msg -> timestamp último mensaje
+#   followup -> {"5min": bool, "60min": bool}
+#   agenda   -> {"awaiting_confirm": bool, "status": str, "last_update": ts, "last_link_time": ts, "last_bot_hash": "", "closed": bool}
+#   greeted  -> bool (si ya se saludó)
+from state_backend import state
+
+def _hist_exists(clave):
+    return state.exists("hist", clave)
+
+def _hist_get(clave):
+    return state.list_get("hist", clave)
+
+def _hist_append(clave, *mensajes):
+    state.list_append("hist", clave, *mensajes)
+
+def _hist_set(clave, mensajes):
+    state.list_set("hist", clave, mensajes)
+
+def _touch_session(clave):
+    state.set("last_msg", clave, time.time())
+
+def _is_greeted(clave) -> bool:
+    return bool(state.get("greeted", clave))
+
+def _set_greeted(clave, valor: bool = True):
+    state.set("greeted", clave, bool(valor))
+
+def _reset_follow_ups(clave):
+    state.set("followup", clave, {"5min": False, "60min": False})
 
 # ✅ CORRECCIÓN: Definición de variables globales para la voz
 voice_call_cache = {}
 voice_conversation_history = {}
+voice_call_meta = {}         # call_sid -> {"bot": str, "numero": str, "started": ts, "last_activity": ts, "turns": [entradas historial]}
+voice_call_finalized = {}    # call_sid -> ts de cierre (los toques tardíos no recrean la llamada)
+_voice_meta_lock = Lock()
 
 
 # =======================
@@ -380,13 +456,13 @@ def _hash_text(s: str) -> str:
     return hashlib.md5((s or "").strip().lower().encode("utf-8")).hexdigest()
 
 def _get_agenda(clave):
-    return agenda_state.get(clave) or {"awaiting_confirm": False, "status": "none", "last_update": 0, "last_link_time": 0, "last_bot_hash": "", "closed": False}
+    return state.get("agenda", clave) or {"awaiting_confirm": False, "status": "none", "last_update": 0, "last_link_time": 0, "last_bot_hash": "", "closed": False}
 
 def _set_agenda(clave, **kw):
     st = _get_agenda(clave)
     st.update(kw)
     st["last_update"] = _now()
-    agenda_state[clave] = st
+    state.set("agenda", clave, st)
     return st
 
 def _can_send_link(clave, cooldown_min=10):
@@ -401,12 +477,51 @@ def _can_send_link(clave, cooldown_min=10):
 def _lead_ref(bot_nombre, numero):
     return db.reference(f"leads/{bot_nombre}/{numero}")
 
+def _lead_write(bot_nombre, numero, lead):
+    """Escribe el lead y su entrada en leads_index en una sola escritura multi-path (lead=None => borrar)."""
+    cambios = {f"leads/{bot_nombre}/{numero}": lead}
+    cambios.update(index_paths(bot_nombre, numero, lead))
+    db.reference().update(cambios)
+
 def fb_get_lead(bot_nombre, numero):
     ref = _lead_ref(bot_nombre, numero)
     data = ref.get()
     return data or {}
 
+def _with_ts(entrada: dict) -> dict:
+    """Toda entrada nueva lleva 'ts' (epoch ms, entero) para poder consultarse por rango."""
+    if isinstance(entrada, dict) and not isinstance(entrada.get("ts"), int):
+        entrada["ts"] = int(time.time() * 1000)
+    return entrada
+
+def _entrada_ts(reg: dict) -> int:
+    ts = (reg or {}).get("ts")
+    if isinstance(ts, (int, float)) and ts > 0:
+        return int(ts)
+    return _hora_to_epoch_ms((reg or {}).get("hora", ""))
+
+def fb_get_historial_since(bot_nombre, numero, since_ms: int = 0):
+    """
+    Historial con ts > since_ms. Con since_ms > 0 usa orderByChild('ts').startAt(since+1):
+    solo viaja el delta. Requiere en las reglas de RTDB:
+      "leads": {"$bot": {"$numero": {"historial": {".indexOn": ["ts"]}}}}
+    Entradas sin 'ts' (anteriores al backfill) solo aparecen en la lectura completa.
+    """
+    ref = _lead_ref(bot_nombre, numero).child("historial")
+    if since_ms > 0:
+        try:
+            data = ref.order_by_child("ts").start_at(int(since_ms) + 1).get() or {}
+            regs = list(data.values()) if isinstance(data, dict) else [r for r in data if r]
+            return sorted((r for r in regs if isinstance(r, dict)), key=_entrada_ts)
+        except Exception as e:
+            print(f"⚠️ Consulta por ts falló (¿falta .indexOn?), leyendo historial completo: {e}")
+    historial = ref.get() or []
+    if isinstance(historial, dict):
+        historial = [historial[k] for k in sorted(historial.keys())]
+    return [r for r in historial if isinstance(r, dict) and _entrada_ts(r) > since_ms]
+
 def fb_append_historial(bot_nombre, numero, entrada):
+    _with_ts(entrada)
     ref = _lead_ref(bot_nombre, numero)
     lead = ref.get() or {}
     historial = lead.get("historial", [])
@@ -421,7 +536,39 @@ def fb_append_historial(bot_nombre, numero, entrada):
     lead.setdefault("numero", numero)
     lead.setdefault("status", "nuevo")
     lead.setdefault("notes", "")
-    ref.set(lead)
+    _lead_write(bot_nombre, numero, lead)
+    bump_lead(bot_nombre, numero)
+    index_message(bot_nombre, numero, entrada)
+    publish_message(bot_nombre, numero, entrada, len(historial) - 1)
+    return len(historial) - 1
+
+def fb_append_historial_batch(bot_nombre, numero, entradas):
+    """Como fb_append_historial pero con varias entradas en una sola lectura + escritura."""
+    entradas = [_with_ts(e) for e in (entradas or []) if isinstance(e, dict)]
+    if not entradas:
+        return
+    ref = _lead_ref(bot_nombre, numero)
+    lead = ref.get() or {}
+    historial = lead.get("historial", [])
+    if isinstance(historial, dict):
+        historial = [historial[k] for k in sorted(historial.keys())]
+    historial.extend(entradas)
+    ultima = entradas[-1]
+    lead["historial"] = historial
+    lead["last_message"] = ultima.get("texto", "")
+    lead["last_seen"] = ultima.get("hora", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    lead["messages"] = int(lead.get("messages", 0)) + len(entradas)
+    lead.setdefault("first_seen", entradas[0].get("hora", lead["last_seen"]))
+    lead.setdefault("bot", bot_nombre)
+    lead.setdefault("numero", numero)
+    lead.setdefault("status", "nuevo")
+    lead.setdefault("notes", "")
+    _lead_write(bot_nombre, numero, lead)
+    bump_lead(bot_nombre, numero)
+    index_messages(bot_nombre, numero, entradas)
+    base = len(historial) - len(entradas)
+    for i, entrada in enumerate(entradas):
+        publish_message(bot_nombre, numero, entrada, base + i)
 
 def fb_list_leads_all():
     root = db.reference("leads").get() or {}
@@ -467,7 +614,11 @@ def fb_list_leads_by_bot(bot_nombre):
 # ✅ NUEVO: eliminar lead completo
 def fb_delete_lead(bot_nombre, numero):
     try:
-        _lead_ref(bot_nombre, numero).delete()
+        _lead_write(bot_nombre, numero, None)
+        _msg_status_ref(bot_nombre, numero).delete()
+        bump_lead(bot_nombre, numero)
+        remove_lead(bot_nombre, numero)
+        publish_reset(bot_nombre, numero)
         return True
     except Exception as e:
         print(f"❌ Error eliminando lead {bot_nombre}/{numero}: {e}")
@@ -486,12 +637,109 @@ def fb_clear_historial(bot_nombre, numero):
         lead.setdefault("notes", "")
         lead.setdefault("bot", bot_nombre)
         lead.setdefault("numero", numero)
-        ref.set(lead)
+        _lead_write(bot_nombre, numero, lead)
+        _msg_status_ref(bot_nombre, numero).delete()
+        bump_lead(bot_nombre, numero)
+        remove_lead(bot_nombre, numero)
+        publish_reset(bot_nombre, numero)
         return True
     except Exception as e:
         print(f"❌ Error vaciando historial {bot_nombre}/{numero}: {e}")
         return False
 
+# ✅ NUEVO: operaciones masivas (estado / notas / borrar / vaciar) con escrituras multi-path
+_BULK_OPS = ("status", "notes", "delete", "clear")
+
+def fb_bulk_leads(items):
+    """
+    items: [{"bot", "numero", "op", "value"}] ya validados (op en _BULK_OPS).
+    Lecturas: una shallow de leads/<bot> (existencia) + una del índice por bot (resúmenes, sin historiales).
+    Escrituras: una multi-path por cada LEADS_BULK_CHUNK leads (lead + leads_index, atómica por trozo).
+    Devuelve un resultado por item, en el mismo orden.
+    """
+    results = [None] * len(items)
+    por_bot = {}
+    for i, it in enumerate(items):
+        por_bot.setdefault(it["bot"], []).append(i)
+
+    def _res(i, ok, error=""):
+        it = items[i]
+        out = {"bot": it["bot"], "numero": it["numero"], "op": it["op"], "ok": ok}
+        if error:
+            out["error"] = error
+        results[i] = out
+
+    planes = {}   # (bot, numero) -> plan de escritura
+    for bot, idxs in por_bot.items():
+        try:
+            existentes = db.reference(f"leads/{bot}").get(shallow=True) or {}
+            resumenes = bot_summaries(bot) if any(items[i]["op"] != "delete" for i in idxs) else {}
+        except Exception as e:
+            print(f"❌ Bulk: error leyendo leads de {bot}: {e}")
+            for i in idxs:
+                _res(i, False, "error")
+            continue
+        for i in idxs:
+            numero, op = items[i]["numero"], items[i]["op"]
+            plan = planes.get((bot, numero))
+            if plan is None:
+                if numero not in existentes:
+                    _res(i, False, "not_found")
+                    continue
+                plan = planes[(bot, numero)] = {"paths": {}, "summary": resumenes.get(numero), "deleted": False, "reset": False, "items": []}
+            if plan["deleted"]:
+                _res(i, False, "not_found")
+                continue
+            base = f"leads/{bot}/{numero}"
+            if op == "delete":
+                plan["paths"] = {base: None, f"msg_status/{bot}/{numero}": None}   # sustituye rutas hijas (no pueden ir junto a su padre)
+                plan["deleted"] = plan["reset"] = True
+            elif op == "clear":
+                plan["paths"].update({f"{base}/historial": None, f"{base}/messages": 0,
+                                      f"{base}/last_message": "", f"{base}/last_seen": "",
+                                      f"msg_status/{bot}/{numero}": None})
+                plan["reset"] = True
+            else:
+                plan["paths"][f"{base}/{op}"] = items[i]["value"]
+            plan["items"].append(i)
+
+    claves = list(planes.keys())
+    for n in range(0, len(claves), max(1, LEADS_BULK_CHUNK)):
+        trozo = claves[n:n + max(1, LEADS_BULK_CHUNK)]
+        cambios = {}
+        try:
+            for bot, numero in trozo:
+                plan = planes[(bot, numero)]
+                cambios.update(plan["paths"])
+                if plan["deleted"]:
+                    cambios.update(index_paths(bot, numero, None))
+                    continue
+                summary = plan["summary"]
+                if summary is None:
+                    # Índice desactualizado: el lead completo (caso raro; se reindexa aquí)
+                    summary = fb_get_lead(bot, numero)
+                    summary.pop("historial", None)
+                summary = dict(summary)
+                for path, val in plan["paths"].items():
+                    summary[path.rsplit("/", 1)[1]] = val
+                cambios.update(index_paths(bot, numero, summary))
+            db.reference().update(cambios)
+        except Exception as e:
+            print(f"❌ Bulk: error escribiendo {len(trozo)} leads: {e}")
+            for clave in trozo:
+                for i in planes[clave]["items"]:
+                    _res(i, False, "error")
+            continue
+        for bot, numero in trozo:
+            plan = planes[(bot, numero)]
+            bump_lead(bot, numero)
+            if plan["reset"]:
+                remove_lead(bot, numero)
+                publish_reset(bot, numero)
+            for i in plan["items"]:
+                _res(i, True)
+    return results
+
 # =======================
 #  ✅ Kill-Switch GLOBAL por bot
 # =======================
@@ -512,9 +760,8 @@ def fb_is_bot_on(bot_name: str) -> bool:
 def fb_is_conversation_on(bot_nombre: str, numero: str) -> bool:
     """Devuelve True si la conversación tiene el bot activado; si no existe el flag, asume ON."""
     try:
-        ref = _lead_ref(bot_nombre, numero)
-        lead = ref.get() or {}
-        val = lead.get("bot_enabled", None)
+        # Solo el flag, no el lead completo con su historial
+        val = _lead_ref(bot_nombre, numero).child("bot_enabled").get()
         if isinstance(val, bool):
             return val
         if isinstance(val, str):
@@ -528,7 +775,9 @@ def fb_set_conversation_on(bot_nombre: str, numero: str, enabled: bool):
         ref = _lead_ref(bot_nombre, numero)
         cur = ref.get() or {}
         cur["bot_enabled"] = bool(enabled)
-        ref.set(cur)
+        _lead_write(bot_nombre, numero, cur)
+        bump_lead(bot_nombre, numero)
+        publish_state(bot_nombre, numero, bool(enabled))
         return True
     except Exception as e:
         print(f"⚠️ Error guardando bot_enabled en {bot_nombre}/{numero}: {e}")
@@ -538,7 +787,7 @@ def fb_set_conversation_on(bot_nombre: str, numero: str, enabled: bool):
 #  🔄 Hidratar sesión desde Firebase (evita perder contexto tras reinicios)
 # =======================
 def _hydrate_session_from_firebase(clave_sesion: str, bot_cfg: dict, sender_number: str):
-    if clave_sesion in session_history:
+    if _hist_exists(clave_sesion):
         return
     bot_name = (bot_cfg or {}).get("name", "")
     if not bot_name:
@@ -561,10 +810,10 @@ def _hydrate_session_from_firebase(clave_sesion: str, bot_cfg: dict, sender_numb
         msgs.append({"role": role, "content": texto})
 
     if msgs:
-        session_history[clave_sesion] = msgs
+        _hist_set(clave_sesion, msgs)
     if len(historial) > 0:
-        greeted_state[clave_sesion] = True
-    follow_up_flags[clave_sesion] = {"5min": False, "60min": False}
+        _set_greeted(clave_sesion, True)
+    _reset_follow_ups(clave_sesion)
 
 # =======================
 #  Rutas UI: Paneles
@@ -710,6 +959,21 @@ def _user_can_access_bot(bot_name):
     bots = session.get("bots_permitidos", [])
     return bot_name in bots
 
+def _leads_filters(args) -> dict:
+    """Filtros/orden del listado de leads desde query params (panel y /api/leads)."""
+    try:
+        limit = int(args.get("limit") or LEADS_PAGE_SIZE)
+    except ValueError:
+        limit = LEADS_PAGE_SIZE
+    return {
+        "status": (args.get("status") or "").strip(),
+        "date_from": (args.get("desde") or args.get("from") or "").strip(),
+        "date_to": (args.get("hasta") or args.get("to") or "").strip(),
+        "sort": (args.get("sort") or "last_seen").strip(),
+        "order": (args.get("order") or "desc").strip(),
+        "limit": limit,
+    }
+
 @app.route("/panel-bot/<bot_nombre>")
 def panel_exclusivo_bot(bot_nombre):
     if not session.get("autenticado"):
@@ -719,14 +983,17 @@ def panel_exclusivo_bot(bot_nombre):
         return f"Bot '{bot_nombre}' no encontrado", 404
     if not _user_can_access_bot(bot_normalizado):
         return "No autorizado para este bot", 403
-    leads_filtrados = fb_list_leads_by_bot(bot_normalizado)
+    filtros = _leads_filters(request.args)
+    pagina = query_leads(bot=bot_normalizado, **filtros)
+    leads_filtrados = leads_page_dict(pagina)
     nombre_comercial = next(
         (config.get("business_name", bot_normalizado)
             for config in bots_config.values()
             if config.get("name") == bot_normalizado),
         bot_normalizado
     )
-    return render_template("panel_bot.html", leads=leads_filtrados, bot=bot_normalizado, nombre_comercial=nombre_comercial)
+    return render_template("panel_bot.html", leads=leads_filtrados, bot=bot_normalizado, nombre_comercial=nombre_comercial,
+                           next_cursor=pagina["next_cursor"], filtros=filtros)
 
 @app.route("/", methods=["GET"])
 def home():
@@ -798,19 +1065,19 @@ def panel():
         if destino:
             return redirect(url_for("panel_exclusivo_bot", bot_nombre=destino))
 
-    leads_todos = fb_list_leads_all()
     bots_disponibles = {}
     for cfg in bots_config.values():
         bots_disponibles[cfg["name"]] = cfg.get("business_name", cfg["name"])
 
+    # Solo la primera página (ordenada y filtrada en el índice); el resto se carga desde /api/leads
     bot_seleccionado = request.args.get("bot")
-    if bot_seleccionado:
-        bot_norm = _normalize_bot_name(bot_seleccionado) or bot_seleccionado
-        leads_filtrados = {k: v for k, v in leads_todos.items() if v.get("bot") == bot_norm}
-    else:
-        leads_filtrados = leads_todos
+    bot_norm = (_normalize_bot_name(bot_seleccionado) or bot_seleccionado) if bot_seleccionado else ""
+    filtros = _leads_filters(request.args)
+    pagina = query_leads(bot=bot_norm, **filtros)
+    leads_filtrados = leads_page_dict(pagina)
 
-    return render_template("panel.html", leads=leads_todos, bots= bots_disponibles, bot_seleccionado=bot_seleccionado)
+    return render_template("panel.html", leads=leads_filtrados, bots= bots_disponibles, bot_seleccionado=bot_seleccionado,
+                           next_cursor=pagina["next_cursor"], filtros=filtros)
 
 @app.route("/logout", methods=["GET", "POST"])
 def logout():
@@ -847,33 +1114,79 @@ def guardar_edicion():
             current["notes"] = nota
         current.setdefault("bot", bot_normalizado)
         current.setdefault("numero", numero)
-        ref.set(current)
+        _lead_write(bot_normalizado, numero, current)
+        bump_lead(bot_normalizado, numero)
     except Exception as e:
         print(f"⚠️ No se pudo actualizar en Firebase: {e}")
 
     return jsonify({"mensaje": "Lead actualizado"})
 
+_EXPORT_COLUMNS = ["Bot", "Número", "Primer contacto", "Último mensaje", "Última vez", "Mensajes", "Estado", "Notas"]
+_EXPORT_FIELDS = ["bot", "numero", "first_seen", "last_message", "last_seen", "messages", "status", "notes"]
+
+def _export_csv(leads):
+    """Genera el CSV fila a fila (un buffer por fila: memoria plana sin importar el tamaño)."""
+    buf = StringIO()
+    writer = csv.writer(buf)
+
+    def _row(values):
+        writer.writerow(values)
+        out = buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+        return out
+
+    yield _row(_EXPORT_COLUMNS)
+    for datos in leads:
+        yield _row([datos.get(f, "") for f in _EXPORT_FIELDS])
+
+def _export_jsonl(leads, transcripts: bool):
+    """Una línea JSON por lead; con transcripts=True añade el historial completo (una lectura por lead)."""
+    for datos in leads:
+        rec = {f: datos.get(f, "") for f in _EXPORT_FIELDS}
+        if transcripts:
+            historial = _lead_ref(datos["bot"], datos["numero"]).child("historial").get() or []
+            if isinstance(historial, dict):
+                historial = [historial[k] for k in sorted(historial.keys())]
+            rec["historial"] = [
+                {"texto": r.get("texto", ""), "hora": r.get("hora", ""), "tipo": r.get("tipo", "user"), "ts": _entrada_ts(r)}
+                for r in historial if isinstance(r, dict)
+            ]
+        yield json.dumps(rec, ensure_ascii=False) + "\n"
+
 @app.route("/exportar")
 def exportar():
+    """
+    Exporta leads en streaming, paginando leads_index por trozos.
+    Params: formato=csv|jsonl, transcripts=1 (solo jsonl), bot, status, desde, hasta (YYYY-MM-DD).
+    """
     if not session.get("autenticado"):
         return redirect(url_for("panel"))
-    leads = fb_list_leads_all()
-    output = StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["Bot", "Número", "Primer contacto", "Último mensaje", "Última vez", "Mensajes", "Estado", "Notas"])
-    for _, datos in leads.items():
-        writer.writerow([
-            datos.get("bot", ""),
-            datos.get("numero", ""),
-            datos.get("first_seen", ""),
-            datos.get("last_message", ""),
-            datos.get("last_seen", ""),
-            datos.get("messages", ""),
-            datos.get("status", ""),
-            datos.get("notes", "")
-        ])
-    output.seek(0)
-    return send_file(output, mimetype="text/csv", download_name="leads.csv", as_attachment=True)
+
+    bot_q = (request.args.get("bot") or "").strip()
+    bot_norm = (_normalize_bot_name(bot_q) or bot_q) if bot_q else ""
+    allowed = None
+    if not _is_admin():
+        if bot_norm and not _user_can_access_bot(bot_norm):
+            return "No autorizado para este bot", 403
+        allowed = [b for b in session.get("bots_permitidos", []) if b != "*"]
+
+    filtros = _leads_filters(request.args)
+    filtros.pop("limit", None)
+    leads = iter_leads(bot=bot_norm, allowed=allowed, **filtros)
+
+    formato = (request.args.get("formato") or request.args.get("format") or "csv").strip().lower()
+    sufijo = f"_{bot_norm}" if bot_norm else ""
+    if formato == "jsonl":
+        transcripts = (request.args.get("transcripts") or "").strip().lower() in ("1", "true", "on", "yes", "si", "sí")
+        body, mimetype, nombre = _export_jsonl(leads, transcripts), "application/x-ndjson", f"leads{sufijo}.jsonl"
+    else:
+        body, mimetype, nombre = _export_csv(leads), "text/csv", f"leads{sufijo}.csv"
+
+    resp = Response(stream_with_context(body), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f'attachment; filename="{nombre}"'
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 # =======================
 #  ✅ NUEVO: Borrar / Vaciar conversaciones (protegido)
@@ -937,6 +1250,113 @@ def api_delete_chat():
 # =======================
 #  ✅ API para responder MANUALMENTE desde el panel o la APP (Bearer)
 # =======================
+_MSG_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+_MSG_ESTADOS_MAX = 20
+# Estados de entrega de Twilio -> estado mostrado en el chat
+_TWILIO_ESTADOS = {"sent": "enviado", "delivered": "entregado", "read": "leido", "failed": "fallido", "undelivered": "fallido"}
+_ESTADO_ORDEN = {"enviando": 0, "enviado": 1, "entregado": 2, "leido": 3, "fallido": 3}
+
+# El estado de entrega vive en msg_status/<bot>/<numero>/<mid>, fuera del historial: fb_append_historial
+# reescribe el lead completo y pisaría cualquier update parcial de una entrada hecho entre su get y su set.
+# Se lee por 'ts' (reglas: "msg_status": {"$bot": {"$numero": {".indexOn": ["ts"]}}}) y se recorta a las
+# últimas _MSG_ESTADOS_MAX entradas cuando un envío llega a un estado final
+def _msg_status_ref(bot_nombre, numero, mid=""):
+    path = f"msg_status/{bot_nombre}/{numero}"
+    return db.reference(f"{path}/{mid}" if mid else path)
+
+def _msg_estados(bot_nombre, numero) -> dict:
+    """{id: estado} de los últimos _MSG_ESTADOS_MAX envíos manuales de la conversación."""
+    ref = _msg_status_ref(bot_nombre, numero)
+    try:
+        nodos = ref.order_by_child("ts").limit_to_last(_MSG_ESTADOS_MAX).get() or {}
+    except Exception as e:
+        print(f"⚠️ Consulta de msg_status por ts falló (¿falta .indexOn?), leyendo el nodo completo: {e}")
+        try:
+            nodos = ref.get() or {}
+        except Exception:
+            return {}
+    if not isinstance(nodos, dict):
+        return {}
+    recientes = sorted((v.get("ts", 0), mid, v.get("estado", "")) for mid, v in nodos.items() if isinstance(v, dict))
+    return {mid: estado for _, mid, estado in recientes[-_MSG_ESTADOS_MAX:] if estado}
+
+def _with_estados(mensajes: list, estados: dict) -> list:
+    """Superpone el estado de entrega vigente (msg_status) al guardado en cada entrada del historial."""
+    for m in mensajes:
+        if m.get("id") in estados:
+            m["estado"] = estados[m["id"]]
+    return mensajes
+
+def _msg_estado_set(bot_nombre, numero, mid, estado, extra: dict = None):
+    """
+    Estado (y campos extra: sid, error) de un envío manual en una transacción sobre su nodo: callbacks
+    concurrentes o desordenados nunca retroceden el estado (p. ej. delivered tras read). Publica el cambio.
+    """
+    def _tx(cur):
+        cur = cur if isinstance(cur, dict) else {}
+        nuevo = {**cur, **(extra or {})}
+        actual = cur.get("estado")
+        if not actual or _ESTADO_ORDEN.get(estado, 0) > _ESTADO_ORDEN.get(actual, 0):
+            nuevo["estado"] = estado
+        nuevo.setdefault("ts", int(time.time() * 1000))
+        return nuevo
+
+    try:
+        res = _msg_status_ref(bot_nombre, numero, mid).transaction(_tx) or {}
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar estado del mensaje {mid}: {e}")
+        return None
+    bump_lead(bot_nombre, numero)
+    publish_update(bot_nombre, numero, -1, {"id": mid, "estado": res.get("estado", estado), **(extra or {})})
+    if _ESTADO_ORDEN.get(estado, 0) >= _ESTADO_ORDEN["entregado"]:
+        _msg_status_prune(bot_nombre, numero)
+    return res
+
+def _msg_status_prune(bot_nombre, numero):
+    """Borra las entradas más viejas que las últimas _MSG_ESTADOS_MAX (nadie las lee ya)."""
+    ref = _msg_status_ref(bot_nombre, numero)
+    try:
+        recientes = ref.order_by_child("ts").limit_to_last(_MSG_ESTADOS_MAX).get() or {}
+        if len(recientes) < _MSG_ESTADOS_MAX:
+            return
+        corte = min(int(v.get("ts", 0)) for v in recientes.values() if isinstance(v, dict))
+        viejos = ref.order_by_child("ts").end_at(corte - 1).limit_to_first(200).get() or {}
+        if viejos:
+            ref.update({mid: None for mid in viejos if mid not in recientes})
+    except Exception as e:
+        print(f"⚠️ No se pudo recortar msg_status de {bot_nombre}/{numero}: {e}")
+
+def _send_manual_async(bot_nombre, numero, from_number, entrada, status_callback):
+    mid = entrada["id"]
+    _msg_estado_set(bot_nombre, numero, mid, "enviando")
+    try:
+        fb_append_historial(bot_nombre, numero, entrada)
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar el mensaje manual en el historial: {e}")
+    try:
+        msg = twilio_client.messages.create(from_=from_number, to=numero, body=entrada["texto"], status_callback=status_callback)
+    except Exception as e:
+        print(f"❌ Error enviando manualmente por Twilio: {e}")
+        _msg_estado_set(bot_nombre, numero, mid, "fallido", {"error": str(e)[:300]})
+        return
+    # Si el status callback ya llegó con un estado posterior, la transacción no lo retrocede
+    _msg_estado_set(bot_nombre, numero, mid, "enviado", {"sid": msg.sid})
+
+def _on_twilio_status(sid: str, status: str, params=None):
+    """
+    Status callback de Twilio (vía billing_api): entregado / leído / fallido de envíos manuales.
+    bot/numero/mid vienen en la URL del callback (fijada al crear el mensaje), así que un callback que
+    llegue antes de que messages.create() devuelva el sid no se pierde.
+    """
+    estado = _TWILIO_ESTADOS.get((status or "").lower())
+    params = params or {}
+    bot_nombre, numero, mid = params.get("bot", ""), params.get("numero", ""), params.get("mid", "")
+    if not estado or not (bot_nombre and numero and _MSG_ID_RE.match(mid or "")):
+        return
+    _msg_estado_set(bot_nombre, numero, mid, estado)
+
+add_twilio_status_hook(_on_twilio_status)
+
 @app.route("/api/send_manual", methods=["POST", "OPTIONS"])
 def api_send_manual():
     """
@@ -969,20 +1389,119 @@ def api_send_manual():
     if not twilio_client:
         return jsonify({"error": "Twilio REST no configurado (TWILIO_ACCOUNT_SID/TWILIO_AUTH_TOKEN)"}), 500
 
+    # Respuesta inmediata: historial (optimista, estado "enviando") + envío por Twilio en segundo plano
+    mid = (data.get("id") or "").strip()
+    if not _MSG_ID_RE.match(mid):
+        mid = uuid.uuid4().hex
+    entrada = {"tipo": "admin", "texto": texto, "hora": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+               "id": mid, "estado": "enviando"}
+    status_callback = _twilio_status_callback_url(bot=bot_normalizado, numero=numero, mid=mid)
+    Thread(target=_send_manual_async, args=(bot_normalizado, numero, from_number, entrada, status_callback),
+           daemon=True).start()
+    return jsonify({"ok": True, "id": mid, "estado": "enviando", "hora": entrada["hora"]}), 202
+
+# =======================
+#  📣 Campañas salientes (cola persistente en RTDB + emisor con ritmo y reintentos)
+# =======================
+def _campaign_send(from_, to, body, status_callback):
+    if not twilio_client:
+        raise RuntimeError("Twilio REST no configurado (TWILIO_ACCOUNT_SID/TWILIO_AUTH_TOKEN)")
+    return twilio_client.messages.create(from_=from_, to=to, body=body, status_callback=status_callback).sid
+
+init_campaigns(send=_campaign_send, append_history=fb_append_historial_batch, bot_number=_get_bot_number_by_name)
+if (os.environ.get("CAMPAIGNS_WORKER", "1") or "1").strip().lower() in ("1", "true", "on", "yes"):
+    start_campaign_worker()
+
+def _campaign_scope():
+    """None = todos los bots; lista = bots permitidos de la sesión."""
+    if session.get("autenticado") and not _is_admin():
+        return [b for b in session.get("bots_permitidos", []) if b != "*"]
+    return None
+
+@app.route("/api/campaigns", methods=["GET", "POST", "OPTIONS"])
+def api_campaigns():
+    """
+    GET: campañas (sin plantilla) con estado y totales.
+    POST JSON: { "bot": "Sara", "template": "Hola, te escribe {bot} ...", "status": "nuevo", "desde": "YYYY-MM-DD",
+                 "hasta": "YYYY-MM-DD", "rate": 5 }   (rate en msg/s, acotado por CAMPAIGN_MAX_RATE_MPS)
+    La campaña nace en "building": el worker resuelve el segmento y llena la cola en segundo plano.
+    """
+    if request.method == "OPTIONS":
+        return ("", 204)
+    if not session.get("autenticado") and not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+    if request.method == "GET":
+        return jsonify({"campaigns": list_campaigns(_campaign_scope())})
+
+    data = request.json or {}
+    bot_nombre = (data.get("bot") or "").strip()
+    template = (data.get("template") or data.get("texto") or "").strip()
+    if not bot_nombre or not template:
+        return jsonify({"error": "Parámetros inválidos (bot, template)"}), 400
+    bot_normalizado = _normalize_bot_name(bot_nombre) or bot_nombre
+    if session.get("autenticado") and not _user_can_access_bot(bot_normalizado):
+        return jsonify({"error": "No autorizado para este bot"}), 403
+    if not _get_bot_number_by_name(bot_normalizado):
+        return jsonify({"error": f"No se encontró el número del bot para '{bot_normalizado}'"}), 400
+    try:
+        rate = float(data.get("rate") or 0) or None
+    except (TypeError, ValueError):
+        return jsonify({"error": "Parámetro 'rate' inválido"}), 400
+
     try:
-        # Enviar vía Twilio REST
-        twilio_client.messages.create(
-            from_=from_number,
-            to=numero,
-            body=texto
+        campaign = create_campaign(
+            bot_normalizado, template,
+            status=(data.get("status") or "").strip(),
+            date_from=(data.get("desde") or data.get("from") or "").strip(),
+            date_to=(data.get("hasta") or data.get("to") or "").strip(),
+            rate=rate,
+            status_callback=_twilio_status_callback_url(),
+            created_by=session.get("usuario", "") if session.get("autenticado") else "api",
         )
-        # Guardar en historial como "admin"
-        ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        fb_append_historial(bot_normalizado, numero, {"tipo": "admin", "texto": texto, "hora": ahora})
-        return jsonify({"ok": True})
     except Exception as e:
-        print(f"❌ Error enviando manualmente por Twilio: {e}")
-        return jsonify({"error": "Fallo enviando el mensaje"}), 500
+        print(f"❌ Error creando campaña: {e}")
+        return jsonify({"error": "No se pudo crear la campaña"}), 500
+    return jsonify({"ok": True, "campaign": campaign}), 201
+
+@app.route("/api/campaigns/<cid>", methods=["GET"])
+def api_campaign_detail(cid):
+    """Progreso de una campaña; ?recipients=1&estado=fallido&limit=100 añade destinatarios."""
+    if not session.get("autenticado") and not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+    campaign = get_campaign(cid)
+    scope = _campaign_scope()
+    if not campaign or (scope is not None and campaign.get("bot") not in scope):
+        return jsonify({"error": "Campaña no encontrada"}), 404
+    out = {"campaign": campaign}
+    if (request.args.get("recipients") or "").strip().lower() in ("1", "true", "on", "yes"):
+        try:
+            limit = min(int(request.args.get("limit") or 100), 1000)
+        except ValueError:
+            limit = 100
+        out["recipients"] = list_recipients(cid, (request.args.get("estado") or "").strip(), limit)
+    return jsonify(out)
+
+@app.route("/api/campaigns/<cid>/<accion>", methods=["POST", "OPTIONS"])
+def api_campaign_action(cid, accion):
+    """accion: pause | resume | cancel"""
+    if request.method == "OPTIONS":
+        return ("", 204)
+    if not session.get("autenticado") and not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+    if accion not in ("pause", "resume", "cancel"):
+        return jsonify({"error": "Acción inválida (pause, resume, cancel)"}), 400
+    campaign = get_campaign(cid)
+    scope = _campaign_scope()
+    if not campaign or (scope is not None and campaign.get("bot") not in scope):
+        return jsonify({"error": "Campaña no encontrada"}), 404
+    ok = campaign_set_state(cid, accion)
+    return jsonify({"ok": ok, "campaign": get_campaign(cid)}), (200 if ok else 409)
+
+@app.route("/api/campaigns/stats", methods=["GET"])
+def api_campaign_stats():
+    if not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+    return jsonify(campaign_stats())
 
 # =======================
 #  ✅ API para ON/OFF por conversación (panel o APP con Bearer)
@@ -1019,6 +1538,26 @@ def api_conversation_bot():
 #  🔔 NEW: Endpoints PUSH (evitan HTTP 404)
 # =======================
 
+def _push_tokens_result(tokens, title: str, body_text: str, data: dict, mode: str = "tokens") -> dict:
+    """Difusión a una lista de tokens vía push_engine (trozos de 500 en paralelo + poda)."""
+    out = send_to_tokens(tokens, title, body_text, data)
+    return {"success": out["failed"] == 0 or out["sent"] > 0, "mode": mode, **out}
+
+def _push_single_token(token: str, title: str, body_text: str, data: dict):
+    msg = fcm.Message(
+        token=token,
+        notification=fcm.Notification(title=title, body=body_text),
+        data=data
+    )
+    try:
+        msg_id = fcm.send(msg)
+    except Exception as e:
+        if not is_dead_token_error(e):
+            raise
+        unregister_tokens([token])
+        return jsonify({"success": False, "mode": "token", "message": "Token no registrado (eliminado)"}), 404
+    return jsonify({"success": True, "mode": "token", "id": msg_id})
+
 def _push_common_data(payload: dict) -> dict:
     """Sanitiza 'data' para FCM (todos valores deben ser str)."""
     data = {}
@@ -1090,27 +1629,57 @@ def push_token():
 
     try:
         if tokens and isinstance(tokens, list) and len(tokens) > 0:
-            multicast = fcm.MulticastMessage(
-                tokens=[str(t) for t in tokens if str(t).strip()],
-                notification=fcm.Notification(title=title, body=body_text),
-                data=data
-            )
-            resp = fcm.send_multicast(multi)
-            return jsonify({"success": True, "mode": "tokens", "sent": resp.success_count, "failed": resp.failure_count})
+            return jsonify(_push_tokens_result(tokens, title, body_text, data))
         elif token:
-            msg = fcm.Message(
-                token=token,
-                notification=fcm.Notification(title=title, body=body_text),
-                data=data
-            )
-            msg_id = fcm.send(msg)
-            return jsonify({"success": True, "mode": "token", "id": msg_id})
+            return _push_single_token(token, title, body_text, data)
         else:
             return jsonify({"success": False, "message": "token(s) requerido(s)"}), 400
     except Exception as e:
         print(f"❌ Error FCM universal: {e}")
         return jsonify({"success": False, "message": "FCM error"}), 500
 
+# --- Registro de tokens de dispositivo (para difusiones "registered" y poda de tokens muertos) ---
+@app.route("/push/register", methods=["POST", "OPTIONS"])
+@app.route("/api/push/register", methods=["POST", "OPTIONS"])
+def push_register():
+    if request.method == "OPTIONS":
+        return ("", 204)
+    if not _bearer_ok(request):
+        return jsonify({"success": False, "message": "Unauthorized"}), 401
+    body = request.get_json(silent=True) or {}
+    token = (body.get("token") or "").strip()
+    if not token:
+        return jsonify({"success": False, "message": "token requerido"}), 400
+    bot = (body.get("bot") or "").strip()
+    try:
+        key = register_token(token, platform=(body.get("platform") or "").strip(),
+                             bot=(_normalize_bot_name(bot) or bot) if bot else "", user=(body.get("user") or "").strip())
+        return jsonify({"success": True, "id": key})
+    except Exception as e:
+        print(f"❌ Error registrando token push: {e}")
+        return jsonify({"success": False, "message": "Error guardando token"}), 500
+
+@app.route("/push/unregister", methods=["POST", "OPTIONS"])
+@app.route("/api/push/unregister", methods=["POST", "OPTIONS"])
+def push_unregister():
+    if request.method == "OPTIONS":
+        return ("", 204)
+    if not _bearer_ok(request):
+        return jsonify({"success": False, "message": "Unauthorized"}), 401
+    body = request.get_json(silent=True) or {}
+    tokens = body.get("tokens") if isinstance(body.get("tokens"), list) else [body.get("token") or ""]
+    try:
+        return jsonify({"success": True, "removed": unregister_tokens([str(t).strip() for t in tokens if str(t).strip()])})
+    except Exception as e:
+        print(f"❌ Error eliminando token push: {e}")
+        return jsonify({"success": False, "message": "Error eliminando token"}), 500
+
+@app.route("/push/stats", methods=["GET"])
+def push_stats_route():
+    if not _bearer_ok(request):
+        return jsonify({"success": False, "message": "Unauthorized"}), 401
+    return jsonify(push_stats())
+
 # --- Health simple para probar rutas ---
 @app.route("/push/health", methods=["GET"])
 def push_health():
@@ -1132,10 +1701,12 @@ def push_universal():
     title = (body.get("title") or body.get("titulo") or "").strip()
     body_text = (body.get("body") or body.get("descripcion") or "").strip()
 
-    # acepta topic/segmento; token único o tokens[]
+    # acepta topic/segmento; token único, tokens[] o "registered": true (todos los registrados, opcional "bot")
     topic = (body.get("topic") or body.get("segmento") or "").strip()
     token = (body.get("token") or "").strip()
     tokens = body.get("tokens") if isinstance(body.get("tokens"), list) else None
+    registered = str(body.get("registered") or "").strip().lower() in ("1", "true", "on", "yes", "si", "sí")
+    audience_bot = (body.get("bot") or "").strip()
 
     data = _push_common_data({
         "link": body.get("link") or "",
@@ -1157,21 +1728,11 @@ def push_universal():
             msg_id = fcm.send(msg)
             return jsonify({"success": True, "mode": "topic", "id": msg_id})
         elif tokens and len(tokens) > 0:
-            multi = fcm.MulticastMessage(
-                tokens=[str(t) for t in tokens if str(t).strip()],
-                notification=fcm.Notification(title=title, body=body_text),
-                data=data
-            )
-            resp = fcm.send_multicast(multi)
-            return jsonify({"success": True, "mode": "tokens", "sent": resp.success_count, "failed": resp.failure_count})
+            return jsonify(_push_tokens_result(tokens, title, body_text, data))
+        elif registered:
+            return jsonify(_push_tokens_result(registered_tokens(audience_bot), title, body_text, data, mode="registered"))
         elif token:
-            msg = fcm.Message(
-                token=token,
-                notification=fcm.Notification(title=title, body=body_text),
-                data=data
-            )
-            msg_id = fcm.send(msg)
-            return jsonify({"success": True, "mode": "token", "id": msg_id})
+            return _push_single_token(token, title, body_text, data)
         else:
             return jsonify({"success": False, "message": "Falta topic o token(s)"}), 400
     except Exception as e:
@@ -1192,11 +1753,26 @@ def verify_whatsapp():
     else:
         return "Token inválido", 403
 
+def _twilio_status_callback_url(**params) -> str:
+    """
+    URL del ledger de Twilio para status callbacks (TWILIO_STATUS_CALLBACK_URL o derivada del host).
+    params viajan en la query (Twilio los firma con la URL) y vuelven en cada callback del mensaje.
+    """
+    url = (os.environ.get("TWILIO_STATUS_CALLBACK_URL") or "").strip()
+    if not url:
+        url = request.url_root.replace("http://", "https://", 1) + "billing/twilio/status"
+    if params:
+        url += ("&" if "?" in url else "?") + urlencode(params)
+    return url
+
 def _compose_with_link(prefix: str, link: str) -> str:
     if _valid_url(link):
         return f"{prefix.strip()} {link}".strip()
     return prefix.strip()
 
+def _metric_intent(bot_name: str, intent: str, t0: float):
+    metrics_observe("intent_classification_seconds", time.perf_counter() - t0, bot=bot_name, intent=intent)
+
 @app.route("/webhook", methods=["POST"])
 def whatsapp_bot():
     incoming_msg  = (request.values.get("Body", "") or "").strip()
@@ -1211,8 +1787,15 @@ def whatsapp_bot():
         resp.message("Este número no está asignado a ningún bot.")
         return str(resp)
 
+    set_request_label(bot=bot.get("name", ""))
     _hydrate_session_from_firebase(clave_sesion, bot, sender_number)
 
+    # 💵 Ledger de Twilio: el inbound se registra aquí (fuera del camino crítico)
+    message_sid = request.values.get("MessageSid") or request.values.get("SmsSid") or ""
+    if message_sid:
+        Thread(target=record_twilio_message, args=(message_sid, sender_number, bot_number, "received"),
+               kwargs={"direction": "inbound"}, daemon=True).start()
+
     try:
         ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         fb_append_historial(bot["name"], sender_number, {"tipo": "user", "texto": incoming_msg, "hora": ahora})
@@ -1227,9 +1810,11 @@ def whatsapp_bot():
         return str(MessagingResponse())
 
     response = MessagingResponse()
-    msg = response.message()
+    msg = response.message(action=_twilio_status_callback_url())
+    t_intent = time.perf_counter()
 
     if _wants_app_download(incoming_msg):
+        _metric_intent(bot_name, "app_link", t_intent)
         url_app = _effective_app_url(bot)
         if url_app:
             links_cfg = bot.get("links") or {}
@@ -1239,25 +1824,26 @@ def whatsapp_bot():
             else:
                 texto = _compose_with_link("Aquí tienes:", url_app)
             msg.body(texto)
-            _set_agenda(clave_sesion, status="app_link_sent")
-            agenda_state[clave_sesion]["closed"] = True
+            _set_agenda(clave_sesion, status="app_link_sent", closed=True)
         else:
             msg.body("No tengo enlace de app disponible.")
-        last_message_time[clave_sesion] = time.time()
+        _touch_session(clave_sesion)
         return str(response)
 
     if _is_negative(incoming_msg):
+        _metric_intent(bot_name, "negative", t_intent)
         cierre = _compose_with_link("Entendido.", _effective_booking_url(bot))
         msg.body(cierre)
-        agenda_state.setdefault(clave_sesion, {})["closed"] = True
-        last_message_time[clave_sesion] = time.time()
+        _set_agenda(clave_sesion, closed=True)
+        _touch_session(clave_sesion)
         return str(response)
 
     if _is_polite_closure(incoming_msg):
+        _metric_intent(bot_name, "closure", t_intent)
         cierre = bot.get("policies", {}).get("polite_closure_message", "Gracias por contactarnos. ¡Hasta pronto!")
         msg.body(cierre)
-        agenda_state.setdefault(clave_sesion, {})["closed"] = True
-        last_message_time[clave_sesion] = time.time()
+        _set_agenda(clave_sesion, closed=True)
+        _touch_session(clave_sesion)
         return str(response)
 
     st = _get_agenda(clave_sesion)
@@ -1268,23 +1854,23 @@ def whatsapp_bot():
     closing_default = re.sub(r"\{\{?\s*GOOGLE_CALENDAR_BOOKING_URL\s*\}?\}", (_effective_booking_url(bot) or ""), (agenda_cfg.get("closing_message") or ""), flags=re.IGNORECASE)
 
     if _is_scheduled_confirmation(incoming_msg):
+        _metric_intent(bot_name, "scheduled", t_intent)
         texto = closing_default or "Agendado."
         msg.body(texto)
-        _set_agenda(clave_sesion, status="confirmed")
-        agenda_state[clave_sesion]["closed"] = True
-        last_message_time[clave_sesion] = time.time()
+        _set_agenda(clave_sesion, status="confirmed", closed=True)
+        _touch_session(clave_sesion)
         return str(response)
 
     if st.get("awaiting_confirm"):
         if _is_affirmative(incoming_msg):
+            _metric_intent(bot_name, "agenda_yes", t_intent)
             if _can_send_link(clave_sesion, cooldown_min=10):
                 link = _effective_booking_url(bot)
                 link_message = (agenda_cfg.get("link_message") or "").strip()
                 link_message = re.sub(r"\{\{?\s*GOOGLE_CALENDAR_BOOKING_URL\s*\}?\}", (link or ""), link_message, flags=re.IGNORECASE)
                 texto = link_message if link_message else (_compose_with_link("Enlace:", link) if link else "Sin enlace disponible.")
                 msg.body(texto)
-                _set_agenda(clave_sesion, awaiting_confirm=False, status="link_sent", last_link_time=int(time.time()), last_bot_hash=_hash_text(texto))
-                agenda_state[clave_sesion]["closed"] = True
+                _set_agenda(clave_sesion, awaiting_confirm=False, status="link_sent", last_link_time=int(time.time()), last_bot_hash=_hash_text(texto), closed=True)
                 try:
                     ahora_bot = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                     fb_append_historial(bot["name"], sender_number, {"tipo": "bot", "texto": texto, "hora": ahora_bot})
@@ -1293,55 +1879,60 @@ def whatsapp_bot():
             else:
                 msg.body("Enlace enviado recientemente.")
                 _set_agenda(clave_sesion, awaiting_confirm=False)
-            last_message_time[clave_sesion] = time.time()
+            _touch_session(clave_sesion)
             return str(response)
         elif _is_negative(incoming_msg):
+            _metric_intent(bot_name, "agenda_no", t_intent)
             if decline_msg:
                 msg.body(decline_msg)
-            _set_agenda(clave_sesion, awaiting_confirm=False)
-            agenda_state[clave_sesion]["closed"] = True
-            last_message_time[clave_sesion] = time.time()
+            _set_agenda(clave_sesion, awaiting_confirm=False, closed=True)
+            _touch_session(clave_sesion)
             return str(response)
         else:
+            _metric_intent(bot_name, "agenda_repeat", t_intent)
             if confirm_q:
                 msg.body(confirm_q)
-            last_message_time[clave_sesion] = time.time()
+            _touch_session(clave_sesion)
             return str(response)
 
     if any(k in (incoming_msg or "").lower() for k in (bot.get("agenda", {}).get("keywords", []) or [])):
+        _metric_intent(bot_name, "agenda", t_intent)
         if confirm_q:
             msg.body(confirm_q)
         _set_agenda(clave_sesion, awaiting_confirm=True)
-        last_message_time[clave_sesion] = time.time()
+        _touch_session(clave_sesion)
         return str(response)
 
-    if clave_sesion not in session_history:
+    if not _hist_exists(clave_sesion):
         sysmsg = _make_system_message(bot)
-        session_history[clave_sesion] = [{"role": "system", "content": sysmsg}] if sysmsg else []
-        follow_up_flags[clave_sesion] = {"5min": False, "60min": False}
-        greeted_state[clave_sesion] = False
+        _hist_set(clave_sesion, [{"role": "system", "content": sysmsg}] if sysmsg else [])
+        _reset_follow_ups(clave_sesion)
+        _set_greeted(clave_sesion, False)
 
     greeting_text = (bot.get("greeting") or "").strip()
     intro_keywords = (bot.get("intro_keywords") or [])
 
-    if (not greeted_state.get(clave_sesion)) and greeting_text and any(w in incoming_msg.lower() for w in intro_keywords):
+    if (not _is_greeted(clave_sesion)) and greeting_text and any(w in incoming_msg.lower() for w in intro_keywords):
+        _metric_intent(bot_name, "greeting", t_intent)
         msg.body(greeting_text)
-        greeted_state[clave_sesion] = True
-        last_message_time[clave_sesion] = time.time()
+        _set_greeted(clave_sesion, True)
+        _touch_session(clave_sesion)
         return str(response)
 
-    session_history.setdefault(clave_sesion, []).append({"role": "user", "content": incoming_msg})
-    last_message_time[clave_sesion] = time.time()
+    _metric_intent(bot_name, "llm", t_intent)
+    _hist_append(clave_sesion, {"role": "user", "content": incoming_msg})
+    _touch_session(clave_sesion)
 
     try:
         model_name = (bot.get("model") or "gpt-4o").strip()
         temperature = float(bot.get("temperature", 0.6)) if isinstance(bot.get("temperature", None), (int, float)) else 0.6
 
-        completion = client.chat.completions.create(
-            model=model_name,
-            temperature=temperature,
-            messages=session_history[clave_sesion]
-        )
+        with metrics_timer("openai_request_seconds", model=model_name, channel="whatsapp", bot=bot_name):
+            completion = client.chat.completions.create(
+                model=model_name,
+                temperature=temperature,
+                messages=_hist_get(clave_sesion)
+            )
 
         respuesta = (completion.choices[0].message.content or "").strip()
         respuesta = _apply_style(bot, respuesta)
@@ -1350,7 +1941,7 @@ def whatsapp_bot():
         must_ask = bool(style.get("always_question", False))
         respuesta = _ensure_question(bot, respuesta, force_question=must_ask)
 
-        st_prev = agenda_state.get(clave_sesion, {})
+        st_prev = _get_agenda(clave_sesion)
         if _hash_text(respuesta) == st_prev.get("last_bot_hash"):
             probe = _next_probe_from_bot(bot)
             if probe and probe not in respuesta:
@@ -1358,10 +1949,9 @@ def whatsapp_bot():
                     respuesta += "."
                 respuesta = f"{respuesta} {probe}".strip()
 
-        session_history[clave_sesion].append({"role": "assistant", "content": respuesta})
+        _hist_append(clave_sesion, {"role": "assistant", "content": respuesta})
         msg.body(respuesta)
-        agenda_state.setdefault(clave_sesion, {})
-        agenda_state[clave_sesion]["last_bot_hash"] = _hash_text(respuesta)
+        _set_agenda(clave_sesion, last_bot_hash=_hash_text(respuesta))
 
         try:
             usage = getattr(completion, "usage", None)
@@ -1373,6 +1963,8 @@ def whatsapp_bot():
                 input_tokens = int(((usage_dict or {}).get("usage") or {}).get("prompt_tokens", 0))
                 output_tokens = int(((usage_dict or {}).get("usage") or {}).get("completion_tokens", 0))
             record_openai_usage(bot.get("name", ""), model_name, input_tokens, output_tokens)
+            metrics_inc("openai_tokens_total", input_tokens, model=model_name, bot=bot_name, type="prompt")
+            metrics_inc("openai_tokens_total", output_tokens, model=model_name, bot=bot_name, type="completion")
         except Exception as e:
             print(f"⚠️ No se pudo registrar tokens en billing: {e}")
 
@@ -1416,29 +2008,55 @@ def _voice_get_bot_config(to_number: str) -> dict:
         "system_prompt": bot_cfg.get("system_prompt", "Eres un asistente de voz amable y natural. Habla con una voz humana."),
         "voice_greeting": bot_cfg.get("voice_greeting", f"Hola, soy el asistente de {bot_cfg.get('business_name', bot_cfg.get('name', 'el bot'))}. ¿Cómo puedo ayudarte?"),
         "openai_voice": bot_cfg.get("realtime", {}).get("voice", "nova"),
+        "realtime": bot_cfg.get("realtime") or {},
     }
     return config
 
+def _voice_realtime_bot_cfg(to_number: str):
+    """Config que usa el puente realtime: la del bot + saludo de voz normalizado."""
+    config = _voice_get_bot_config(to_number)
+    if not config:
+        return None
+    return {
+        "name": config["bot_name"],
+        "system_prompt": config["system_prompt"],
+        "voice_greeting": config["voice_greeting"],
+        "realtime": config["realtime"],
+    }
+
+def _voice_realtime_on_start(call_sid, bot_cfg, caller):
+    _voice_touch(call_sid, bot_name=bot_cfg.get("name", ""), caller=caller)
+
+def _voice_realtime_on_turn(call_sid, tipo, texto):
+    ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    _voice_touch(call_sid, turns=[{"tipo": tipo, "texto": texto, "hora": ahora, "canal": "voz"}])
+
+init_voice_realtime(
+    app,
+    resolve_bot=_voice_realtime_bot_cfg,
+    on_start=_voice_realtime_on_start,
+    on_turn=_voice_realtime_on_turn,
+    on_end=lambda call_sid: _voice_finalize_call(call_sid, reason="stream_end"),
+)
+
 def _generate_and_store_greeting(call_sid: str, bot_config: dict):
-    """Genera audio con OpenAI TTS y lo guarda en /tmp. Guarda el nombre del archivo en caché."""
+    """Genera audio con OpenAI TTS y lo guarda en AUDIO_DIR. Guarda el nombre del archivo en caché."""
     try:
         greeting_text = bot_config["voice_greeting"]
         openai_voice = bot_config["openai_voice"]
         
-        temp_dir = "/tmp"
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
-        greeting_file_name = f"{call_sid}_greeting.mp3"
-        greeting_file_path = os.path.join(temp_dir, greeting_file_name)
+        greeting_file_name, greeting_file_path = audio_new_file(call_sid, "greeting")
 
         if not os.path.exists(greeting_file_path):
-            tts_response = client.audio.speech.create(
-                model="tts-1",
-                voice=openai_voice,
-                input=greeting_text,
-                speed=1.0
-            )
-            tts_response.stream_to_file(greeting_file_path)
+            with metrics_timer("tts_request_seconds", voice=openai_voice, kind="greeting", bot=bot_config["bot_name"]):
+                tts_response = client.audio.speech.create(
+                    model="tts-1",
+                    voice=openai_voice,
+                    input=greeting_text,
+                    speed=1.0
+                )
+                tts_response.stream_to_file(greeting_file_path)
+        audio_register(call_sid, greeting_file_name)
         
         # ✅ CORRECCIÓN: Guardar el nombre del archivo dentro de un diccionario
         voice_call_cache[f"{call_sid}_greeting"] = {"audio_file_name": greeting_file_name}
@@ -1448,6 +2066,86 @@ def _generate_and_store_greeting(call_sid: str, bot_config: dict):
         # ✅ CORRECCIÓN: Asegurar que siempre se guarde un diccionario
         voice_call_cache[f"{call_sid}_greeting"] = {"audio_file_name": ""}
 
+# =======================
+#  🔊 Ciclo de vida de llamadas (liberar memoria y audios al colgar)
+# =======================
+VOICE_CALL_IDLE_SEC = int(os.environ.get("VOICE_CALL_IDLE_SEC", "900") or 900)
+VOICE_SWEEP_INTERVAL_SEC = int(os.environ.get("VOICE_SWEEP_INTERVAL_SEC", "60") or 60)
+_VOICE_FINAL_STATUSES = ("completed", "busy", "failed", "no-answer", "canceled")
+
+def _voice_touch(call_sid: str, bot_name: str = "", caller: str = "", turns=None):
+    """Crea/actualiza la metadata de la llamada y acumula turnos para persistir al final."""
+    if not call_sid:
+        return
+    with _voice_meta_lock:
+        if call_sid in voice_call_finalized:
+            return
+        meta = voice_call_meta.get(call_sid)
+        if meta is None:
+            meta = {"bot": "", "numero": "", "started": time.time(), "last_activity": time.time(), "turns": []}
+            voice_call_meta[call_sid] = meta
+        if bot_name and not meta["bot"]:
+            meta["bot"] = bot_name
+        if caller and not meta["numero"]:
+            canon = _canonize_phone(caller)
+            # Mismo formato de clave que los leads de WhatsApp para unificar el historial del contacto
+            meta["numero"] = f"whatsapp:{canon}" if canon else ""
+        if turns:
+            # hora/ts del momento del turno, no del cuelgue
+            ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            for t in turns:
+                t.setdefault("hora", ahora)
+                _with_ts(t)
+            meta["turns"].extend(turns)
+        meta["last_activity"] = time.time()
+
+def _voice_finalize_call(call_sid: str, reason: str = "completed"):
+    """Persiste la transcripción (una sola escritura), borra audios y libera el estado en memoria."""
+    with _voice_meta_lock:
+        voice_call_finalized[call_sid] = time.time()
+        meta = voice_call_meta.pop(call_sid, None)
+    voice_conversation_history.pop(call_sid, None)
+    voice_call_cache.pop(call_sid, None)
+    voice_call_cache.pop(f"{call_sid}_greeting", None)
+    borrados = audio_release_call(call_sid)
+
+    turns = (meta or {}).get("turns") or []
+    if meta and turns and meta.get("bot") and meta.get("numero"):
+        try:
+            fb_append_historial_batch(meta["bot"], meta["numero"], turns)
+        except Exception as e:
+            print(f"⚠️ No se pudo guardar la transcripción de la llamada {call_sid}: {e}")
+    print(f"[VOICE] Llamada {call_sid} finalizada ({reason}): {len(turns)} turnos, {borrados} audios borrados.")
+
+def _voice_sweep_idle():
+    """Finaliza llamadas sin actividad (por si Twilio no envió el status callback)."""
+    limite = time.time() - VOICE_CALL_IDLE_SEC
+    for call_sid, meta in list(voice_call_meta.items()):
+        if meta.get("last_activity", 0) < limite:
+            _voice_finalize_call(call_sid, reason="idle")
+    with _voice_meta_lock:
+        for call_sid, cerrada in list(voice_call_finalized.items()):
+            if cerrada < limite:
+                voice_call_finalized.pop(call_sid, None)
+    # Restos sin metadata (no deberían existir, pero no dejamos fugas)
+    for key in list(voice_call_cache.keys()):
+        sid = key[:-len("_greeting")] if key.endswith("_greeting") else key
+        if sid not in voice_call_meta:
+            voice_call_cache.pop(key, None)
+    for sid in list(voice_conversation_history.keys()):
+        if sid not in voice_call_meta:
+            voice_conversation_history.pop(sid, None)
+
+def _voice_sweeper_loop():
+    while True:
+        time.sleep(VOICE_SWEEP_INTERVAL_SEC)
+        try:
+            _voice_sweep_idle()
+        except Exception as e:
+            print(f"⚠️ Error en el barrido de llamadas: {e}")
+
+Thread(target=_voice_sweeper_loop, daemon=True).start()
+
 def _thread_target_chat(call_sid, user_speech, bot_config):
     """Función para el hilo de procesamiento de la IA."""
     try:
@@ -1456,27 +2154,31 @@ def _thread_target_chat(call_sid, user_speech, bot_config):
         
         voice_conversation_history[call_sid].append({"role": "user", "content": user_speech})
         
-        chat_completion = client.chat.completions.create(
-            model=bot_config["model"],
-            messages=voice_conversation_history[call_sid]
-        )
+        with metrics_timer("openai_request_seconds", model=bot_config["model"], channel="voice", bot=bot_config["bot_name"]):
+            chat_completion = client.chat.completions.create(
+                model=bot_config["model"],
+                messages=voice_conversation_history[call_sid]
+            )
         bot_response_text = chat_completion.choices[0].message.content.strip()
         
         voice_conversation_history[call_sid].append({"role": "assistant", "content": bot_response_text})
+        ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        _voice_touch(call_sid, turns=[
+            {"tipo": "user", "texto": user_speech, "hora": ahora, "canal": "voz"},
+            {"tipo": "bot", "texto": bot_response_text, "hora": ahora, "canal": "voz"},
+        ])
 
-        temp_dir = "/tmp"
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
-        audio_file_name = f"{call_sid}_{uuid.uuid4().hex[:8]}.mp3"
-        audio_file_path = os.path.join(temp_dir, audio_file_name)
+        audio_file_name, audio_file_path = audio_new_file(call_sid)
         
-        tts_response = client.audio.speech.create(
-            model="tts-1",
-            voice=bot_config["openai_voice"],
-            input=bot_response_text,
-            speed=1.0
-        )
-        tts_response.stream_to_file(audio_file_path)
+        with metrics_timer("tts_request_seconds", voice=bot_config["openai_voice"], kind="turn", bot=bot_config["bot_name"]):
+            tts_response = client.audio.speech.create(
+                model="tts-1",
+                voice=bot_config["openai_voice"],
+                input=bot_response_text,
+                speed=1.0
+            )
+            tts_response.stream_to_file(audio_file_path)
+        audio_register(call_sid, audio_file_name)
 
         # Guardar el nombre del archivo en la caché
         voice_call_cache[call_sid] = {"audio_file_name": audio_file_name}
@@ -1508,6 +2210,19 @@ def voice_webhook():
         return str(resp)
 
     print(f"[VOICE] Llamada a '{bot_config['bot_name']}' iniciada.")
+    set_request_label(bot=bot_config["bot_name"])
+    _voice_touch(call_sid, bot_name=bot_config["bot_name"], caller=request.values.get("From", ""))
+
+    # ⚡ Modo realtime: audio bidireccional por Media Streams (sin Gather/STT/TTS por turno)
+    if realtime_enabled(bot_config):
+        resp = VoiceResponse()
+        connect = Connect()
+        stream = connect.stream(url=realtime_stream_url(request.host_url.replace("http://", "https://", 1), call_sid or ""))
+        stream.parameter(name="to", value=to_number or "")
+        stream.parameter(name="from", value=request.values.get("From", ""))
+        stream.parameter(name="call_sid", value=call_sid or "")
+        resp.append(connect)
+        return str(resp)
     
     # ✅ CORRECCIÓN: Iniciar el procesamiento del saludo en un hilo separado
     # Se añade la entrada a voice_call_cache para que el hilo sepa dónde guardar el resultado
@@ -1545,6 +2260,9 @@ def voice_gather():
         resp.say("Lo siento, hubo un problema técnico.")
         return str(resp)
         
+    set_request_label(bot=bot_config["bot_name"])
+    _voice_touch(call_sid, bot_name=bot_config["bot_name"], caller=request.values.get("From", ""))
+
     if user_speech:
         print(f"[VOICE] Mensaje del usuario: {user_speech}")
         
@@ -1579,15 +2297,39 @@ def voice_gather():
     
     return str(resp)
 
-# 3. Endpoint para servir el archivo de audio
-@app.route("/voice-audio/<filename>", methods=["GET"])
+# 3. Endpoint para servir el archivo de audio (ETag + Cache-Control + Range; ver voice_audio.py)
+@app.route("/voice-audio/<filename>", methods=["GET", "HEAD"])
 def voice_audio(filename):
-    file_path = os.path.join("/tmp", filename)
-    if os.path.exists(file_path):
-        return send_file(file_path, mimetype="audio/mpeg", as_attachment=False)
-    else:
-        print(f"❌ Error 404: Archivo no encontrado en {file_path}")
-        return "Archivo no encontrado", 404
+    return audio_response(filename)
+
+# 4. Status callback de la llamada (configurar en el número: "Call status changes" -> /voice-status)
+@app.route("/voice-status", methods=["POST"])
+def voice_status():
+    call_sid = request.values.get("CallSid", "")
+    call_status = (request.values.get("CallStatus", "") or "").lower()
+    if call_sid and call_status in _VOICE_FINAL_STATUSES:
+        # Respondemos rápido a Twilio; la escritura en Firebase va en segundo plano
+        Thread(target=_voice_finalize_call, args=(call_sid, call_status), daemon=True).start()
+    return ("", 204)
+
+# 5. Estado de llamadas activas y memoria usada (Bearer)
+@app.route("/voice/stats", methods=["GET"])
+def voice_stats():
+    if not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+    mensajes = sum(len(h) for h in voice_conversation_history.values())
+    bytes_aprox = sum(len(m.get("content") or "") for h in voice_conversation_history.values() for m in h)
+    bytes_aprox += sum(len(t.get("texto") or "") for m in voice_call_meta.values() for t in m.get("turns", []))
+    return jsonify({
+        "active_calls": len(voice_call_meta),
+        "history_calls": len(voice_conversation_history),
+        "history_messages": mensajes,
+        "cache_entries": len(voice_call_cache),
+        "approx_text_bytes": bytes_aprox,
+        "idle_timeout_sec": VOICE_CALL_IDLE_SEC,
+        "audio": audio_stats(),
+        "realtime": realtime_stats(),
+    })
 
 # =======================
 #  Vistas de conversación (leen Firebase)
@@ -1609,7 +2351,9 @@ def chat_general(bot, numero):
     historial = data.get("historial", [])
     if isinstance(historial, dict):
         historial = [historial[k] for k in sorted(historial.keys())]
-    mensajes = [{"texto": r.get("texto", ""), "hora": r.get("hora", ""), "tipo": r.get("tipo", "user")} for r in historial]
+    mensajes = [{"texto": r.get("texto", ""), "hora": r.get("hora", ""), "tipo": r.get("tipo", "user"),
+                 "id": r.get("id", ""), "estado": r.get("estado", "")} for r in historial]
+    mensajes = _with_estados(mensajes, _msg_estados(bot_normalizado, numero))
 
     return render_template("chat.html", numero=numero, mensajes=mensajes, bot=bot_normalizado, bot_data=bot_cfg, company_name=company_name)
 
@@ -1630,7 +2374,9 @@ def chat_bot(bot, numero):
     historial = data.get("historial", [])
     if isinstance(historial, dict):
         historial = [historial[k] for k in sorted(historial.keys())]
-    mensajes = [{"texto": r.get("texto", ""), "hora": r.get("hora", ""), "tipo": r.get("tipo", "user")} for r in historial]
+    mensajes = [{"texto": r.get("texto", ""), "hora": r.get("hora", ""), "tipo": r.get("tipo", "user"),
+                 "id": r.get("id", ""), "estado": r.get("estado", "")} for r in historial]
+    mensajes = _with_estados(mensajes, _msg_estados(bot_normalizado, numero))
 
     return render_template("chat_bot.html", numero=numero, mensajes=mensajes, bot=bot_normalizado, bot_data=bot_cfg, company_name=company_name)
 
@@ -1658,31 +2404,293 @@ def api_chat(bot, numero):
     except ValueError:
         since_ms = 0
 
-    data = fb_get_lead(bot_normalizado, numero)
-    historial = data.get("historial", [])
-    if isinstance(historial, dict):
-        historial = [historial[k] for k in sorted(historial.keys())]
-
-    nuevos = []
-    last_ts = since_ms
-    for reg in historial:
-        ts = _hora_to_epoch_ms(reg.get("hora", ""))
-        if ts > since_ms:
-            nuevos.append({"texto": reg.get("texto", ""), "hora": reg.get("hora", ""), "tipo": reg.get("tipo", "user"), "ts": ts})
-        if ts > last_ts:
-            last_ts = ts
-
-    if since_ms == 0 and not nuevos and historial:
-        for reg in historial:
-            ts = _hora_to_epoch_ms(reg.get("hora", ""))
+    def _build():
+        # Solo el delta (consulta por 'ts'); con since=0 una única pasada sobre el historial
+        nuevos = []
+        last_ts = since_ms
+        for reg in fb_get_historial_since(bot_normalizado, numero, since_ms):
+            ts = _entrada_ts(reg)
+            msg = {"texto": reg.get("texto", ""), "hora": reg.get("hora", ""), "tipo": reg.get("tipo", "user"), "ts": ts}
+            for k in ("id", "estado"):
+                if reg.get(k):
+                    msg[k] = reg[k]
+            nuevos.append(msg)
             if ts > last_ts:
                 last_ts = ts
-        nuevos = [{"texto": reg.get("texto", ""), "hora": reg.get("hora", ""), "tipo": reg.get("tipo", "user"), "ts": _hora_to_epoch_ms(reg.get("hora", ""))} for reg in historial]
 
-    # ✅ Adjuntamos estado ON/OFF por conversación para que el front muestre el botón correcto
-    bot_enabled = fb_is_conversation_on(bot_normalizado, numero)
+        # ✅ Adjuntamos estado ON/OFF por conversación para que el front muestre el botón correcto
+        bot_enabled = fb_is_conversation_on(bot_normalizado, numero)
+
+        # 'cursor' = valor a enviar como ?since= en la siguiente llamada
+        # 'estados': entrega de los últimos envíos manuales (cambian sin que cambie su 'ts')
+        estados = _msg_estados(bot_normalizado, numero)
+        return {"mensajes": _with_estados(nuevos, estados), "last_ts": last_ts, "cursor": last_ts,
+                "bot_enabled": bool(bot_enabled), "estados": estados}
+
+    # Sin cambios en el lead desde el último poll => 304 sin tocar Firebase
+    etag = make_etag("api_chat", keys=[f"lead:{bot_normalizado}:{numero}"], parts=[numero, since_ms])
+    return conditional_json("api_chat", etag, _build)
+
+# =======================
+#  📡 Stream SSE: mensajes nuevos y ON/OFF sin polling
+# =======================
+# EventSource no manda headers: los clientes con Bearer piden antes un token corto firmado (HMAC con
+# API_BEARER_TOKEN como clave, que nunca viaja en la URL) válido solo para ese bot y número
+CHAT_STREAM_TOKEN_TTL_SEC = int(os.environ.get("CHAT_STREAM_TOKEN_TTL_SEC", "300") or 300)
+
+def _chat_stream_sig(bot: str, numero: str, exp: int) -> str:
+    msg = f"chat_stream|{bot}|{numero}|{exp}".encode("utf-8")
+    return hmac.new(API_BEARER_TOKEN.encode("utf-8"), msg, hashlib.sha256).hexdigest()
+
+def _chat_stream_token_ok(token: str, bot: str, numero: str) -> bool:
+    if not API_BEARER_TOKEN or "." not in (token or ""):
+        return False
+    exp_s, sig = token.split(".", 1)
+    try:
+        exp = int(exp_s)
+    except ValueError:
+        return False
+    return exp >= time.time() and hmac.compare_digest(sig, _chat_stream_sig(bot, numero, exp))
+
+@app.route("/api/chat_stream/token/<bot>/<numero>", methods=["GET", "POST"])
+def api_chat_stream_token(bot, numero):
+    """Token de un solo bot/número para abrir /api/chat_stream con ?token= (caduca en CHAT_STREAM_TOKEN_TTL_SEC)."""
+    if not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+    bot_normalizado = _normalize_bot_name(bot)
+    if not bot_normalizado:
+        return jsonify({"error": "Bot no encontrado"}), 404
+    exp = int(time.time()) + CHAT_STREAM_TOKEN_TTL_SEC
+    return jsonify({"token": f"{exp}.{_chat_stream_sig(bot_normalizado, numero, exp)}", "expires_in": CHAT_STREAM_TOKEN_TTL_SEC})
+
+@app.route("/api/chat_stream/<bot>/<numero>", methods=["GET"])
+def api_chat_stream(bot, numero):
+    # ✅ Sesión, Bearer en header o token corto firmado para este bot/número (?token=, ver arriba)
+    bot_normalizado = _normalize_bot_name(bot)
+    if not session.get("autenticado") and not _bearer_ok(request):
+        token = (request.args.get("token") or "").strip()
+        if not (bot_normalizado and _chat_stream_token_ok(token, bot_normalizado, numero)):
+            return jsonify({"error": "No autenticado"}), 401
 
-    return jsonify({"mensajes": nuevos, "last_ts": last_ts, "bot_enabled": bool(bot_enabled)})
+    if not bot_normalizado:
+        return jsonify({"error": "Bot no encontrado"}), 404
+    if session.get("autenticado") and not _user_can_access_bot(bot_normalizado):
+        return jsonify({"error": "No autorizado"}), 403
+
+    resp = Response(stream_with_context(sse_stream(bot_normalizado, numero)), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+# =======================
+#  📇 Listado paginado de leads (cursor + orden + filtros)
+# =======================
+@app.route("/api/leads", methods=["GET", "OPTIONS"])
+def api_leads():
+    if request.method == "OPTIONS":
+        return ("", 204)
+    if not session.get("autenticado") and not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+
+    bot_q = (request.args.get("bot") or "").strip()
+    bot_norm = (_normalize_bot_name(bot_q) or bot_q) if bot_q else ""
+    allowed = None
+    if session.get("autenticado") and not _is_admin():
+        if bot_norm and not _user_can_access_bot(bot_norm):
+            return jsonify({"error": "No autorizado"}), 403
+        allowed = [b for b in session.get("bots_permitidos", []) if b != "*"]
+
+    filtros = _leads_filters(request.args)
+    cursor = (request.args.get("cursor") or "").strip()
+    etag = make_etag("api_leads", keys=[f"leads:{bot_norm}" if bot_norm else "leads:*"],
+                     parts=[bot_norm, cursor, ",".join(allowed or ["*"])] + [filtros[k] for k in sorted(filtros)])
+    return conditional_json("api_leads", etag,
+                            lambda: query_leads(bot=bot_norm, cursor=cursor, allowed=allowed, **filtros))
+
+@app.route("/api/leads/bulk", methods=["POST", "OPTIONS"])
+def api_leads_bulk():
+    """
+    JSON: {"items": [{"bot": "Sara", "numero": "whatsapp:+1...", "op": "status|notes|delete|clear", "value": "..."}]}
+    (también "key": "Bot|numero" en lugar de bot + numero). Respuesta: un resultado por item, en orden.
+    """
+    if request.method == "OPTIONS":
+        return ("", 204)
+    if not session.get("autenticado") and not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+
+    data = request.json or {}
+    raw = data.get("items")
+    if not isinstance(raw, list) or not raw:
+        return jsonify({"error": "Se requiere 'items' (lista no vacía)"}), 400
+    if len(raw) > LEADS_BULK_MAX:
+        return jsonify({"error": f"Máximo {LEADS_BULK_MAX} items por petición"}), 400
+
+    results = [None] * len(raw)
+    validos, posiciones = [], []
+    for i, it in enumerate(raw):
+        it = it if isinstance(it, dict) else {}
+        bot, numero = (it.get("bot") or "").strip(), (it.get("numero") or "").strip()
+        if not bot and "|" in (it.get("key") or ""):
+            bot, numero = [x.strip() for x in it["key"].split("|", 1)]
+        op = (it.get("op") or "").strip().lower()
+        value = it.get("value")
+        bot = (_normalize_bot_name(bot) or bot) if bot else ""
+        error = ""
+        if not bot or not numero or op not in _BULK_OPS:
+            error = "invalid"
+        elif op in ("status", "notes") and not isinstance(value, str):
+            error = "invalid"
+        elif op == "status" and not value.strip():
+            error = "invalid"
+        elif session.get("autenticado") and not _user_can_access_bot(bot):
+            error = "forbidden"
+        if error:
+            results[i] = {"bot": bot, "numero": numero, "op": op, "ok": False, "error": error}
+            continue
+        validos.append({"bot": bot, "numero": numero, "op": op, "value": value.strip() if isinstance(value, str) else None})
+        posiciones.append(i)
+
+    for i, r in zip(posiciones, fb_bulk_leads(validos)):
+        results[i] = r
+    aplicados = sum(1 for r in results if r and r.get("ok"))
+    return jsonify({"ok": aplicados == len(results), "applied": aplicados, "failed": len(results) - aplicados, "results": results})
+
+# =======================
+#  🔎 Búsqueda en conversaciones (sin lecturas a Firebase)
+# =======================
+@app.route("/api/search", methods=["GET", "OPTIONS"])
+def api_search():
+    if request.method == "OPTIONS":
+        return ("", 204)
+    if not session.get("autenticado") and not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+
+    q = (request.args.get("q") or "").strip()
+    if not q:
+        return jsonify({"error": "Parámetro 'q' requerido"}), 400
+    bot_q = (request.args.get("bot") or "").strip()
+    bot_norm = (_normalize_bot_name(bot_q) or bot_q) if bot_q else ""
+    try:
+        limit = min(int(request.args.get("limit") or 20), 100)
+    except ValueError:
+        limit = 20
+
+    bots = [bot_norm] if bot_norm else None
+    if session.get("autenticado") and not _is_admin():
+        if bot_norm and not _user_can_access_bot(bot_norm):
+            return jsonify({"error": "No autorizado"}), 403
+        if not bot_norm:
+            bots = [b for b in session.get("bots_permitidos", []) if b != "*"]
+    res = search_historial(q, bots=bots, limit=limit)
+    if not res.get("enabled"):
+        return jsonify({**res, "error": "Búsqueda desactivada: requiere un solo worker (o SEARCH_ENABLED=1)"}), 503
+    return jsonify(res)
+
+@app.route("/api/search/rebuild", methods=["POST"])
+def api_search_rebuild():
+    if not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+    return jsonify({"ok": True, "bots": search_rebuild_all()})
+
+@app.route("/api/search/stats", methods=["GET"])
+def api_search_stats():
+    if not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+    return jsonify(search_stats())
+
+@app.route("/api/http_cache/stats", methods=["GET"])
+def api_http_cache_stats():
+    if not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+    return jsonify(http_cache_stats())
+
+@app.route("/api/compression/stats", methods=["GET"])
+def api_compression_stats():
+    if not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+    return jsonify(compression_stats())
+
+@app.route("/api/chat_stream/stats", methods=["GET"])
+def api_chat_stream_stats():
+    if not _bearer_ok(request):
+        return jsonify({"error": "No autenticado"}), 401
+    return jsonify(chat_events_stats())
+
+# =======================
+#  📈 Métricas: colas, memoria y cachés (se calculan solo al raspar /metrics)
+# =======================
+metrics_describe("queue_depth", "Elementos pendientes por cola del proceso.")
+metrics_describe("inmemory_entries", "Entradas en estructuras en memoria del proceso.")
+metrics_describe("cache_requests_total", "Consultas a cachés por resultado (hit/miss).", kind="counter")
+metrics_describe("cache_hit_ratio", "hits / (hits + misses) por caché desde el arranque.")
+
+@register_collector
+def _metrics_collector():
+    ce = chat_events_stats()
+    bc = billing_cache_stats()
+    au = audio_stats()
+    se = search_stats()
+    out = [
+        ("queue_depth", {"queue": "sse_events"}, ce["queued"]),
+        ("queue_depth", {"queue": "billing_inflight"}, bc["inflight"]),
+        ("queue_depth", {"queue": "twilio_price_pending"}, price_fetch_stats()["pending"]),
+        ("queue_depth", {"queue": "threads"}, active_count()),
+        ("inmemory_entries", {"structure": "sse_subscribers"}, ce["subscribers"]),
+        ("inmemory_entries", {"structure": "voice_calls"}, len(voice_call_meta)),
+        ("inmemory_entries", {"structure": "voice_history_messages"}, sum(len(h) for h in list(voice_conversation_history.values()))),
+        ("inmemory_entries", {"structure": "voice_cache"}, len(voice_call_cache)),
+        ("inmemory_entries", {"structure": "billing_cache"}, bc["entries"]),
+        ("inmemory_entries", {"structure": "search_docs"}, se["docs"]),
+        ("inmemory_entries", {"structure": "search_terms"}, se["terms"]),
+        ("inmemory_entries", {"structure": "audio_files"}, au["files"]),
+        ("inmemory_entries", {"structure": f"state_{state.name}"}, state.size()),
+    ]
+    caches = {"billing": (bc["hits"], bc["misses"]), "voice_audio": (au["not_modified"], au["served"])}
+    for endpoint, st in http_cache_stats()["endpoints"].items():
+        caches[f"http:{endpoint}"] = (st["hits"], st["misses"])
+    for cache, (hits, misses) in caches.items():
+        out.append(("cache_requests_total", {"cache": cache, "result": "hit"}, hits))
+        out.append(("cache_requests_total", {"cache": cache, "result": "miss"}, misses))
+        out.append(("cache_hit_ratio", {"cache": cache}, round(hits / (hits + misses), 4) if hits + misses else 0.0))
+    return out
+
+# =======================
+#  🛠️ Backfill: añadir 'ts' a historiales existentes (flask --app main backfill-historial-ts)
+# =======================
+@app.cli.command("backfill-historial-ts")
+def backfill_historial_ts():
+    """Recorre leads/<bot>/<numero>/historial y escribe 'ts' (desde 'hora') donde falte."""
+    bots = db.reference("leads").get(shallow=True) or {}
+    total_leads = total_regs = 0
+    for bot_nombre in sorted(bots.keys()):
+        numeros = db.reference(f"leads/{bot_nombre}").get(shallow=True) or {}
+        for numero in sorted(numeros.keys()):
+            ref = _lead_ref(bot_nombre, numero).child("historial")
+            historial = ref.get() or []
+            items = historial.items() if isinstance(historial, dict) else enumerate(historial)
+            cambios = {}
+            for idx, reg in items:
+                if isinstance(reg, dict) and not isinstance(reg.get("ts"), int):
+                    cambios[f"{idx}/ts"] = _hora_to_epoch_ms(reg.get("hora", ""))
+            if cambios:
+                ref.update(cambios)   # una escritura multi-path por lead
+                total_leads += 1
+                total_regs += len(cambios)
+    print(f"[BACKFILL] ts añadido a {total_regs} mensajes en {total_leads} leads.")
+
+@app.cli.command("rebuild-leads-index")
+def rebuild_leads_index():
+    """Reconstruye leads_index/ desde leads/ (el arranque ya lo hace si falta; esto fuerza una reconstrucción)."""
+    total = rebuild_index()
+    print(f"[LEADS_INDEX] {total} leads indexados.")
+
+# =======================
+#  💡 API móvil (Blueprint en /api/mobile)
+# =======================
+# bots/api_mobile hace "from main import ...": con "python main.py" este módulo es __main__
+sys.modules.setdefault("main", sys.modules[__name__])
+from bots.api_mobile import mobile_bp
+app.register_blueprint(mobile_bp, url_prefix="/api/mobile")
 
 # =======================
 #  Run
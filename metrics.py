@@ -0,0 +1,468 @@
+# metrics.py
+# Métricas estilo Prometheus (GET /metrics, formato de texto 0.0.4) sin dependencias
+# - Histogramas (buckets fijos), contadores y gauges con etiquetas (bot, route, model, op, ...)
+# - observe()/inc() solo tocan dicts bajo un lock, sin E/S: baratos con eventlet y miles de greenlets
+# - Colectores: funciones evaluadas solo al raspar (profundidad de colas, tamaños en memoria, ratios de caché)
+# - instrument_firebase(): cada round-trip de db.Reference / db.Query (op + raíz del path + ruta)
+# - instrument_twilio(): cada petición REST del SDK de Twilio (método + recurso + código)
+# - METRICS_ENABLED=0 apaga la medición; METRICS_MAX_SERIES acota la cardinalidad por métrica
+# - Varios workers (gunicorn -w N): con METRICS_DIR cada proceso vuelca sus series a <dir>/metrics_<pid>.json
+#   y /metrics (lo atienda quien lo atienda) suma contadores/histogramas de todos; los valores de colectores
+#   (colas, memoria, cachés) salen por worker con la etiqueta worker=<pid>. Sin METRICS_DIR cada worker
+#   expone solo lo suyo y todas sus series llevan worker=<pid> para no mezclar procesos distintos
+# - Retención en METRICS_DIR: cada proceso hace un último volcado al salir; al raspar, los volcados de PIDs
+#   muertos se suman a retired_metrics.json y se borran (los totales no retroceden y el directorio no crece)
+
+from contextlib import contextmanager
+import atexit
+import bisect
+import fcntl
+import functools
+import glob
+import json
+import os
+import re
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+
+METRICS_ENABLED = (os.environ.get("METRICS_ENABLED", "1") or "1").strip().lower() in ("1", "true", "on", "yes")
+METRICS_MAX_SERIES = int(os.environ.get("METRICS_MAX_SERIES", "2000") or 2000)
+METRICS_DIR = (os.environ.get("METRICS_DIR") or "").strip()
+METRICS_FLUSH_SEC = float(os.environ.get("METRICS_FLUSH_SEC", "5") or 5)
+
+# Segundos: de 5 ms (lecturas RTDB) a 30 s (OpenAI lento / TTS largo)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_meta = {}         # nombre -> (tipo, ayuda, buckets)
+_series = {}       # nombre -> {etiquetas(tuple) -> [cuentas por bucket..., suma, total] | valor}
+_collectors = []   # fn() -> [(nombre, {etiquetas}, valor)]
+_dropped = {"series": 0, "collector_errors": 0}
+
+# =======================
+# Definición
+# =======================
+def histogram(name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+    with _lock:
+        _meta.setdefault(name, ("histogram", help_text, tuple(sorted(buckets))))
+        _series.setdefault(name, {})
+
+def counter(name: str, help_text: str):
+    with _lock:
+        _meta.setdefault(name, ("counter", help_text, None))
+        _series.setdefault(name, {})
+
+def describe(name: str, help_text: str, kind: str = "gauge"):
+    """Métrica alimentada por colectores (se calcula al raspar): gauge o counter."""
+    with _lock:
+        _meta.setdefault(name, (kind, help_text, None))
+
+def register_collector(fn):
+    with _lock:
+        _collectors.append(fn)
+    return fn
+
+# =======================
+# Medición
+# =======================
+def _key(labels: dict) -> tuple:
+    return tuple(sorted((k, "" if v is None else str(v)) for k, v in labels.items()))
+
+def _slot(name: str, key: tuple, factory):
+    """Serie existente o nueva (si no se supera METRICS_MAX_SERIES); llamar con _lock tomado."""
+    por_serie = _series.setdefault(name, {})
+    cur = por_serie.get(key)
+    if cur is None:
+        if len(por_serie) >= METRICS_MAX_SERIES:
+            _dropped["series"] += 1
+            return None
+        cur = por_serie[key] = factory()
+    return cur
+
+def observe(name: str, value: float, **labels):
+    if not METRICS_ENABLED:
+        return
+    meta = _meta.get(name)
+    if meta is None:
+        histogram(name, name)
+        meta = _meta[name]
+    buckets = meta[2]
+    i = bisect.bisect_left(buckets, value)
+    with _lock:
+        h = _slot(name, _key(labels), lambda: [0] * (len(buckets) + 3))
+        if h is None:
+            return
+        h[i] += 1                 # buckets no acumulados; el último índice de bucket es +Inf
+        h[-2] += value
+        h[-1] += 1
+
+def inc(name: str, value: float = 1, **labels):
+    if not METRICS_ENABLED:
+        return
+    if name not in _meta:
+        counter(name, name)
+    with _lock:
+        por_serie = _series[name]
+        key = _key(labels)
+        if key not in por_serie and len(por_serie) >= METRICS_MAX_SERIES:
+            _dropped["series"] += 1
+            return
+        por_serie[key] = por_serie.get(key, 0) + value
+
+@contextmanager
+def timer(name: str, **labels):
+    """Mide el bloque; el dict devuelto admite etiquetas extra (p. ej. status) antes de salir."""
+    t0 = time.perf_counter()
+    try:
+        yield labels
+    except Exception:
+        labels.setdefault("status", "error")
+        raise
+    else:
+        labels.setdefault("status", "ok")
+    finally:
+        observe(name, time.perf_counter() - t0, **labels)
+
+def current_route() -> str:
+    """Plantilla de la ruta Flask en curso (baja cardinalidad) o 'background' fuera de una petición."""
+    if not has_request_context():
+        return "background"
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+def set_request_label(**labels):
+    """Etiquetas extra (p. ej. bot) para el histograma de la petición en curso."""
+    if has_request_context():
+        g.setdefault("_metrics_labels", {}).update(labels)
+
+# =======================
+# Exposición
+# =======================
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt_labels(key, extra=()) -> str:
+    pares = list(key) + list(extra)
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pares) + "}"
+
+def _fmt_num(v) -> str:
+    if isinstance(v, float):
+        return repr(v) if v != int(v) or abs(v) >= 1e15 else str(int(v))
+    return str(v)
+
+def _collect() -> dict:
+    """Valores de los colectores de este proceso: {nombre: {etiquetas: valor}}."""
+    recogidos = {}
+    for fn in list(_collectors):
+        try:
+            for name, labels, value in fn() or []:
+                if value is None:
+                    continue
+                recogidos.setdefault(name, {})[_key(labels or {})] = value
+        except Exception as e:
+            _dropped["collector_errors"] += 1
+            print(f"[metrics] ⚠️ Colector {getattr(fn, '__name__', fn)} falló: {e}")
+    return recogidos
+
+def _local() -> dict:
+    """Instantánea de este proceso en el mismo formato que los volcados de METRICS_DIR."""
+    recogidos = _collect()
+    with _lock:
+        return {
+            "pid": os.getpid(),
+            "meta": {n: [t, h, list(b) if b else None] for n, (t, h, b) in _meta.items()},
+            "series": {n: [[list(map(list, k)), v] for k, v in s.items()] for n, s in _series.items()},
+            "gauges": {n: [[list(map(list, k)), v] for k, v in s.items()] for n, s in recogidos.items()},
+            "dropped": dict(_dropped),
+        }
+
+def _dump_path(pid) -> str:
+    return os.path.join(METRICS_DIR, f"metrics_{pid}.json")
+
+def _dump(snap: dict):
+    """Escritura atómica (tmp + rename): otro worker nunca lee un archivo a medias."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    destino = _dump_path(snap["pid"])
+    tmp = f"{destino}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snap, f, separators=(",", ":"))
+    os.replace(tmp, destino)
+
+_RETIRED = "retired_metrics.json"
+
+def _load(path: str):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+def _add_rows(destino: dict, filas, pid=None):
+    """Suma filas [[etiquetas], valor] de contadores/histogramas en destino (con worker=pid si se pide)."""
+    for k, v in filas:
+        key = tuple(map(tuple, k))
+        key = _with_worker(key, pid) if pid is not None else key
+        cur = destino.get(key)
+        if cur is None:
+            destino[key] = list(v) if isinstance(v, list) else v
+        elif isinstance(v, list) and len(v) == len(cur):
+            destino[key] = [a + b for a, b in zip(cur, v)]
+        elif not isinstance(v, list):
+            destino[key] = cur + v
+
+def _retire_dead():
+    """Suma los volcados de PIDs muertos a retired_metrics.json y los borra (bajo flock: un solo worker a la vez)."""
+    muertos = []
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics_*.json")):
+        pid = os.path.basename(path)[len("metrics_"):-len(".json")]
+        if pid.isdigit() and int(pid) != os.getpid() and not _alive(int(pid)):
+            muertos.append(path)
+    if not muertos:
+        return
+    with open(os.path.join(METRICS_DIR, ".retire.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retirado = _load(os.path.join(METRICS_DIR, _RETIRED)) or {"pid": "retired", "meta": {}, "series": {}, "gauges": {}, "dropped": {}}
+        cambios = False
+        for path in muertos:
+            snap = _load(path)   # None si otro worker ya lo retiró
+            if snap is None:
+                continue
+            for name, m in snap.get("meta", {}).items():
+                retirado["meta"].setdefault(name, m)
+            for name, filas in snap.get("series", {}).items():
+                acumulado = {tuple(map(tuple, k)): v for k, v in retirado["series"].get(name, [])}
+                _add_rows(acumulado, filas)
+                retirado["series"][name] = [[list(map(list, k)), v] for k, v in acumulado.items()]
+            for k, v in (snap.get("dropped") or {}).items():
+                retirado["dropped"][k] = retirado["dropped"].get(k, 0) + v
+            cambios = True
+            os.remove(path)
+        if cambios:
+            destino = os.path.join(METRICS_DIR, _RETIRED)
+            with open(f"{destino}.tmp", "w", encoding="utf-8") as f:
+                json.dump(retirado, f, separators=(",", ":"))
+            os.replace(f"{destino}.tmp", destino)
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+
+def _snapshots() -> list:
+    """Este proceso + (con METRICS_DIR) el último volcado de los demás workers del nodo."""
+    propio = _local()
+    if not METRICS_DIR:
+        return [propio]
+    try:
+        _dump(propio)
+    except Exception as e:
+        print(f"[metrics] ⚠️ No se pudo volcar métricas en {METRICS_DIR}: {e}")
+    try:
+        _retire_dead()
+    except Exception as e:
+        print(f"[metrics] ⚠️ No se pudieron retirar volcados de workers muertos: {e}")
+    out = [propio]
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics_*.json")) + [os.path.join(METRICS_DIR, _RETIRED)]:
+        snap = _load(path)
+        if snap and snap.get("pid") != propio["pid"]:
+            out.append(snap)
+    return out
+
+def _snap_alive(snap: dict) -> bool:
+    pid = snap.get("pid")
+    return pid == os.getpid() or (isinstance(pid, int) and _alive(pid))
+
+def _with_worker(key: tuple, pid) -> tuple:
+    return _key({**dict(key), "worker": pid})
+
+def render() -> str:
+    snaps = _snapshots()
+    por_worker = not METRICS_DIR   # sin volcado compartido no se puede sumar: cada serie lleva su worker
+    meta, valores, dropped = {}, {}, {"series": 0, "collector_errors": 0}
+    for snap in snaps:
+        pid = snap["pid"]
+        for name, (tipo, ayuda, buckets) in snap["meta"].items():
+            meta.setdefault(name, (tipo, ayuda, tuple(buckets) if buckets else None))
+        for name, filas in snap["series"].items():
+            _add_rows(valores.setdefault(name, {}), filas, pid if por_worker else None)
+        # Gauges de colectores: solo de workers vivos (el último valor de uno muerto ya no describe nada)
+        if _snap_alive(snap):
+            for name, filas in snap["gauges"].items():
+                meta.setdefault(name, ("gauge", name, None))
+                destino = valores.setdefault(name, {})
+                for k, v in filas:
+                    destino[_with_worker(tuple(map(tuple, k)), pid)] = v
+        for k in dropped:
+            dropped[k] += (snap.get("dropped") or {}).get(k, 0)
+
+    lineas = []
+    for name in sorted(meta):
+        tipo, ayuda, buckets = meta[name]
+        series = valores.get(name) or {}
+        lineas.append(f"# HELP {name} {ayuda}")
+        lineas.append(f"# TYPE {name} {tipo}")
+        for key, val in sorted(series.items()):
+            if tipo == "histogram":
+                acumulado = 0
+                for le, n in zip(list(buckets) + ["+Inf"], val[:-2]):
+                    acumulado += n
+                    lineas.append(f"{name}_bucket{_fmt_labels(key, [('le', _fmt_num(float(le)) if le != '+Inf' else le)])} {acumulado}")
+                lineas.append(f"{name}_sum{_fmt_labels(key)} {_fmt_num(round(val[-2], 6))}")
+                lineas.append(f"{name}_count{_fmt_labels(key)} {val[-1]}")
+            else:
+                lineas.append(f"{name}{_fmt_labels(key)} {_fmt_num(val)}")
+    lineas.append("# TYPE metrics_dropped_series_total counter")
+    lineas.append(f"metrics_dropped_series_total {dropped['series']}")
+    lineas.append("# TYPE metrics_collector_errors_total counter")
+    lineas.append(f"metrics_collector_errors_total {dropped['collector_errors']}")
+    lineas.append("# TYPE metrics_workers gauge")
+    lineas.append(f"metrics_workers {sum(1 for sn in snaps if _snap_alive(sn))}")
+    return "\n".join(lineas) + "\n"
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_SEC)
+        try:
+            _dump(_local())
+        except Exception as e:
+            print(f"[metrics] ⚠️ No se pudo volcar métricas en {METRICS_DIR}: {e}")
+
+_flush_started = {"pid": 0}
+
+def start_flush():
+    """Volcado periódico a METRICS_DIR (uno por proceso; tras un fork el hijo arranca el suyo)."""
+    if not (METRICS_ENABLED and METRICS_DIR) or _flush_started["pid"] == os.getpid():
+        return
+    _flush_started["pid"] = os.getpid()
+    threading.Thread(target=_flush_loop, daemon=True).start()
+    atexit.register(_final_flush)
+
+def _final_flush():
+    """Último volcado al salir: lo contado desde el último flush entra en retired_metrics.json."""
+    if _flush_started["pid"] != os.getpid():
+        return
+    try:
+        _dump(_local())
+    except Exception as e:
+        print(f"[metrics] ⚠️ Volcado final de métricas falló: {e}")
+
+histogram("http_request_duration_seconds", "Tiempo total de la petición HTTP por ruta (plantilla), método, clase de estado y bot.")
+
+def init_app(app, auth=None):
+    """Histograma por petición + GET /metrics (auth(request) -> bool protege el endpoint)."""
+
+    @app.before_request
+    def _metrics_start():
+        start_flush()
+        g._metrics_t0 = time.perf_counter()
+
+    @app.after_request
+    def _metrics_observe(resp):
+        t0 = g.pop("_metrics_t0", None)
+        if t0 is not None and request.endpoint != "metrics_endpoint":
+            observe(
+                "http_request_duration_seconds", time.perf_counter() - t0,
+                route=current_route(), method=request.method, status=f"{resp.status_code // 100}xx",
+                **{"bot": "", **g.get("_metrics_labels", {})},
+            )
+        return resp
+
+    @app.route("/metrics", methods=["GET"], endpoint="metrics_endpoint")
+    def metrics_endpoint():
+        if auth is not None and not auth(request):
+            return Response("No autenticado\n", status=401, mimetype="text/plain")
+        return Response(render(), mimetype="text/plain", headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+# =======================
+# Instrumentación de SDKs (un solo punto por round-trip)
+# =======================
+histogram("firebase_request_seconds", "Round-trip a Firebase RTDB por operación, raíz del path y ruta.")
+histogram("twilio_request_seconds", "Petición REST a Twilio por método, recurso y clase de estado.")
+
+_FB_OPS = {
+    "get": "read", "get_if_changed": "read",
+    "set": "write", "set_if_unchanged": "write", "update": "write", "push": "write", "delete": "write",
+}
+
+def _fb_root(pathurl: str) -> str:
+    path = (pathurl or "").strip("/")
+    if path.endswith(".json"):
+        path = path[:-5]
+    return path.split("/", 1)[0] or "/"
+
+def _wrap(cls, meth: str, on_done):
+    orig = getattr(cls, meth, None)
+    if orig is None or getattr(orig, "_metrics_wrapped", False):
+        return
+
+    @functools.wraps(orig)
+    def wrapper(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        status, result = "ok", None
+        try:
+            result = orig(self, *args, **kwargs)
+            return result
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            on_done(self, args, kwargs, time.perf_counter() - t0, status, result)
+
+    wrapper._metrics_wrapped = True
+    setattr(cls, meth, wrapper)
+
+def instrument_firebase():
+    """Envuelve db.Reference / db.Query. transaction() no se envuelve: sus get + set_if_unchanged ya cuentan."""
+    if not METRICS_ENABLED:
+        return
+    from firebase_admin import db
+
+    for meth, kind in _FB_OPS.items():
+        _wrap(db.Reference, meth, lambda self, a, kw, dt, st, res, _op=meth, _kind=kind: observe(
+            "firebase_request_seconds", dt, op=_op, kind=_kind, root=_fb_root(getattr(self, "path", "")),
+            route=current_route(), status=st))
+    _wrap(db.Query, "get", lambda self, a, kw, dt, st, res: observe(
+        "firebase_request_seconds", dt, op="query", kind="read", root=_fb_root(getattr(self, "_pathurl", "")),
+        route=current_route(), status=st))
+
+_SID_RE = re.compile(r"^[A-Z]{2}[0-9a-f]{32}$")
+
+def _twilio_resource(url: str) -> str:
+    path = (url or "").split("?", 1)[0]
+    segs = [s[:-5] if s.endswith(".json") else s for s in path.split("/")[3:] if s]
+    segs = [s for s in segs if not _SID_RE.match(s) and s not in ("2010-04-01", "v1", "v2")]
+    return segs[-1] if segs else "/"
+
+def instrument_twilio():
+    if not METRICS_ENABLED:
+        return
+    from twilio.http.http_client import TwilioHttpClient
+
+    def _done(self, args, kwargs, dt, st, res):
+        method = args[0] if args else kwargs.get("method", "")
+        url = args[1] if len(args) > 1 else kwargs.get("url", "")
+        code = getattr(res, "status_code", 0) or 0
+        observe("twilio_request_seconds", dt, method=str(method).upper(), resource=_twilio_resource(url),
+                status=f"{code // 100}xx" if code else st, route=current_route())
+
+    _wrap(TwilioHttpClient, "request", _done)
+
+def metrics_stats() -> dict:
+    with _lock:
+        return {
+            "enabled": METRICS_ENABLED,
+            "metrics": len(_meta),
+            "series": sum(len(s) for s in _series.values()),
+            "collectors": len(_collectors),
+            "dropped_series": _dropped["series"],
+            "dir": METRICS_DIR,
+            "pid": os.getpid(),
+        }
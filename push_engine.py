@@ -0,0 +1,155 @@
+# push_engine.py
+# Envío FCM a muchos tokens (difusiones grandes en segundos)
+# - Trozos de 500 tokens (límite de MulticastMessage) enviados en paralelo acotado (PUSH_MAX_PARALLEL)
+# - send_each_for_multicast: resultado por token (send_multicast está obsoleto)
+# - Tokens muertos (Unregistered / SenderIdMismatch) se borran de push_tokens/ en una escritura multi-path
+# - Registro de tokens: push_tokens/<sha1(token)> = {token, platform, bot, user, updated}
+# - Reglas de RTDB recomendadas: "push_tokens": {".indexOn": ["bot"]}
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import os
+import threading
+import time
+
+from firebase_admin import db
+from firebase_admin import messaging as fcm
+
+FCM_MULTICAST_MAX = 500
+PUSH_MAX_PARALLEL = int(os.environ.get("PUSH_MAX_PARALLEL", "8") or 8)
+PUSH_FAILURES_REPORTED = int(os.environ.get("PUSH_FAILURES_REPORTED", "100") or 100)
+
+# Errores que significan "este token ya no sirve": se eliminan del registro
+_DEAD_ERRORS = tuple(
+    e for e in (getattr(fcm, "UnregisteredError", None), getattr(fcm, "SenderIdMismatchError", None)) if e
+)
+
+_lock = threading.Lock()
+_stats = {"broadcasts": 0, "tokens": 0, "sent": 0, "failed": 0, "pruned": 0, "last_took_ms": 0.0}
+
+# =======================
+# Registro de tokens
+# =======================
+def token_key(token: str) -> str:
+    return hashlib.sha1(token.encode("utf-8")).hexdigest()
+
+def register_token(token: str, platform: str = "", bot: str = "", user: str = "") -> str:
+    key = token_key(token)
+    db.reference(f"push_tokens/{key}").set({
+        "token": token,
+        "platform": platform,
+        "bot": bot,
+        "user": user,
+        "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    })
+    return key
+
+def unregister_tokens(tokens) -> int:
+    """Quita tokens del registro en una sola escritura multi-path."""
+    cambios = {f"push_tokens/{token_key(t)}": None for t in set(tokens or []) if t}
+    if cambios:
+        db.reference().update(cambios)
+    return len(cambios)
+
+def registered_tokens(bot: str = "") -> list:
+    ref = db.reference("push_tokens")
+    if bot:
+        try:
+            data = ref.order_by_child("bot").equal_to(bot).get() or {}
+        except Exception as e:
+            print(f"[push_engine] ⚠️ Consulta por bot falló (¿falta .indexOn?), leyendo registro completo: {e}")
+            data = {k: v for k, v in (ref.get() or {}).items() if isinstance(v, dict) and v.get("bot") == bot}
+    else:
+        data = ref.get() or {}
+    return [v["token"] for v in data.values() if isinstance(v, dict) and v.get("token")]
+
+# =======================
+# Envío
+# =======================
+def _chunks(seq: list, n: int):
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+def _send_chunk(chunk: list, title: str, body: str, data: dict):
+    try:
+        msg = fcm.MulticastMessage(
+            tokens=chunk,
+            notification=fcm.Notification(title=title, body=body),
+            data=data or {},
+        )
+        return chunk, fcm.send_each_for_multicast(msg)
+    except Exception as e:
+        return chunk, e
+
+def send_to_tokens(tokens, title: str, body: str, data: dict = None, prune: bool = True) -> dict:
+    """
+    Envía a todos los tokens (deduplicados) en trozos de 500 con PUSH_MAX_PARALLEL trozos en vuelo.
+    Devuelve estadísticas agregadas + los primeros PUSH_FAILURES_REPORTED fallos por token.
+    """
+    t0 = time.perf_counter()
+    unicos = list(dict.fromkeys(str(t).strip() for t in (tokens or []) if str(t).strip()))
+    trozos = list(_chunks(unicos, FCM_MULTICAST_MAX))
+    sent, failed = 0, 0
+    errors = {}       # tipo de error -> cuántos
+    failures = []     # [{"token", "error"}]
+    dead = []
+
+    def _fail(token, err_name):
+        nonlocal failed
+        failed += 1
+        errors[err_name] = errors.get(err_name, 0) + 1
+        if len(failures) < PUSH_FAILURES_REPORTED:
+            failures.append({"token": token, "error": err_name})
+
+    if trozos:
+        workers = max(1, min(PUSH_MAX_PARALLEL, len(trozos)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for chunk, resp in pool.map(lambda c: _send_chunk(c, title, body, data), trozos):
+                if isinstance(resp, Exception):
+                    print(f"[push_engine] ❌ Trozo de {len(chunk)} tokens falló: {resp}")
+                    for tok in chunk:
+                        _fail(tok, type(resp).__name__)
+                    continue
+                for tok, r in zip(chunk, resp.responses):
+                    if r.success:
+                        sent += 1
+                        continue
+                    _fail(tok, type(r.exception).__name__ if r.exception else "Unknown")
+                    if _DEAD_ERRORS and isinstance(r.exception, _DEAD_ERRORS):
+                        dead.append(tok)
+
+    pruned = 0
+    if prune and dead:
+        try:
+            pruned = unregister_tokens(dead)
+        except Exception as e:
+            print(f"[push_engine] ⚠️ No se pudieron eliminar {len(dead)} tokens muertos: {e}")
+
+    took_ms = round((time.perf_counter() - t0) * 1000, 1)
+    with _lock:
+        _stats["broadcasts"] += 1
+        _stats["tokens"] += len(unicos)
+        _stats["sent"] += sent
+        _stats["failed"] += failed
+        _stats["pruned"] += pruned
+        _stats["last_took_ms"] = took_ms
+    print(f"[push_engine] 🔔 {sent}/{len(unicos)} enviados en {len(trozos)} trozos ({took_ms} ms, {pruned} tokens eliminados)")
+    return {
+        "requested": len(tokens or []),
+        "unique": len(unicos),
+        "chunks": len(trozos),
+        "sent": sent,
+        "failed": failed,
+        "pruned": pruned,
+        "errors": errors,
+        "failures": failures,
+        "took_ms": took_ms,
+    }
+
+def is_dead_token_error(exc) -> bool:
+    return bool(_DEAD_ERRORS) and isinstance(exc, _DEAD_ERRORS)
+
+def push_stats() -> dict:
+    with _lock:
+        return {**_stats, "max_parallel": PUSH_MAX_PARALLEL, "chunk_size": FCM_MULTICAST_MAX}
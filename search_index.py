@@ -0,0 +1,262 @@
+# search_index.py
+# Búsqueda de texto completo sobre los historiales, en memoria del proceso
+# - Índice invertido por bot: término normalizado -> ids de mensaje
+# - Normalización sin acentos ni mayúsculas (español/inglés): "Niño" == "nino"
+# - Prefijos con bisect sobre la lista ordenada de términos ("cot" -> "cotización")
+# - Incremental: lo alimenta fb_append_historial(_batch); se reconstruye desde Firebase al arrancar
+# - Las consultas no leen Firebase
+# - Requiere UN solo worker: el índice vive en la memoria del proceso, cada worker descargaría el árbol
+#   leads/ completo al arrancar y solo vería sus propias escrituras. Con WEB_CONCURRENCY > 1 queda
+#   desactivado salvo SEARCH_ENABLED=1 explícito (aceptando resultados por worker)
+
+import bisect
+import itertools
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from firebase_admin import db
+
+SEARCH_SNIPPET_CHARS = int(os.environ.get("SEARCH_SNIPPET_CHARS", "160") or 160)
+SEARCH_PREFIX_MAX_TERMS = int(os.environ.get("SEARCH_PREFIX_MAX_TERMS", "200") or 200)
+SEARCH_MIN_TERM = 2
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1") or 1)
+SEARCH_ENABLED = (os.environ.get("SEARCH_ENABLED", "1" if WEB_CONCURRENCY <= 1 else "0") or "0").strip().lower() in ("1", "true", "on", "yes")
+if not SEARCH_ENABLED:
+    print(f"[search_index] ⚠️ Búsqueda en memoria desactivada (WEB_CONCURRENCY={WEB_CONCURRENCY}); requiere un solo worker.")
+
+_STOPWORDS = {
+    # español
+    "de", "la", "el", "en", "y", "a", "los", "las", "del", "un", "una", "por", "con", "para", "que",
+    "es", "se", "lo", "al", "mi", "tu", "su", "me", "te", "no", "si",
+    # inglés
+    "the", "and", "to", "of", "in", "is", "it", "for", "on", "at", "an", "be", "my", "you", "i",
+}
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# =======================
+# Estado (runtime)
+# =======================
+_lock = threading.Lock()
+_bots = {}          # bot -> índice (ver _new_bot_index)
+_rebuilding = {}    # bot -> [entradas llegadas durante la reconstrucción]
+_ids = itertools.count(1)   # next() es atómico: sirve también fuera de _lock (reconstrucción)
+_stats = {"queries": 0, "indexed": 0, "last_rebuild_sec": 0.0}
+
+
+def normalize(texto: str) -> str:
+    """Minúsculas y sin diacríticos (ñ -> n, á -> a)."""
+    nfkd = unicodedata.normalize("NFKD", (texto or "").lower())
+    return "".join(c for c in nfkd if not unicodedata.combining(c))
+
+def tokenize(texto: str) -> list:
+    return [t for t in _TOKEN_RE.findall(normalize(texto)) if len(t) >= SEARCH_MIN_TERM and t not in _STOPWORDS]
+
+def _new_bot_index() -> dict:
+    return {
+        "postings": {},   # término -> set(doc_id)
+        "terms": [],      # términos ordenados (prefijos con bisect)
+        "docs": {},       # doc_id -> (numero, ts, tipo, hora, snippet, términos, firma)
+        "by_lead": {},    # numero -> set(doc_id)
+        "sigs": set(),    # (numero, ts, tipo, texto) ya indexados (deduplicación)
+    }
+
+def _add(idx: dict, numero: str, entrada: dict) -> int:
+    """Indexa un mensaje (con _lock tomado o sobre un índice aún privado); 1 si se añadió. No toca _stats."""
+    texto = (entrada or {}).get("texto", "") or ""
+    ts = entrada.get("ts") if isinstance(entrada.get("ts"), int) else 0
+    tipo = entrada.get("tipo", "user")
+    sig = (numero, ts, tipo, texto)
+    if not texto or sig in idx["sigs"]:
+        return 0
+    terms = tuple(set(tokenize(texto)))
+    if not terms:
+        return 0
+    doc_id = next(_ids)
+    idx["sigs"].add(sig)
+    idx["docs"][doc_id] = (numero, ts, tipo, entrada.get("hora", ""), texto[:SEARCH_SNIPPET_CHARS], terms, sig)
+    idx["by_lead"].setdefault(numero, set()).add(doc_id)
+    for t in terms:
+        ids = idx["postings"].get(t)
+        if ids is None:
+            idx["postings"][t] = ids = set()
+            bisect.insort(idx["terms"], t)
+        ids.add(doc_id)
+    return 1
+
+def _remove_lead(idx: dict, numero: str):
+    for doc_id in idx["by_lead"].pop(numero, set()):
+        doc = idx["docs"].pop(doc_id, None)
+        if not doc:
+            continue
+        idx["sigs"].discard(doc[6])
+        for t in doc[5]:
+            ids = idx["postings"].get(t)
+            if ids is None:
+                continue
+            ids.discard(doc_id)
+            if not ids:
+                del idx["postings"][t]
+                i = bisect.bisect_left(idx["terms"], t)
+                if i < len(idx["terms"]) and idx["terms"][i] == t:
+                    del idx["terms"][i]
+
+# =======================
+# Camino de escritura
+# =======================
+def index_messages(bot: str, numero: str, entradas):
+    if not SEARCH_ENABLED:
+        return
+    with _lock:
+        idx = _bots.setdefault(bot, _new_bot_index())
+        pendientes = _rebuilding.get(bot)
+        for e in entradas or []:
+            if isinstance(e, dict):
+                _stats["indexed"] += _add(idx, numero, e)
+                if pendientes is not None:
+                    pendientes.append((numero, e))
+
+def index_message(bot: str, numero: str, entrada: dict):
+    index_messages(bot, numero, [entrada])
+
+def remove_lead(bot: str, numero: str):
+    """Lead borrado o historial vaciado."""
+    if not SEARCH_ENABLED:
+        return
+    with _lock:
+        idx = _bots.get(bot)
+        if idx:
+            _remove_lead(idx, numero)
+        pendientes = _rebuilding.get(bot)
+        if pendientes is not None:
+            pendientes.append((numero, None))
+
+# =======================
+# Consulta
+# =======================
+def _matching_docs(idx: dict, token: str) -> set:
+    """Unión de postings de todos los términos que empiezan por 'token'."""
+    terms = idx["terms"]
+    out = set()
+    i = bisect.bisect_left(terms, token)
+    n = 0
+    while i < len(terms) and terms[i].startswith(token) and n < SEARCH_PREFIX_MAX_TERMS:
+        out |= idx["postings"][terms[i]]
+        i += 1
+        n += 1
+    return out
+
+def search(q: str, bots=None, limit: int = 20) -> dict:
+    """
+    Leads cuyo historial contiene TODOS los términos de q (cada uno como prefijo).
+    bots: lista de bots a consultar (None = todos). Resultado ordenado por mensaje más reciente.
+    """
+    t0 = time.perf_counter()
+    tokens = tokenize(q)
+    results = []
+    if tokens and SEARCH_ENABLED:
+        with _lock:
+            _stats["queries"] += 1
+            objetivo = list(_bots.keys()) if bots is None else [b for b in bots if b in _bots]
+            for bot in objetivo:
+                idx = _bots[bot]
+                docs = None
+                for tok in sorted(set(tokens), key=len, reverse=True):
+                    m = _matching_docs(idx, tok)
+                    docs = m if docs is None else docs & m
+                    if not docs:
+                        break
+                por_lead = {}
+                for doc_id in docs or ():
+                    numero, ts, tipo, hora, snippet, _, _ = idx["docs"][doc_id]
+                    r = por_lead.get(numero)
+                    if r is None:
+                        r = por_lead[numero] = {"bot": bot, "numero": numero, "hits": 0, "last_ts": -1, "snippet": None}
+                    r["hits"] += 1
+                    if ts >= r["last_ts"]:
+                        r["last_ts"] = ts
+                        r["snippet"] = {"texto": snippet, "hora": hora, "tipo": tipo, "ts": ts}
+                results.extend(por_lead.values())
+    results.sort(key=lambda r: (r["last_ts"], r["hits"]), reverse=True)
+    return {
+        "query": q,
+        "terms": tokens,
+        "total": len(results),
+        "results": results[:max(1, int(limit or 20))],
+        "took_ms": round((time.perf_counter() - t0) * 1000, 3),
+        "enabled": SEARCH_ENABLED,
+    }
+
+# =======================
+# Reconstrucción
+# =======================
+def _as_list(historial):
+    if isinstance(historial, dict):
+        return [historial[k] for k in sorted(historial.keys())]
+    return [h for h in (historial or []) if h is not None]
+
+def rebuild_bot(bot: str) -> int:
+    """Reconstruye el índice de un bot desde leads/<bot> y lo intercambia de forma atómica."""
+    with _lock:
+        _rebuilding[bot] = []
+    try:
+        numeros = db.reference(f"leads/{bot}").get() or {}
+        nuevo = _new_bot_index()
+        n = 0   # índice privado: se construye sin _lock y el contador se suma al intercambiarlo
+        if isinstance(numeros, dict):
+            for numero, lead in numeros.items():
+                if not isinstance(lead, dict):
+                    continue
+                for e in _as_list(lead.get("historial")):
+                    if isinstance(e, dict):
+                        n += _add(nuevo, numero, e)
+        with _lock:
+            # Escrituras que llegaron mientras leíamos Firebase
+            for numero, e in _rebuilding.get(bot) or []:
+                if e is None:
+                    _remove_lead(nuevo, numero)
+                else:
+                    n += _add(nuevo, numero, e)
+            _stats["indexed"] += n
+            _bots[bot] = nuevo
+            return len(nuevo["docs"])
+    finally:
+        with _lock:
+            _rebuilding.pop(bot, None)
+
+def rebuild_all() -> dict:
+    if not SEARCH_ENABLED:
+        return {}
+    t0 = time.time()
+    bots = db.reference("leads").get(shallow=True) or {}
+    out = {}
+    for bot in sorted(bots.keys()):
+        try:
+            out[bot] = rebuild_bot(bot)
+        except Exception as e:
+            print(f"[search_index] ⚠️ Error reconstruyendo {bot}: {e}")
+    with _lock:
+        _stats["last_rebuild_sec"] = round(time.time() - t0, 3)
+        segundos = _stats["last_rebuild_sec"]
+    print(f"[search_index] Índice reconstruido: {sum(out.values())} mensajes en {len(out)} bots ({segundos} s)")
+    return out
+
+def start_rebuild():
+    """Reconstrucción inicial en segundo plano (no bloquea el arranque)."""
+    if not SEARCH_ENABLED:
+        return
+    threading.Thread(target=rebuild_all, daemon=True).start()
+
+def search_stats() -> dict:
+    with _lock:
+        return {
+            "bots": len(_bots),
+            "docs": sum(len(i["docs"]) for i in _bots.values()),
+            "terms": sum(len(i["terms"]) for i in _bots.values()),
+            "rebuilding": list(_rebuilding.keys()),
+            "enabled": SEARCH_ENABLED,
+            **_stats,
+        }
@@ -0,0 +1,323 @@
+# state_backend.py
+# Estado de conversación compartible entre workers y nodos
+# - Interfaz mínima (get/set/delete, listas, contadores) por espacio de nombres + clave
+# - "memory": dicts del proceso (comportamiento histórico; solo válido con 1 worker)
+# - "sqlite": archivo local en modo WAL (N workers en el mismo nodo)
+# - "redis":  servidor Redis/Valkey/KeyDB (N workers en varios nodos)
+# - Selección por entorno: STATE_BACKEND=memory|sqlite|redis, STATE_SQLITE_PATH, STATE_REDIS_URL
+# - Todos los valores son JSON; cada clave expira a los STATE_TTL_SEC sin escrituras
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    from eventlet import patcher as _patcher, tpool as _tpool
+except ImportError:   # sin eventlet (scripts, tests): llamadas directas
+    _patcher = _tpool = None
+
+STATE_BACKEND = (os.environ.get("STATE_BACKEND") or "memory").strip().lower()
+STATE_TTL_SEC = int(os.environ.get("STATE_TTL_SEC", str(7 * 24 * 3600)) or 7 * 24 * 3600)
+STATE_SQLITE_PATH = (os.environ.get("STATE_SQLITE_PATH") or "/tmp/bot_state.sqlite3").strip()
+STATE_REDIS_URL = (os.environ.get("STATE_REDIS_URL") or os.environ.get("REDIS_URL") or "redis://127.0.0.1:6379/0").strip()
+STATE_PREFIX = (os.environ.get("STATE_PREFIX") or "mbi").strip()
+
+
+class MemoryBackend:
+    """Dicts en memoria del proceso (con expiración perezosa)."""
+    name = "memory"
+
+    def __init__(self, ttl: int = STATE_TTL_SEC):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = {}   # (ns, key) -> (value, expires)
+
+    def _live(self, k):
+        item = self._data.get(k)
+        if item is None:
+            return None
+        if item[1] and item[1] < time.time():
+            self._data.pop(k, None)
+            return None
+        return item
+
+    def get(self, ns, key, default=None):
+        with self._lock:
+            item = self._live((ns, key))
+            return default if item is None else item[0]
+
+    def get_many(self, ns, keys) -> list:
+        with self._lock:
+            out = []
+            for key in keys:
+                item = self._live((ns, key))
+                out.append(None if item is None else item[0])
+            return out
+
+    def set(self, ns, key, value):
+        with self._lock:
+            self._data[(ns, key)] = (value, time.time() + self.ttl if self.ttl else 0)
+
+    def delete(self, ns, key):
+        with self._lock:
+            self._data.pop((ns, key), None)
+
+    def exists(self, ns, key) -> bool:
+        with self._lock:
+            return self._live((ns, key)) is not None
+
+    def list_get(self, ns, key) -> list:
+        return list(self.get(ns, key) or [])
+
+    def list_set(self, ns, key, items):
+        self.set(ns, key, list(items))
+
+    def list_append(self, ns, key, *items):
+        with self._lock:
+            item = self._live((ns, key))
+            cur = list(item[0]) if item else []
+            cur.extend(items)
+            self._data[(ns, key)] = (cur, time.time() + self.ttl if self.ttl else 0)
+
+    def incr(self, ns, key) -> int:
+        with self._lock:
+            item = self._live((ns, key))
+            val = int(item[0]) + 1 if item else 1
+            self._data[(ns, key)] = (val, time.time() + self.ttl if self.ttl else 0)
+            return val
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def purge(self) -> int:
+        now = time.time()
+        with self._lock:
+            viejas = [k for k, (_, exp) in self._data.items() if exp and exp < now]
+            for k in viejas:
+                self._data.pop(k, None)
+            return len(viejas)
+
+
+class SQLiteBackend:
+    """
+    Tabla clave/valor en un archivo SQLite (WAL): compartida por los procesos del mismo nodo.
+    Una sola conexión por proceso detrás de un lock: con eventlet threading.local() es por greenlet
+    (una conexión nueva por petición), así que más conexiones no dan paralelismo.
+    Con eventlet las llamadas a sqlite3 se ejecutan en un hilo real (tpool): la E/S de disco y las
+    esperas de BEGIN IMMEDIATE no paran el hub ni al resto de greenlets del worker.
+    """
+    name = "sqlite"
+
+    def __init__(self, path: str = STATE_SQLITE_PATH, ttl: int = STATE_TTL_SEC):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=10000")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS kv (ns TEXT NOT NULL, k TEXT NOT NULL, v TEXT NOT NULL, exp REAL NOT NULL, "
+            "PRIMARY KEY (ns, k)) WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS kv_exp ON kv (exp)")
+
+    @staticmethod
+    def _blocking(fn, *args):
+        """Ejecuta fn fuera del hub si eventlet parcheó los hilos (gunicorn -k eventlet)."""
+        if _tpool is not None and _patcher.is_monkey_patched("thread"):
+            return _tpool.execute(fn, *args)
+        return fn(*args)
+
+    def _q(self, sql: str, params=(), fetch: str = ""):
+        """Una sentencia con la conexión compartida; fetch = 'one' | 'all' | '' (rowcount)."""
+        with self._lock:
+            return self._blocking(self._exec, sql, params, fetch)
+
+    def _exec(self, sql: str, params, fetch: str):
+        cur = self._db.execute(sql, params)
+        if fetch == "one":
+            return cur.fetchone()
+        if fetch == "all":
+            return cur.fetchall()
+        return cur.rowcount
+
+    def _exp(self) -> float:
+        return time.time() + self.ttl if self.ttl else 1e18
+
+    def get(self, ns, key, default=None):
+        row = self._q("SELECT v FROM kv WHERE ns=? AND k=? AND exp>?", (ns, key, time.time()), "one")
+        return default if row is None else json.loads(row[0])
+
+    def get_many(self, ns, keys) -> list:
+        keys = list(keys)
+        if not keys:
+            return []
+        marks = ",".join("?" * len(keys))
+        rows = self._q(f"SELECT k, v FROM kv WHERE ns=? AND exp>? AND k IN ({marks})", [ns, time.time()] + keys, "all")
+        found = {k: json.loads(v) for k, v in rows}
+        return [found.get(k) for k in keys]
+
+    def set(self, ns, key, value):
+        self._q(
+            "INSERT OR REPLACE INTO kv (ns, k, v, exp) VALUES (?, ?, ?, ?)",
+            (ns, key, json.dumps(value, ensure_ascii=False), self._exp()),
+        )
+
+    def delete(self, ns, key):
+        self._q("DELETE FROM kv WHERE ns=? AND k=?", (ns, key))
+
+    def exists(self, ns, key) -> bool:
+        return self._q("SELECT 1 FROM kv WHERE ns=? AND k=? AND exp>?", (ns, key, time.time()), "one") is not None
+
+    def list_get(self, ns, key) -> list:
+        return list(self.get(ns, key) or [])
+
+    def list_set(self, ns, key, items):
+        self.set(ns, key, list(items))
+
+    def _rmw(self, ns, key, fn):
+        """Lectura-modificación-escritura atómica entre procesos (BEGIN IMMEDIATE) y entre greenlets (lock)."""
+        with self._lock:
+            return self._blocking(self._rmw_tx, ns, key, fn)
+
+    def _rmw_tx(self, ns, key, fn):
+        conn = self._db
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT v FROM kv WHERE ns=? AND k=? AND exp>?", (ns, key, time.time())).fetchone()
+            val = fn(json.loads(row[0]) if row else None)
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (ns, k, v, exp) VALUES (?, ?, ?, ?)",
+                (ns, key, json.dumps(val, ensure_ascii=False), self._exp()),
+            )
+            conn.execute("COMMIT")
+            return val
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def list_append(self, ns, key, *items):
+        self._rmw(ns, key, lambda cur: list(cur or []) + list(items))
+
+    def incr(self, ns, key) -> int:
+        return self._rmw(ns, key, lambda cur: int(cur or 0) + 1)
+
+    def size(self) -> int:
+        return self._q("SELECT COUNT(*) FROM kv WHERE exp>?", (time.time(),), "one")[0]
+
+    def purge(self) -> int:
+        return self._q("DELETE FROM kv WHERE exp<=?", (time.time(),))
+
+
+class RedisBackend:
+    """
+    Redis (o compatible): compartido entre nodos. Listas como RPUSH de JSON; TTL nativo.
+    Redis no guarda listas vacías: una lista vacía se marca con la clave "<k>:e" para que
+    exists() sea True igual que en memory/sqlite.
+    """
+    name = "redis"
+
+    def __init__(self, url: str = STATE_REDIS_URL, ttl: int = STATE_TTL_SEC, prefix: str = STATE_PREFIX):
+        import redis   # opcional: solo si STATE_BACKEND=redis
+        self.r = redis.Redis.from_url(url)
+        self.r.ping()
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _k(self, ns, key) -> str:
+        return f"{self.prefix}:{ns}:{key}"
+
+    def get(self, ns, key, default=None):
+        raw = self.r.get(self._k(ns, key))
+        return default if raw is None else json.loads(raw)
+
+    def get_many(self, ns, keys) -> list:
+        keys = list(keys)
+        if not keys:
+            return []
+        return [None if raw is None else json.loads(raw) for raw in self.r.mget([self._k(ns, k) for k in keys])]
+
+    def set(self, ns, key, value):
+        self.r.set(self._k(ns, key), json.dumps(value, ensure_ascii=False), ex=self.ttl or None)
+
+    def delete(self, ns, key):
+        k = self._k(ns, key)
+        self.r.delete(k, k + ":l", k + ":e")
+
+    def exists(self, ns, key) -> bool:
+        k = self._k(ns, key)
+        return bool(self.r.exists(k, k + ":l", k + ":e"))
+
+    def list_get(self, ns, key) -> list:
+        return [json.loads(x) for x in self.r.lrange(self._k(ns, key) + ":l", 0, -1)]
+
+    def list_set(self, ns, key, items):
+        k = self._k(ns, key) + ":l"
+        pipe = self.r.pipeline()
+        pipe.delete(k, self._k(ns, key) + ":e")
+        if items:
+            pipe.rpush(k, *[json.dumps(i, ensure_ascii=False) for i in items])
+            if self.ttl:
+                pipe.expire(k, self.ttl)
+        else:
+            pipe.set(self._k(ns, key) + ":e", 1, ex=self.ttl or None)   # existe pero vacía
+        pipe.execute()
+
+    def list_append(self, ns, key, *items):
+        k = self._k(ns, key) + ":l"
+        pipe = self.r.pipeline()
+        pipe.delete(self._k(ns, key) + ":e")
+        pipe.rpush(k, *[json.dumps(i, ensure_ascii=False) for i in items])
+        if self.ttl:
+            pipe.expire(k, self.ttl)
+        pipe.execute()
+
+    def incr(self, ns, key) -> int:
+        k = self._k(ns, key)
+        pipe = self.r.pipeline()
+        pipe.incr(k)
+        if self.ttl:
+            pipe.expire(k, self.ttl)
+        return int(pipe.execute()[0])
+
+    def size(self):
+        return None   # contar claves con prefijo exige SCAN: no se expone
+
+    def purge(self) -> int:
+        return 0   # Redis expira solo
+
+
+def make_backend(kind: str = STATE_BACKEND, **opciones):
+    """
+    opciones se pasan al constructor (p. ej. path= para sqlite, url= para redis).
+    Solo "memory" (o vacío) da memoria: si se pidió sqlite/redis y no arranca, se lanza RuntimeError
+    en vez de caer en silencio a dicts por proceso (con N workers se perdería el contexto).
+    """
+    kind = (kind or "memory").strip().lower()
+    if kind == "memory":
+        return MemoryBackend(**opciones)
+    if kind not in ("sqlite", "redis"):
+        raise RuntimeError(f"STATE_BACKEND desconocido '{kind}' (memory | sqlite | redis)")
+    try:
+        return SQLiteBackend(**opciones) if kind == "sqlite" else RedisBackend(**opciones)
+    except Exception as e:
+        raise RuntimeError(f"No se pudo iniciar el backend de estado '{kind}': {e}") from e
+
+
+state = make_backend()
+print(f"[state_backend] Backend de estado: {state.name}")
+
+
+def _purge_loop():
+    while True:
+        time.sleep(3600)
+        try:
+            state.purge()
+        except Exception as e:
+            print(f"[state_backend] ⚠️ Error purgando claves vencidas: {e}")
+
+threading.Thread(target=_purge_loop, daemon=True).start()
@@ -0,0 +1,5 @@
+# Los módulos de la app viven en la raíz del repo (no hay paquete instalable)
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
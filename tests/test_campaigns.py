@@ -0,0 +1,24 @@
+# Plantillas de campaña: solo variables públicas del lead; nunca las notas internas
+import campaigns as C
+
+
+LEAD = {"bot": "Sara", "numero": "whatsapp:+15551234567", "status": "nuevo", "notes": "NOTA INTERNA: no llamar"}
+
+
+def test_known_variables():
+    assert C.render_template("Hola de {bot}: {numero} ({estado})", LEAD) == "Hola de Sara: +15551234567 (nuevo)"
+
+
+def test_notes_are_never_rendered():
+    texto = C.render_template("Hola {nombre} {notes} {nota}", LEAD)
+    assert "NOTA INTERNA" not in texto
+    assert texto == "Hola {nombre} {notes} {nota}"
+
+
+def test_unknown_variables_stay_literal():
+    assert C.render_template("{desconocida} y {bot}", LEAD) == "{desconocida} y Sara"
+
+
+def test_empty_template_and_lead():
+    assert C.render_template("", LEAD) == ""
+    assert C.render_template("{numero}|{bot}", {}) == "|"
@@ -0,0 +1,65 @@
+# ETag por versión y GET condicional (backend de estado en memoria, un solo worker)
+import pytest
+from flask import Flask
+
+import http_cache as H
+
+
+@pytest.fixture
+def app():
+    return Flask(__name__)
+
+
+def test_etag_changes_when_the_lead_is_bumped():
+    before = H.make_etag("api_chat", keys=["lead:Sara:+1"], parts=["+1"])
+    assert before == H.make_etag("api_chat", keys=["lead:Sara:+1"], parts=["+1"])
+    H.bump_lead("Sara", "+1")
+    assert H.make_etag("api_chat", keys=["lead:Sara:+1"], parts=["+1"]) != before
+
+
+def test_bump_lead_invalidates_bot_and_global_lists():
+    listas = [H.make_etag("api_leads", keys=[k]) for k in ("leads:Sara", "leads:*")]
+    otro_bot = H.make_etag("api_leads", keys=["leads:Camila"])
+    H.bump_lead("Sara", "+2")
+    assert [H.make_etag("api_leads", keys=[k]) for k in ("leads:Sara", "leads:*")] != listas
+    assert H.make_etag("api_leads", keys=["leads:Camila"]) == otro_bot
+
+
+def test_parts_are_part_of_the_etag():
+    assert H.make_etag("e", parts=["a"]) != H.make_etag("e", parts=["b"])
+    assert H.make_etag("e", parts=["a"]).startswith('W/"')
+
+
+def test_etag_matches():
+    tag = H.make_etag("e")
+    assert H.etag_matches(tag, tag)
+    assert H.etag_matches(tag.replace("W/", ""), tag)
+    assert H.etag_matches(f'"otro", {tag}', tag)
+    assert H.etag_matches("*", tag)
+    assert not H.etag_matches("", tag)
+    assert not H.etag_matches('"otro"', tag)
+
+
+def test_conditional_json_304_skips_build(app):
+    tag = H.make_etag("test_304")
+    llamadas = []
+
+    def build():
+        llamadas.append(1)
+        return {"ok": True}
+
+    with app.test_request_context(headers={"If-None-Match": tag}):
+        resp = H.conditional_json("test_304", tag, build)
+    assert resp.status_code == 304 and resp.headers["ETag"] == tag
+    assert not llamadas
+    with app.test_request_context():
+        resp = H.conditional_json("test_304", tag, build)
+    assert resp.status_code == 200 and resp.get_json() == {"ok": True} and resp.headers["ETag"] == tag
+    stats = H.http_cache_stats()["endpoints"]["test_304"]
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+def test_conditional_json_errors_carry_no_etag(app):
+    with app.test_request_context():
+        resp = H.conditional_json("test_err", H.make_etag("test_err"), lambda: ({"error": "x"}, 500))
+    assert resp.status_code == 500 and "ETag" not in resp.headers
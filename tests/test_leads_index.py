@@ -0,0 +1,104 @@
+# Paginación y filtros de leads_index sin RTDB: _fetch_chunk se resuelve sobre una lista en memoria
+import pytest
+
+import leads_index as L
+
+
+def _lead(hora, messages=1, status="nuevo"):
+    return {"last_seen": hora, "messages": messages, "status": status, "last_message": "hola", "notes": "interna"}
+
+
+ENTRIES = [
+    L.index_entry("Sara", "whatsapp:+1", _lead("2026-10-01 10:00:00", 5)),
+    L.index_entry("Sara", "whatsapp:+2", _lead("2026-10-02 10:00:00", 1, "cliente")),
+    L.index_entry("Camila", "whatsapp:+3", _lead("2026-10-03 10:00:00", 9)),
+    L.index_entry("Camila", "whatsapp:+4", _lead("2026-10-04 10:00:00", 2, "cliente")),
+]
+
+
+@pytest.fixture
+def index(monkeypatch):
+    def _fetch_chunk(field, lo, hi, cursor, n, desc):
+        return L._query_fallback(field, lo, hi, cursor, desc, ENTRIES)[:n]
+
+    monkeypatch.setattr(L, "_fetch_chunk", _fetch_chunk)
+    monkeypatch.setitem(L._ready, "ok", True)
+
+
+def _numeros(page):
+    return [l["numero"] for l in page["leads"]]
+
+
+def test_index_entry_keys_sort_like_values():
+    a = L.index_entry("Sara", "n1", _lead("2026-10-01 10:00:00", 9))
+    b = L.index_entry("Sara", "n2", _lead("2026-10-02 10:00:00", 10))
+    assert a["k_seen"] < b["k_seen"]
+    assert a["k_msgs"] < b["k_msgs"]          # ceros a la izquierda: 9 < 10 también como texto
+    assert a["k_bot_seen"].startswith("Sara|")
+
+
+def test_index_entry_truncates_last_message():
+    entry = L.index_entry("Sara", "n", {"last_message": "x" * 1000})
+    assert len(entry["last_message"]) == L._LAST_MESSAGE_MAX
+    assert entry["status"] == "nuevo"
+
+
+def test_public_hides_sort_keys():
+    assert not [k for k in L._public(ENTRIES[0]) if k.startswith("k_")]
+
+
+def test_bounds_by_bot_and_dates():
+    lo, hi = L._bounds("k_bot_seen", "Sara", "2026-10-02", "2026-10-02")
+    assert lo == f"Sara|{L._day_ms('2026-10-02'):013d}"
+    assert [e["numero"] for e in ENTRIES if lo <= e["k_bot_seen"] <= hi] == ["whatsapp:+2"]
+
+
+def test_matches_filters():
+    e = ENTRIES[1]
+    assert L._matches(e, "Sara", "cliente", "2026-10-02", "2026-10-02")
+    assert not L._matches(e, "Camila", "", "", "")
+    assert not L._matches(e, "", "nuevo", "", "")
+    assert not L._matches(e, "", "", "2026-10-03", "")
+
+
+def test_query_pages_desc_by_last_seen(index):
+    p1 = L.query_leads(limit=2)
+    assert _numeros(p1) == ["whatsapp:+4", "whatsapp:+3"]
+    assert p1["next_cursor"]
+    p2 = L.query_leads(limit=2, cursor=p1["next_cursor"])
+    assert _numeros(p2) == ["whatsapp:+2", "whatsapp:+1"]
+    assert p2["next_cursor"] is None
+
+
+def test_no_cursor_when_page_is_exactly_full(index):
+    page = L.query_leads(limit=4)
+    assert len(page["leads"]) == 4
+    assert page["next_cursor"] is None
+
+
+def test_status_filter_and_scope(index):
+    page = L.query_leads(status="cliente", limit=1)
+    assert _numeros(page) == ["whatsapp:+4"]
+    page = L.query_leads(status="cliente", limit=1, cursor=page["next_cursor"])
+    assert _numeros(page) == ["whatsapp:+2"]
+    assert page["next_cursor"] is None
+    assert _numeros(L.query_leads(allowed=["Sara"])) == ["whatsapp:+2", "whatsapp:+1"]
+
+
+def test_sort_by_messages_asc(index):
+    page = L.query_leads(sort="messages", order="asc")
+    assert [l["messages"] for l in page["leads"]] == [1, 2, 5, 9]
+
+
+def test_iter_leads_walks_every_page(index):
+    assert len(list(L.iter_leads(page_size=1))) == len(ENTRIES)
+
+
+def test_fallback_while_index_not_built(monkeypatch):
+    monkeypatch.setitem(L._ready, "ok", False)
+    monkeypatch.setitem(L._ready, "checked", 1e18)   # no volver a consultar leads_index_meta
+    monkeypatch.setattr(L, "_entries_from_leads", lambda bot="": [e for e in ENTRIES if not bot or e["bot"] == bot])
+    page = L.query_leads(bot="Camila", limit=1)
+    assert _numeros(page) == ["whatsapp:+4"] and page["next_cursor"]
+    page = L.query_leads(bot="Camila", limit=1, cursor=page["next_cursor"])
+    assert _numeros(page) == ["whatsapp:+3"] and page["next_cursor"] is None
@@ -0,0 +1,77 @@
+# Formato de texto Prometheus y agregación entre workers vía METRICS_DIR
+import json
+import os
+
+import pytest
+
+import metrics as M
+
+
+def _lineas(texto, prefijo):
+    return [l for l in texto.splitlines() if l.startswith(prefijo)]
+
+
+def test_histogram_is_cumulative_with_sum_and_count(monkeypatch):
+    monkeypatch.setattr(M, "METRICS_DIR", "")
+    M.histogram("t_hist_seconds", "prueba", buckets=(0.1, 1.0))
+    M.observe("t_hist_seconds", 0.05, route="/x")
+    M.observe("t_hist_seconds", 0.5, route="/x")
+    M.observe("t_hist_seconds", 5, route="/x")
+    texto = M.render()
+    w = f'route="/x",worker="{os.getpid()}"'
+    assert "# TYPE t_hist_seconds histogram" in texto
+    assert _lineas(texto, "t_hist_seconds_bucket") == [
+        f't_hist_seconds_bucket{{{w},le="0.1"}} 1',
+        f't_hist_seconds_bucket{{{w},le="1"}} 2',
+        f't_hist_seconds_bucket{{{w},le="+Inf"}} 3',
+    ]
+    assert _lineas(texto, "t_hist_seconds_count") == [f"t_hist_seconds_count{{{w}}} 3"]
+    assert _lineas(texto, "t_hist_seconds_sum") == [f"t_hist_seconds_sum{{{w}}} 5.55"]
+
+
+def test_label_values_are_escaped(monkeypatch):
+    monkeypatch.setattr(M, "METRICS_DIR", "")
+    M.inc("t_escape_total", bot='a"b\\c\nd')
+    assert r'bot="a\"b\\c\nd"' in _lineas(M.render(), "t_escape_total{")[0]
+
+
+def test_timer_labels_status():
+    M.histogram("t_timer_seconds", "prueba")
+    with M.timer("t_timer_seconds", op="ok"):
+        pass
+    with pytest.raises(ValueError):
+        with M.timer("t_timer_seconds", op="falla"):
+            raise ValueError()
+    claves = {dict(k)["op"]: dict(k)["status"] for k in M._series["t_timer_seconds"]}
+    assert claves == {"ok": "ok", "falla": "error"}
+
+
+def test_collector_gauges(monkeypatch):
+    monkeypatch.setattr(M, "METRICS_DIR", "")
+    M.describe("t_queue_depth", "prueba")
+
+    @M.register_collector
+    def _c():
+        return [("t_queue_depth", {"queue": "q"}, 7)]
+
+    assert _lineas(M.render(), "t_queue_depth{") == [f't_queue_depth{{queue="q",worker="{os.getpid()}"}} 7']
+
+
+def test_dead_worker_dumps_are_summed_then_retired(monkeypatch, tmp_path):
+    monkeypatch.setattr(M, "METRICS_DIR", str(tmp_path))
+    M.inc("t_shared_total", 2, bot="x")
+    muerto = M._local()
+    muerto["pid"] = 2 ** 22 + 12345   # por encima de pid_max por defecto: nunca vivo
+    muerto["gauges"] = {"t_dead_gauge": [[[["queue", "q"]], 99]]}
+    (tmp_path / f"metrics_{muerto['pid']}.json").write_text(json.dumps(muerto))
+
+    propio = sum(v for k, v in M._series["t_shared_total"].items() if dict(k) == {"bot": "x"})
+    esperado = f't_shared_total{{bot="x"}} {M._fmt_num(propio * 2)}'
+    texto = M.render()
+    assert _lineas(texto, "t_shared_total{") == [esperado]
+    assert not _lineas(texto, "t_dead_gauge{")
+    assert "metrics_workers 1" in texto
+    assert not (tmp_path / f"metrics_{muerto['pid']}.json").exists()
+    assert (tmp_path / M._RETIRED).exists()
+    # El total no retrocede en la siguiente lectura (ya desde retired_metrics.json)
+    assert _lineas(M.render(), "t_shared_total{") == [esperado]
@@ -0,0 +1,70 @@
+# Índice invertido en memoria: normalización, prefijos, AND de términos, alcance por bot y borrado
+import pytest
+
+import search_index as S
+
+
+@pytest.fixture(autouse=True)
+def index_vacio(monkeypatch):
+    monkeypatch.setattr(S, "_bots", {})
+    monkeypatch.setattr(S, "_rebuilding", {})
+    monkeypatch.setattr(S, "SEARCH_ENABLED", True)
+
+
+def _msg(texto, ts, tipo="user"):
+    return {"texto": texto, "ts": ts, "tipo": tipo, "hora": "2026-10-19 08:00:00"}
+
+
+def test_normalize_and_tokenize():
+    assert S.normalize("Niño CANCIÓN") == "nino cancion"
+    assert S.tokenize("¿Quiero la cotización del seguro?") == ["quiero", "cotizacion", "seguro"]
+    assert S.tokenize("a y x") == []
+
+
+def test_prefix_and_accent_insensitive_search():
+    S.index_message("Sara", "+1", _msg("Necesito una cotización", 1))
+    res = S.search("COT")
+    assert [r["numero"] for r in res["results"]] == ["+1"]
+    assert res["results"][0]["snippet"]["texto"] == "Necesito una cotización"
+
+
+def test_all_terms_must_match():
+    S.index_messages("Sara", "+1", [_msg("seguro de auto", 1)])
+    S.index_messages("Sara", "+2", [_msg("seguro de vida", 2)])
+    assert [r["numero"] for r in S.search("seguro auto")["results"]] == ["+1"]
+    assert S.search("seguro")["total"] == 2
+
+
+def test_results_by_latest_message_and_hits():
+    S.index_messages("Sara", "+1", [_msg("precio", 10), _msg("otro precio", 11)])
+    S.index_messages("Sara", "+2", [_msg("precio", 50)])
+    res = S.search("precio")["results"]
+    assert [r["numero"] for r in res] == ["+2", "+1"]
+    assert res[1]["hits"] == 2 and res[1]["snippet"]["ts"] == 11
+
+
+def test_duplicates_are_indexed_once():
+    S.index_message("Sara", "+1", _msg("hola precio", 5))
+    S.index_message("Sara", "+1", _msg("hola precio", 5))
+    assert S.search("precio")["results"][0]["hits"] == 1
+
+
+def test_bot_scope():
+    S.index_message("Sara", "+1", _msg("poliza", 1))
+    S.index_message("Camila", "+2", _msg("poliza", 2))
+    assert [r["bot"] for r in S.search("poliza", bots=["Sara"])["results"]] == ["Sara"]
+    assert S.search("poliza", bots=["Nadie"])["total"] == 0
+
+
+def test_remove_lead_drops_docs_and_terms():
+    S.index_message("Sara", "+1", _msg("palabraunica", 1))
+    S.remove_lead("Sara", "+1")
+    assert S.search("palabraunica")["total"] == 0
+    assert "palabraunica" not in S._bots["Sara"]["terms"]
+
+
+def test_disabled_is_a_noop(monkeypatch):
+    monkeypatch.setattr(S, "SEARCH_ENABLED", False)
+    S.index_message("Sara", "+1", _msg("precio", 1))
+    res = S.search("precio")
+    assert res["total"] == 0 and res["enabled"] is False
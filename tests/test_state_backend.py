@@ -0,0 +1,88 @@
+# Mismo contrato para todos los backends de estado (redis solo si hay un servidor en STATE_REDIS_URL)
+import time
+
+import pytest
+
+import state_backend as S
+
+
+def _redis():
+    pytest.importorskip("redis")
+    try:
+        return S.RedisBackend(ttl=60, prefix=f"test{int(time.time() * 1000)}")
+    except Exception as e:
+        pytest.skip(f"sin servidor Redis: {e}")
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return S.MemoryBackend(ttl=60)
+    if request.param == "sqlite":
+        return S.SQLiteBackend(path=str(tmp_path / "state.sqlite3"), ttl=60)
+    return _redis()
+
+
+def test_get_set_delete(backend):
+    assert backend.get("ns", "k", "def") == "def"
+    backend.set("ns", "k", {"a": [1, "ñ"]})
+    assert backend.get("ns", "k") == {"a": [1, "ñ"]}
+    assert backend.exists("ns", "k")
+    assert not backend.exists("otro", "k")
+    backend.delete("ns", "k")
+    assert not backend.exists("ns", "k")
+
+
+def test_get_many_keeps_order(backend):
+    backend.set("ns", "a", 1)
+    backend.set("ns", "c", 3)
+    assert backend.get_many("ns", ["c", "b", "a"]) == [3, None, 1]
+    assert backend.get_many("ns", []) == []
+
+
+def test_lists(backend):
+    backend.list_set("h", "k", [{"role": "system"}])
+    backend.list_append("h", "k", {"role": "user"}, {"role": "assistant"})
+    assert [m["role"] for m in backend.list_get("h", "k")] == ["system", "user", "assistant"]
+    assert backend.list_get("h", "nada") == []
+
+
+def test_empty_list_still_exists(backend):
+    backend.list_set("h", "vacia", [])
+    assert backend.exists("h", "vacia")
+    assert backend.list_get("h", "vacia") == []
+    backend.list_append("h", "vacia", "x")
+    assert backend.list_get("h", "vacia") == ["x"]
+    backend.delete("h", "vacia")
+    assert not backend.exists("h", "vacia")
+
+
+def test_incr(backend):
+    assert backend.incr("etag", "k") == 1
+    assert backend.incr("etag", "k") == 2
+    assert backend.get_many("etag", ["k"]) == [2]
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_expired_keys_are_invisible_and_purged(kind, tmp_path):
+    b = S.MemoryBackend(ttl=1) if kind == "memory" else S.SQLiteBackend(path=str(tmp_path / "s.db"), ttl=1)
+    b.set("ns", "k", 1)
+    time.sleep(1.1)
+    assert b.get("ns", "k") is None and not b.exists("ns", "k")
+    assert b.purge() >= 0
+    assert b.size() == 0
+
+
+def test_sqlite_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "shared.db")
+    a, b = S.SQLiteBackend(path=path, ttl=60), S.SQLiteBackend(path=path, ttl=60)
+    a.incr("etag", "k")
+    assert b.incr("etag", "k") == 2
+
+
+def test_make_backend_rejects_unknown_and_fails_fast(tmp_path):
+    assert S.make_backend("memory").name == "memory"
+    with pytest.raises(RuntimeError):
+        S.make_backend("mongo")
+    with pytest.raises(RuntimeError):
+        S.make_backend("sqlite", path=str(tmp_path / "no" / "existe" / "x.db"))
@@ -0,0 +1,202 @@
+# voice_audio.py
+# Almacén de audios de voz (saludos y respuestas TTS en MP3)
+# - Registra cada archivo por llamada (CallSid) para poder liberarlo al colgar
+# - GC en segundo plano: TTL por archivo + presupuesto total de disco
+# - Servido eficiente para Twilio: validación de nombre, ETag, Cache-Control y Range
+
+from flask import send_file
+import os
+import re
+import time
+import uuid
+import hashlib
+import threading
+
+# =======================
+# Configuración (entorno)
+# =======================
+# Directorio propio: el GC de huérfanos borra por patrón de nombre y no debe tocar archivos ajenos
+AUDIO_DIR = (os.environ.get("VOICE_AUDIO_DIR") or "/tmp/voice_audio").strip() or "/tmp/voice_audio"
+AUDIO_TTL_SEC = int(os.environ.get("VOICE_AUDIO_TTL_SEC", "900") or 900)          # 15 min por archivo
+AUDIO_MAX_BYTES = int(float(os.environ.get("VOICE_AUDIO_MAX_MB", "200") or 200) * 1024 * 1024)
+AUDIO_GC_INTERVAL_SEC = int(os.environ.get("VOICE_AUDIO_GC_INTERVAL_SEC", "60") or 60)
+
+# Solo servimos nombres generados por nosotros: "<CallSid>_<sufijo>.mp3"
+_SAFE_NAME = re.compile(r"^[A-Za-z0-9]+_[A-Za-z0-9\-]+\.mp3$")
+
+# =======================
+# Estado (runtime)
+# =======================
+_lock = threading.Lock()
+_files = {}       # filename -> {"call_sid": str, "size": int, "created": ts, "etag": str}
+_by_call = {}     # call_sid -> set(filenames)
+_gc_started = False
+_stats = {"served": 0, "not_modified": 0, "deleted_ttl": 0, "deleted_budget": 0, "deleted_call_end": 0}
+
+
+def _path(filename: str) -> str:
+    return os.path.join(AUDIO_DIR, filename)
+
+def _safe_call_sid(call_sid: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]", "", str(call_sid or "")) or "nocall"
+
+def _remove_file(filename: str):
+    try:
+        os.remove(_path(filename))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"[voice_audio] ⚠️ No se pudo borrar {filename}: {e}")
+
+def _forget(filename: str):
+    """Quita el archivo de los índices (llamar con _lock tomado)."""
+    info = _files.pop(filename, None)
+    if info:
+        names = _by_call.get(info["call_sid"])
+        if names is not None:
+            names.discard(filename)
+            if not names:
+                _by_call.pop(info["call_sid"], None)
+    return info
+
+# =======================
+# API del almacén
+# =======================
+def audio_new_file(call_sid: str, suffix: str = ""):
+    """Devuelve (filename, path) para un audio nuevo de la llamada. No registra hasta audio_register()."""
+    if not os.path.exists(AUDIO_DIR):
+        os.makedirs(AUDIO_DIR, exist_ok=True)
+    suffix = re.sub(r"[^A-Za-z0-9\-]", "", suffix or "") or uuid.uuid4().hex[:8]
+    filename = f"{_safe_call_sid(call_sid)}_{suffix}.mp3"
+    return filename, _path(filename)
+
+def audio_register(call_sid: str, filename: str):
+    """Registra un archivo ya escrito en disco y aplica el presupuesto total."""
+    try:
+        st = os.stat(_path(filename))
+    except FileNotFoundError:
+        return False
+    etag = hashlib.md5(f"{filename}:{st.st_size}:{int(st.st_mtime)}".encode("utf-8")).hexdigest()
+    sid = _safe_call_sid(call_sid)
+    with _lock:
+        _files[filename] = {"call_sid": sid, "size": int(st.st_size), "created": time.time(), "etag": etag}
+        _by_call.setdefault(sid, set()).add(filename)
+    _enforce_budget()
+    return True
+
+def audio_release_call(call_sid: str) -> int:
+    """Borra todos los audios de una llamada (al colgar). Devuelve cuántos se borraron."""
+    sid = _safe_call_sid(call_sid)
+    with _lock:
+        names = list(_by_call.get(sid, set()))
+        for n in names:
+            _forget(n)
+        _stats["deleted_call_end"] += len(names)
+    for n in names:
+        _remove_file(n)
+    return len(names)
+
+def _enforce_budget():
+    """Si el total supera AUDIO_MAX_BYTES, borra los más antiguos primero."""
+    victims = []
+    with _lock:
+        total = sum(i["size"] for i in _files.values())
+        if total <= AUDIO_MAX_BYTES:
+            return
+        for name, info in sorted(_files.items(), key=lambda kv: kv[1]["created"]):
+            if total <= AUDIO_MAX_BYTES:
+                break
+            total -= info["size"]
+            victims.append(name)
+        for n in victims:
+            _forget(n)
+        _stats["deleted_budget"] += len(victims)
+    for n in victims:
+        _remove_file(n)
+
+def audio_gc():
+    """Borra audios vencidos (TTL), incluidos huérfanos de reinicios previos, y aplica el presupuesto."""
+    now = time.time()
+    victims = []
+    with _lock:
+        for name, info in list(_files.items()):
+            if now - info["created"] > AUDIO_TTL_SEC:
+                _forget(name)
+                victims.append(name)
+        tracked = set(_files.keys())
+
+    # Huérfanos: archivos con nuestro patrón que no están en el índice (p. ej. tras reinicio)
+    try:
+        for entry in os.scandir(AUDIO_DIR):
+            if entry.name in tracked or not _SAFE_NAME.match(entry.name):
+                continue
+            try:
+                if now - entry.stat().st_mtime > AUDIO_TTL_SEC:
+                    victims.append(entry.name)
+            except FileNotFoundError:
+                continue
+    except FileNotFoundError:
+        pass
+
+    for n in victims:
+        _remove_file(n)
+    with _lock:
+        _stats["deleted_ttl"] += len(victims)
+    _enforce_budget()
+    return len(victims)
+
+def _gc_loop():
+    while True:
+        time.sleep(AUDIO_GC_INTERVAL_SEC)
+        try:
+            audio_gc()
+        except Exception as e:
+            print(f"[voice_audio] ⚠️ Error en GC: {e}")
+
+def audio_start_gc():
+    """Arranca (una sola vez) el hilo de GC en segundo plano."""
+    global _gc_started
+    with _lock:
+        if _gc_started:
+            return
+        _gc_started = True
+    threading.Thread(target=_gc_loop, daemon=True).start()
+
+def audio_stats() -> dict:
+    with _lock:
+        return {
+            "files": len(_files),
+            "calls": len(_by_call),
+            "bytes": sum(i["size"] for i in _files.values()),
+            "max_bytes": AUDIO_MAX_BYTES,
+            "ttl_sec": AUDIO_TTL_SEC,
+            **_stats,
+        }
+
+# =======================
+# Servido HTTP
+# =======================
+def audio_response(filename: str):
+    """Respuesta Flask para /voice-audio/<filename> con ETag, Cache-Control y soporte de Range."""
+    if not _SAFE_NAME.match(filename or ""):
+        return "Archivo no encontrado", 404
+    path = _path(filename)
+    if not os.path.isfile(path):
+        print(f"❌ Error 404: Archivo no encontrado en {path}")
+        return "Archivo no encontrado", 404
+
+    with _lock:
+        info = _files.get(filename)
+    etag = info["etag"] if info else True  # True => Flask calcula el ETag a partir del archivo
+
+    # conditional=True => 304 con If-None-Match/If-Modified-Since y 206 con Range
+    resp = send_file(path, mimetype="audio/mpeg", as_attachment=False, conditional=True, etag=etag, max_age=AUDIO_TTL_SEC)
+    # El contenido de cada nombre nunca cambia (sufijo único por audio)
+    resp.headers["Cache-Control"] = f"public, max-age={AUDIO_TTL_SEC}, immutable"
+    resp.headers["Accept-Ranges"] = "bytes"
+    with _lock:
+        if resp.status_code == 304:
+            _stats["not_modified"] += 1
+        else:
+            _stats["served"] += 1
+    return resp
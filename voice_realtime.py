@@ -0,0 +1,360 @@
+# voice_realtime.py
+# Modo de voz en tiempo real: puente Twilio Media Streams <-> modelo realtime de OpenAI
+# - /voice-stream (WebSocket): recibe audio μ-law 8 kHz de Twilio y lo reenvía tal cual al modelo
+# - El audio del modelo (también g711_ulaw) vuelve a Twilio frame a frame, sin archivos ni TTS
+# - Barge-in: si el llamante habla mientras el bot responde o Twilio aún reproduce su audio (hasta que devuelve
+#   el mark enviado al final de la respuesta), se limpia el buffer de Twilio y se trunca/cancela la respuesta
+# - Latencia por turno (fin de voz -> primer audio) y por frame (recepción -> envío a Twilio)
+# - OPENAI_REALTIME_URL permite apuntar a un servidor falso local (ver bench/fake_realtime.py)
+
+from flask_sock import Sock
+from collections import deque
+import os
+import json
+import time
+import threading
+from urllib.parse import quote
+
+import websocket  # websocket-client
+
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY") or ""
+OPENAI_REALTIME_URL = (os.environ.get("OPENAI_REALTIME_URL") or "wss://api.openai.com/v1/realtime").strip()
+VOICE_REALTIME_DEFAULT = (os.environ.get("VOICE_REALTIME", "") or "").strip().lower() in ("1", "true", "on", "yes")
+
+# Twilio Media Streams: μ-law 8 kHz => 8 bytes por ms de audio
+_ULAW_BYTES_PER_MS = 8
+
+sock = Sock()
+
+# Hooks que registra main.py (resolver bot, guardar turnos, finalizar llamada)
+_hooks = {"resolve_bot": None, "on_start": None, "on_turn": None, "on_end": None}
+
+# =======================
+# Métricas (runtime)
+# =======================
+_stats_lock = threading.Lock()
+_stats = {"active": 0, "calls": 0, "turns": 0, "frames_in": 0, "frames_out": 0, "barge_ins": 0, "upstream_errors": 0}
+_turn_latency_ms = deque(maxlen=1000)    # fin de voz del llamante -> primer frame de audio del bot
+_frame_forward_ms = deque(maxlen=5000)   # frame recibido del modelo -> enviado a Twilio
+
+def _bump(key: str, n: int = 1):
+    with _stats_lock:
+        _stats[key] += n
+
+def _pct(values, p: float) -> float:
+    if not values:
+        return 0.0
+    vals = sorted(values)
+    idx = min(len(vals) - 1, int(round((p / 100.0) * (len(vals) - 1))))
+    return round(vals[idx], 2)
+
+def realtime_stats() -> dict:
+    with _stats_lock:
+        turns = list(_turn_latency_ms)
+        frames = list(_frame_forward_ms)
+        out = dict(_stats)
+    out["turn_latency_ms"] = {"p50": _pct(turns, 50), "p95": _pct(turns, 95), "p99": _pct(turns, 99), "n": len(turns)}
+    out["frame_forward_ms"] = {"p50": _pct(frames, 50), "p95": _pct(frames, 95), "p99": _pct(frames, 99), "n": len(frames)}
+    return out
+
+# =======================
+# Config por bot
+# =======================
+def realtime_enabled(bot_cfg: dict) -> bool:
+    """El bot usa modo realtime si 'realtime.enabled' es true (o VOICE_REALTIME=1 y el bot trae bloque realtime)."""
+    rt = (bot_cfg or {}).get("realtime")
+    if not isinstance(rt, dict) or not rt:
+        return False
+    if "enabled" in rt:
+        return bool(rt.get("enabled"))
+    return VOICE_REALTIME_DEFAULT
+
+def _session_payload(bot_cfg: dict) -> dict:
+    rt = (bot_cfg or {}).get("realtime") or {}
+    vad = rt.get("vad") or {}
+    transcription = rt.get("transcription") or {}
+    session = {
+        "modalities": ["audio", "text"],
+        "voice": rt.get("voice") or "alloy",
+        "instructions": (bot_cfg or {}).get("system_prompt", "") or "",
+        # Twilio entrega/recibe μ-law 8 kHz; usamos el mismo formato para no transcodificar
+        "input_audio_format": "g711_ulaw",
+        "output_audio_format": "g711_ulaw",
+    }
+    if vad.get("enable", True):
+        session["turn_detection"] = {
+            "type": "server_vad",
+            "prefix_padding_ms": int(vad.get("prefix_ms", 300)),
+            "silence_duration_ms": int(vad.get("silence_ms", 500)),
+        }
+    if transcription.get("enable", True):
+        session["input_audio_transcription"] = {"model": "whisper-1"}
+    return session
+
+def _upstream_url(bot_cfg: dict) -> str:
+    model = (((bot_cfg or {}).get("realtime") or {}).get("model") or "gpt-4o-realtime-preview").strip()
+    sep = "&" if "?" in OPENAI_REALTIME_URL else "?"
+    return f"{OPENAI_REALTIME_URL}{sep}model={model}"
+
+# =======================
+# Puente por llamada
+# =======================
+class _Bridge:
+    """Estado de una llamada en modo realtime (un WebSocket Twilio + uno hacia el modelo)."""
+
+    def __init__(self, twilio_ws):
+        self.twilio_ws = twilio_ws
+        self.upstream = None
+        self.stream_sid = ""
+        self.call_sid = ""
+        self.bot_cfg = {}
+        self.closed = False
+        self.send_lock = threading.Lock()
+        self.up_lock = threading.Lock()
+        # Turno en curso
+        self.responding = False
+        self.playing = False          # Twilio tiene audio del bot en cola hasta que devuelve pending_mark
+        self.pending_mark = ""
+        self.mark_seq = 0
+        self.speech_stopped_at = 0.0
+        self.first_delta_pending = False
+        self.current_item_id = ""
+        self.item_audio_ms = 0
+        self.item_started_at = 0.0
+
+    # ---- envíos ----
+    def to_twilio(self, payload: dict):
+        with self.send_lock:
+            self.twilio_ws.send(json.dumps(payload))
+
+    def to_upstream(self, payload: dict):
+        if not self.upstream:
+            return
+        with self.up_lock:
+            self.upstream.send(json.dumps(payload))
+
+    # ---- ciclo de vida ----
+    def open_upstream(self, bot_cfg: dict):
+        self.bot_cfg = bot_cfg or {}
+        headers = [f"Authorization: Bearer {OPENAI_API_KEY}", "OpenAI-Beta: realtime=v1"]
+        self.upstream = websocket.create_connection(_upstream_url(self.bot_cfg), header=headers, timeout=10)
+        self.upstream.settimeout(None)
+        self.to_upstream({"type": "session.update", "session": _session_payload(self.bot_cfg)})
+        greeting = (self.bot_cfg.get("voice_greeting") or "").strip()
+        if greeting:
+            # El saludo lo dice el propio modelo con la voz configurada
+            self.to_upstream({"type": "response.create", "response": {"instructions": f"Saluda exactamente así: {greeting}"}})
+        threading.Thread(target=self._upstream_loop, daemon=True).start()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.upstream:
+                self.upstream.close()
+        except Exception:
+            pass
+
+    # ---- audio del llamante ----
+    def on_caller_media(self, payload_b64: str):
+        _bump("frames_in")
+        self.to_upstream({"type": "input_audio_buffer.append", "audio": payload_b64})
+
+    # ---- eventos del modelo ----
+    def _barge_in(self):
+        """El llamante interrumpe: vaciar lo que Twilio tiene en cola y cortar la respuesta del modelo."""
+        _bump("barge_ins")
+        try:
+            self.to_twilio({"event": "clear", "streamSid": self.stream_sid})
+            if self.responding:
+                self.to_upstream({"type": "response.cancel"})
+            if self.current_item_id:
+                played_ms = int((time.time() - self.item_started_at) * 1000) if self.item_started_at else 0
+                self.to_upstream({
+                    "type": "conversation.item.truncate",
+                    "item_id": self.current_item_id,
+                    "content_index": 0,
+                    "audio_end_ms": max(0, min(played_ms, self.item_audio_ms)),
+                })
+        except Exception as e:
+            print(f"[voice_realtime] ⚠️ Error en barge-in: {e}")
+        self.responding = False
+        self.playing = False
+        self.pending_mark = ""     # Twilio devuelve los marks vaciados por clear: se ignoran
+        self.current_item_id = ""
+
+    def on_mark(self, name: str):
+        """Twilio terminó de reproducir hasta este mark: si es el de la última respuesta, ya no hay audio en cola."""
+        if name and name == self.pending_mark:
+            self.playing = False
+            self.pending_mark = ""
+            if not self.responding:
+                self.current_item_id = ""
+
+    def _on_audio_delta(self, evt: dict, received_at: float):
+        delta = evt.get("delta") or ""
+        if not delta:
+            return
+        item_id = evt.get("item_id") or ""
+        if item_id and item_id != self.current_item_id:
+            self.current_item_id = item_id
+            self.item_audio_ms = 0
+            self.item_started_at = time.time()
+        if self.first_delta_pending and self.speech_stopped_at:
+            with _stats_lock:
+                _turn_latency_ms.append((received_at - self.speech_stopped_at) * 1000.0)
+            self.first_delta_pending = False
+        self.responding = True
+        self.playing = True
+        self.to_twilio({"event": "media", "streamSid": self.stream_sid, "media": {"payload": delta}})
+        # base64 -> bytes μ-law -> ms de audio
+        self.item_audio_ms += int(len(delta) * 3 / 4) // _ULAW_BYTES_PER_MS
+        with _stats_lock:
+            _stats["frames_out"] += 1
+            _frame_forward_ms.append((time.time() - received_at) * 1000.0)
+
+    def _emit_turn(self, tipo: str, texto: str):
+        texto = (texto or "").strip()
+        if not texto or not _hooks["on_turn"]:
+            return
+        try:
+            _hooks["on_turn"](self.call_sid, tipo, texto)
+        except Exception as e:
+            print(f"[voice_realtime] ⚠️ Error guardando turno: {e}")
+
+    def _upstream_loop(self):
+        interruptible = bool(((self.bot_cfg.get("realtime") or {}).get("interruptible", True)))
+        while not self.closed:
+            try:
+                raw = self.upstream.recv()
+            except Exception as e:
+                if not self.closed:
+                    _bump("upstream_errors")
+                    print(f"[voice_realtime] ⚠️ Conexión con el modelo cerrada: {e}")
+                break
+            if not raw:
+                break
+            received_at = time.time()
+            try:
+                evt = json.loads(raw)
+            except Exception:
+                continue
+            etype = evt.get("type", "")
+
+            try:
+                if etype in ("response.audio.delta", "response.output_audio.delta"):
+                    self._on_audio_delta(evt, received_at)
+                elif etype == "input_audio_buffer.speech_started":
+                    if interruptible and (self.responding or self.playing):
+                        self._barge_in()
+                elif etype == "input_audio_buffer.speech_stopped":
+                    self.speech_stopped_at = received_at
+                    self.first_delta_pending = True
+                    _bump("turns")
+                elif etype == "conversation.item.input_audio_transcription.completed":
+                    self._emit_turn("user", evt.get("transcript", ""))
+                elif etype in ("response.audio_transcript.done", "response.output_audio_transcript.done"):
+                    self._emit_turn("bot", evt.get("transcript", ""))
+                elif etype == "response.done":
+                    self.responding = False
+                    if self.playing:
+                        # El audio sigue en el buffer de Twilio: current_item_id se conserva para poder
+                        # truncar si hay barge-in antes de que Twilio devuelva este mark
+                        self.mark_seq += 1
+                        self.pending_mark = f"response_done_{self.mark_seq}"
+                        self.to_twilio({"event": "mark", "streamSid": self.stream_sid, "mark": {"name": self.pending_mark}})
+                    else:
+                        self.current_item_id = ""
+                elif etype == "error":
+                    _bump("upstream_errors")
+                    print(f"[voice_realtime] ⚠️ Error del modelo: {evt.get('error')}")
+            except Exception as e:
+                if not self.closed:
+                    print(f"[voice_realtime] ⚠️ Error reenviando a Twilio: {e}")
+                    break
+        self.close()
+
+# =======================
+# WebSocket de Twilio
+# =======================
+@sock.route("/voice-stream")
+def voice_stream(ws):
+    _serve_stream(ws)
+
+@sock.route("/voice-stream/<call_sid>")
+def voice_stream_call(ws, call_sid):
+    # El CallSid va en la ruta solo para que dispatcher.py enrute al worker de la llamada
+    _serve_stream(ws)
+
+def _serve_stream(ws):
+    bridge = _Bridge(ws)
+    with _stats_lock:
+        _stats["active"] += 1
+        _stats["calls"] += 1
+    try:
+        while not bridge.closed:
+            raw = ws.receive()
+            if raw is None:
+                break
+            try:
+                msg = json.loads(raw)
+            except Exception:
+                continue
+            event = msg.get("event")
+
+            if event == "start":
+                start = msg.get("start") or {}
+                params = start.get("customParameters") or {}
+                bridge.stream_sid = start.get("streamSid") or msg.get("streamSid") or ""
+                bridge.call_sid = start.get("callSid") or params.get("call_sid") or ""
+                resolve = _hooks["resolve_bot"]
+                bot_cfg = resolve(params.get("to", "")) if resolve else None
+                if not bot_cfg:
+                    print(f"[voice_realtime] ❌ Sin bot para {params.get('to')}")
+                    break
+                if _hooks["on_start"]:
+                    _hooks["on_start"](bridge.call_sid, bot_cfg, params.get("from", ""))
+                bridge.open_upstream(bot_cfg)
+                print(f"[voice_realtime] Llamada {bridge.call_sid} conectada a {_upstream_url(bot_cfg)}")
+            elif event == "media":
+                media = msg.get("media") or {}
+                # Solo audio del llamante (track inbound)
+                if media.get("track", "inbound") == "inbound" and media.get("payload"):
+                    bridge.on_caller_media(media["payload"])
+            elif event == "mark":
+                bridge.on_mark((msg.get("mark") or {}).get("name", ""))
+            elif event == "stop":
+                break
+    except Exception as e:
+        print(f"[voice_realtime] ⚠️ Error en el stream de Twilio: {e}")
+    finally:
+        bridge.close()
+        with _stats_lock:
+            _stats["active"] -= 1
+        if bridge.call_sid and _hooks["on_end"]:
+            try:
+                _hooks["on_end"](bridge.call_sid)
+            except Exception as e:
+                print(f"[voice_realtime] ⚠️ Error finalizando llamada: {e}")
+
+# =======================
+# Registro en la app
+# =======================
+def init_voice_realtime(app, resolve_bot, on_start=None, on_turn=None, on_end=None):
+    """Registra el WebSocket /voice-stream y los hooks de main.py."""
+    _hooks.update({"resolve_bot": resolve_bot, "on_start": on_start, "on_turn": on_turn, "on_end": on_end})
+    sock.init_app(app)
+
+def realtime_stream_url(host_url: str, call_sid: str = "") -> str:
+    """
+    URL wss:// del stream a partir de request.host_url (Render termina TLS delante de la app).
+    Con call_sid la URL es /voice-stream/<CallSid> (Twilio no admite query en <Stream url>),
+    y el despachador manda el WebSocket al mismo worker que atiende la llamada.
+    """
+    base = (host_url or "").rstrip("/")
+    if base.startswith("https://"):
+        base = "wss://" + base[len("https://"):]
+    elif base.startswith("http://"):
+        base = "ws://" + base[len("http://"):]
+    return f"{base}/voice-stream/{quote(call_sid, safe='')}" if call_sid else f"{base}/voice-stream"